@@ -0,0 +1,643 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Minimal in-process stand-ins for the brokers, speaking just enough of each protocol for the backends:
+# Redis pub/sub, NATS, MQTT 3.1.1 / 5 and AMQP 0-9-1. Messages are kept in memory only and delivered right away,
+# so the benchmarks measure h2a and not the broker.
+#
+#   python3 bench/brokers.py redis --port 6379
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from collections import deque
+from fnmatch import fnmatchcase
+from itertools import count
+import argparse
+import asyncio
+import json
+import logging
+import struct
+from http2broker.topic import TopicTrie
+
+LOG = logging.getLogger('bench.brokers')
+
+
+class Broker(object):
+    # Shared state of all connections to one stand-in
+    def __init__(self):
+        self.connections = set()
+        self.published = 0
+        self.delivered = 0
+
+
+class LineProtocol(asyncio.Protocol):
+    def __init__(self, broker):
+        self.broker = broker
+        self.buf = bytearray()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.broker.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.broker.connections.discard(self)
+        self.transport = None
+        self.closed()
+
+    def closed(self):
+        pass
+
+    def write(self, data):
+        if self.transport is not None:
+            self.transport.write(data)
+
+
+# Redis
+
+def _resp(*items):
+    parts = [b'*', str(len(items)).encode('ascii'), b'\r\n']
+    for item in items:
+        if isinstance(item, int):
+            parts.extend([b':', str(item).encode('ascii'), b'\r\n'])
+        else:
+            parts.extend([b'$', str(len(item)).encode('ascii'), b'\r\n', item, b'\r\n'])
+    return b''.join(parts)
+
+
+class RedisBroker(Broker):
+    def __init__(self):
+        super().__init__()
+        self.channels = {}
+        self.patterns = {}
+
+    def publish(self, channel, payload):
+        self.published += 1
+        receivers = 0
+        for connection in tuple(self.channels.get(channel, ())):
+            connection.write(_resp(b'message', channel, payload))
+            receivers += 1
+        name = channel.decode('utf-8', 'replace')
+        for pattern, connections in tuple(self.patterns.items()):
+            if fnmatchcase(name, pattern.decode('utf-8', 'replace')):
+                for connection in tuple(connections):
+                    connection.write(_resp(b'pmessage', pattern, channel, payload))
+                    receivers += 1
+        self.delivered += receivers
+        return receivers
+
+
+class RedisProtocol(LineProtocol):
+    def __init__(self, broker):
+        super().__init__(broker)
+        self.channels = set()
+        self.patterns = set()
+
+    def data_received(self, data):
+        self.buf.extend(data)
+        offset = 0
+        while True:
+            parsed = self._parse(offset)
+            if parsed is None:
+                break
+            command, offset = parsed
+            self.command(command)
+        del self.buf[:offset]
+
+    def _parse(self, offset):
+        buf = self.buf
+        eol = buf.find(b'\r\n', offset)
+        if eol < 0:
+            return None
+        if buf[offset:offset + 1] != b'*':
+            return bytes(buf[offset:eol]).split(), eol + 2
+        items = []
+        pos = eol + 2
+        for _ in range(int(buf[offset + 1:eol])):
+            eol = buf.find(b'\r\n', pos)
+            if eol < 0:
+                return None
+            size = int(buf[pos + 1:eol])
+            if len(buf) < eol + 2 + size + 2:
+                return None
+            items.append(bytes(buf[eol + 2:eol + 2 + size]))
+            pos = eol + 2 + size + 2
+        return items, pos
+
+    def command(self, command):
+        if not command:
+            return
+        name = command[0].upper()
+        args = command[1:]
+        if name == b'PUBLISH':
+            self.write(b':' + str(self.broker.publish(args[0], args[1])).encode('ascii') + b'\r\n')
+        elif name in (b'SUBSCRIBE', b'PSUBSCRIBE'):
+            subscriptions, names = (self.channels, self.broker.channels) if name == b'SUBSCRIBE' else (self.patterns, self.broker.patterns)
+            for arg in args:
+                subscriptions.add(arg)
+                names.setdefault(arg, set()).add(self)
+                self.write(_resp(name.lower(), arg, len(self.channels) + len(self.patterns)))
+        elif name in (b'UNSUBSCRIBE', b'PUNSUBSCRIBE'):
+            subscriptions, names = (self.channels, self.broker.channels) if name == b'UNSUBSCRIBE' else (self.patterns, self.broker.patterns)
+            for arg in args or list(subscriptions):
+                subscriptions.discard(arg)
+                names.get(arg, set()).discard(self)
+                self.write(_resp(name.lower(), arg, len(self.channels) + len(self.patterns)))
+        elif name == b'PING':
+            self.write(b'+PONG\r\n')
+        elif name in (b'SELECT', b'AUTH', b'CLIENT'):
+            self.write(b'+OK\r\n')
+        else:
+            self.write(b'-ERR unknown command\r\n')
+
+    def closed(self):
+        for channel in self.channels:
+            self.broker.channels.get(channel, set()).discard(self)
+        for pattern in self.patterns:
+            self.broker.patterns.get(pattern, set()).discard(self)
+
+
+# NATS
+
+class NATSBroker(Broker):
+    def __init__(self):
+        super().__init__()
+        self.subscriptions = TopicTrie('.', '*', '>', multi_empty=False)
+
+    def publish(self, subject, payload):
+        self.published += 1
+        receivers = self.subscriptions.match(subject.decode('utf-8'))
+        for connection, sid in receivers:
+            connection.write(b''.join([b'MSG ', subject, b' ', sid, b' ', str(len(payload)).encode('ascii'), b'\r\n', payload, b'\r\n']))
+        self.delivered += len(receivers)
+
+
+class NATSProtocol(LineProtocol):
+    def __init__(self, broker):
+        super().__init__(broker)
+        self.sids = {}
+        self.pub = None
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.write(b'INFO ' + json.dumps({'server_id': 'bench', 'version': '0.0.0', 'max_payload': 1048576}).encode('ascii') + b'\r\n')
+
+    def data_received(self, data):
+        buf = self.buf
+        buf.extend(data)
+        offset = 0
+        while True:
+            if self.pub is not None:
+                subject, size = self.pub
+                if len(buf) - offset < size + 2:
+                    break
+                self.pub = None
+                self.broker.publish(subject, bytes(buf[offset:offset + size]))
+                offset += size + 2
+                continue
+            eol = buf.find(b'\r\n', offset)
+            if eol < 0:
+                break
+            line = bytes(buf[offset:eol])
+            offset = eol + 2
+            self.operation(line.split())
+        del buf[:offset]
+
+    def operation(self, args):
+        if not args:
+            return
+        op = args[0].upper()
+        if op == b'PUB':
+            self.pub = (args[1], int(args[-1]))
+        elif op == b'SUB':
+            sid = args[-1]
+            self.sids[sid] = args[1].decode('utf-8')
+            self.broker.subscriptions.add(self.sids[sid], (self, sid))
+        elif op == b'UNSUB':
+            subject = self.sids.pop(args[1], None)
+            if subject is not None:
+                self.broker.subscriptions.remove(subject, (self, args[1]))
+        elif op == b'PING':
+            self.write(b'PONG\r\n')
+
+    def closed(self):
+        for sid, subject in self.sids.items():
+            self.broker.subscriptions.remove(subject, (self, sid))
+
+
+# MQTT
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+
+def _mqtt_length(n):
+    out = bytearray()
+    while True:
+        byte = n % 128
+        n //= 128
+        out.append(byte | 0x80 if n else byte)
+        if not n:
+            return bytes(out)
+
+
+def _mqtt_packet(kind, flags, *parts):
+    body = b''.join(parts)
+    return bytes([kind << 4 | flags]) + _mqtt_length(len(body)) + body
+
+
+def _mqtt_string(value):
+    return struct.pack('!H', len(value)) + value
+
+
+def _mqtt_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+class MQTTBroker(Broker):
+    # Like mosquitto, a copy of a message for every matching subscription, with MQTT 5 carrying its identifier
+    def __init__(self):
+        super().__init__()
+        self.subscriptions = TopicTrie('/', '+', '#')
+
+    def publish(self, topic, payload):
+        self.published += 1
+        receivers = self.subscriptions.match(topic.decode('utf-8'))
+        for connection, subscription in receivers:
+            if connection.version >= 5:
+                identifier = connection.topics.get(subscription, None)
+                properties = b'\x0b' + _mqtt_length(identifier) if identifier else b''
+                connection.write(_mqtt_packet(PUBLISH, 0, _mqtt_string(topic), _mqtt_length(len(properties)), properties, payload))
+            else:
+                connection.write(_mqtt_packet(PUBLISH, 0, _mqtt_string(topic), payload))
+        self.delivered += len(receivers)
+
+
+class MQTTProtocol(LineProtocol):
+    def __init__(self, broker):
+        super().__init__(broker)
+        # The subscribed topic filters and their subscription identifiers
+        self.topics = {}
+        self.version = 4
+
+    def data_received(self, data):
+        buf = self.buf
+        buf.extend(data)
+        offset = 0
+        while len(buf) - offset >= 2:
+            length = 0
+            multiplier = 1
+            pos = offset + 1
+            while True:
+                if pos >= len(buf):
+                    length = None
+                    break
+                byte = buf[pos]
+                pos += 1
+                length += (byte & 0x7f) * multiplier
+                multiplier *= 128
+                if not byte & 0x80:
+                    break
+            if length is None or len(buf) - pos < length:
+                break
+            self.packet(buf[offset] >> 4, buf[offset] & 0x0f, bytes(buf[pos:pos + length]))
+            offset = pos + length
+        del buf[:offset]
+
+    def packet(self, kind, flags, body):
+        # Properties of MQTT 5 packets, if any, are empty
+        properties = b'\x00' if self.version >= 5 else b''
+        if kind == CONNECT:
+            self.version = body[6]
+            properties = b'\x00' if self.version >= 5 else b''
+            self.write(_mqtt_packet(CONNACK, 0, b'\x00\x00', properties))
+        elif kind == PUBLISH:
+            size, = struct.unpack_from('!H', body)
+            topic = body[2:2 + size]
+            offset = 2 + size
+            qos = (flags >> 1) & 3
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.write(_mqtt_packet(PUBACK if qos == 1 else PUBREC, 0, packet_id))
+            if self.version >= 5:
+                size, offset = _mqtt_varint(body, offset)
+                offset += size
+            self.broker.publish(topic, body[offset:])
+        elif kind == PUBREL:
+            self.write(_mqtt_packet(PUBCOMP, 0, body[:2]))
+        elif kind in (SUBSCRIBE, UNSUBSCRIBE):
+            packet_id = body[:2]
+            offset = 2
+            identifier = None
+            if self.version >= 5:
+                size, offset = _mqtt_varint(body, offset)
+                if size and body[offset] == 0x0b:
+                    identifier = _mqtt_varint(body, offset + 1)[0]
+                offset += size
+            granted = []
+            while offset < len(body):
+                size, = struct.unpack_from('!H', body, offset)
+                topic = body[offset + 2:offset + 2 + size].decode('utf-8')
+                offset += 2 + size
+                if kind == SUBSCRIBE:
+                    offset += 1
+                    granted.append(0)
+                    self.topics[topic] = identifier
+                    self.broker.subscriptions.add(topic, (self, topic))
+                elif self.topics.pop(topic, False) is not False:
+                    self.broker.subscriptions.remove(topic, (self, topic))
+            if kind == SUBSCRIBE:
+                self.write(_mqtt_packet(SUBACK, 0, packet_id, properties, bytes(granted)))
+            else:
+                self.write(_mqtt_packet(UNSUBACK, 0, packet_id, properties))
+        elif kind == PINGREQ:
+            self.write(_mqtt_packet(PINGRESP, 0))
+        elif kind == DISCONNECT and self.transport is not None:
+            self.transport.close()
+
+    def closed(self):
+        for topic in self.topics:
+            self.broker.subscriptions.remove(topic, (self, topic))
+
+
+# AMQP 0-9-1
+
+FRAME_METHOD, FRAME_HEADER, FRAME_BODY, FRAME_HEARTBEAT = 1, 2, 3, 8
+FRAME_END = b'\xce'
+FRAME_MAX = 131072
+
+
+class Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def _unpack(self, fmt):
+        value, = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return value
+
+    def octet(self):
+        return self._unpack('!B')
+
+    def short(self):
+        return self._unpack('!H')
+
+    def long(self):
+        return self._unpack('!I')
+
+    def longlong(self):
+        return self._unpack('!Q')
+
+    def shortstr(self):
+        size = self.octet()
+        value = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return value.decode('utf-8')
+
+    def table(self):
+        # Not needed by the stand-in, so skipped
+        self.offset += self.long()
+
+
+def _shortstr(value):
+    value = value.encode('utf-8')
+    return struct.pack('!B', len(value)) + value
+
+
+def _longstr(value):
+    return struct.pack('!I', len(value)) + value
+
+
+def _frame(kind, channel, payload):
+    return b''.join([struct.pack('!BHI', kind, channel, len(payload)), payload, FRAME_END])
+
+
+def _method(channel, class_id, method_id, *args):
+    return _frame(FRAME_METHOD, channel, struct.pack('!HH', class_id, method_id) + b''.join(args))
+
+
+class Consumer(object):
+    def __init__(self, connection, channel, tag, prefetch):
+        self.connection = connection
+        self.channel = channel
+        self.tag = tag
+        self.prefetch = prefetch
+        self.unacked = deque()
+        self.pending = deque()
+
+
+class AMQPBroker(Broker):
+    def __init__(self):
+        super().__init__()
+        self.exchanges = {}
+        self.consumers = {}
+        self.names = count(1)
+
+    def exchange(self, name):
+        if name not in self.exchanges:
+            self.exchanges[name] = TopicTrie('.', '*', '#')
+        return self.exchanges[name]
+
+    def publish(self, exchange, routing_key, header, body):
+        self.published += 1
+        for queue in self.exchange(exchange).match(routing_key):
+            consumer = self.consumers.get(queue, None)
+            if consumer is not None:
+                self.delivered += 1
+                consumer.pending.append((exchange, routing_key, header, body))
+                consumer.connection.deliver(consumer)
+
+
+class AMQPProtocol(LineProtocol):
+    def __init__(self, broker):
+        super().__init__(broker)
+        self.handshake = True
+        self.prefetch = {}
+        self.queues = set()
+        self.bindings = set()
+        self.publishing = {}
+        self.tags = {}
+
+    def data_received(self, data):
+        buf = self.buf
+        buf.extend(data)
+        offset = 0
+        if self.handshake:
+            if len(buf) < 8:
+                return
+            offset = 8
+            self.handshake = False
+            properties = struct.pack('!I', 0)
+            self.write(_method(0, 10, 10, b'\x00\x09', properties, _longstr(b'AMQPLAIN PLAIN'), _longstr(b'en_US')))
+        while len(buf) - offset >= 7:
+            kind, channel, size = struct.unpack_from('!BHI', buf, offset)
+            if len(buf) - offset < 7 + size + 1:
+                break
+            payload = bytes(buf[offset + 7:offset + 7 + size])
+            offset += 7 + size + 1
+            self.frame(kind, channel, payload)
+        del buf[:offset]
+
+    def frame(self, kind, channel, payload):
+        if kind == FRAME_METHOD:
+            class_id, method_id = struct.unpack_from('!HH', payload)
+            self.method(channel, class_id, method_id, Reader(payload[4:]))
+        elif kind == FRAME_HEADER:
+            exchange, routing_key = self.publishing[channel][:2]
+            body_size, = struct.unpack_from('!Q', payload, 4)
+            self.publishing[channel] = (exchange, routing_key, payload, body_size, [])
+            if body_size == 0:
+                self._published(channel)
+        elif kind == FRAME_BODY:
+            self.publishing[channel][4].append(payload)
+            if sum(len(chunk) for chunk in self.publishing[channel][4]) >= self.publishing[channel][3]:
+                self._published(channel)
+
+    def _published(self, channel):
+        exchange, routing_key, header, _, chunks = self.publishing.pop(channel)
+        self.broker.publish(exchange, routing_key, header, b''.join(chunks))
+
+    def method(self, channel, class_id, method_id, args):
+        broker = self.broker
+        if (class_id, method_id) == (10, 11):
+            # start-ok
+            self.write(_method(0, 10, 30, struct.pack('!HIH', 2047, FRAME_MAX, 0)))
+        elif (class_id, method_id) == (10, 40):
+            # open
+            self.write(_method(0, 10, 41, _shortstr('')))
+        elif (class_id, method_id) == (10, 50):
+            self.write(_method(0, 10, 51))
+            if self.transport is not None:
+                self.transport.close()
+        elif (class_id, method_id) == (20, 10):
+            self.write(_method(channel, 20, 11, _longstr(b'')))
+        elif (class_id, method_id) == (20, 40):
+            self.write(_method(channel, 20, 41))
+        elif (class_id, method_id) == (40, 10):
+            args.short()
+            broker.exchange(args.shortstr())
+            args.shortstr()
+            if not args.octet() & 0x10:
+                self.write(_method(channel, 40, 11))
+        elif (class_id, method_id) == (50, 10):
+            args.short()
+            queue = args.shortstr() or 'amq.gen-{}'.format(next(broker.names))
+            self.queues.add(queue)
+            if not args.octet() & 0x10:
+                self.write(_method(channel, 50, 11, _shortstr(queue), struct.pack('!II', 0, 0)))
+        elif (class_id, method_id) in ((50, 20), (50, 50)):
+            args.short()
+            queue, exchange, routing_key = args.shortstr(), args.shortstr(), args.shortstr()
+            if method_id == 20:
+                broker.exchange(exchange).add(routing_key, queue)
+                self.bindings.add((exchange, routing_key, queue))
+                if not args.octet() & 0x01:
+                    self.write(_method(channel, 50, 21))
+            else:
+                broker.exchange(exchange).remove(routing_key, queue)
+                self.bindings.discard((exchange, routing_key, queue))
+                self.write(_method(channel, 50, 51))
+        elif (class_id, method_id) == (60, 10):
+            args.long()
+            self.prefetch[channel] = args.short()
+            self.write(_method(channel, 60, 11))
+        elif (class_id, method_id) == (60, 20):
+            args.short()
+            queue, tag = args.shortstr(), args.shortstr()
+            tag = tag or 'ctag-{}'.format(next(broker.names))
+            broker.consumers[queue] = self.tags[tag] = Consumer(self, channel, tag, self.prefetch.get(channel, 0))
+            if not args.octet() & 0x08:
+                self.write(_method(channel, 60, 21, _shortstr(tag)))
+        elif (class_id, method_id) == (60, 40):
+            args.short()
+            self.publishing[channel] = (args.shortstr(), args.shortstr())
+        elif (class_id, method_id) == (60, 80):
+            tag = args.longlong()
+            multiple = args.octet() & 0x01
+            for consumer in self.tags.values():
+                if consumer.channel != channel:
+                    continue
+                while consumer.unacked and (consumer.unacked[0] <= tag if multiple else consumer.unacked[0] == tag):
+                    consumer.unacked.popleft()
+                if not multiple and tag in consumer.unacked:
+                    consumer.unacked.remove(tag)
+                self.deliver(consumer)
+
+    def deliver(self, consumer):
+        # Within the prefetch window of the consumer
+        while consumer.pending and (consumer.prefetch == 0 or len(consumer.unacked) < consumer.prefetch):
+            exchange, routing_key, header, body = consumer.pending.popleft()
+            tag = self.next_tag(consumer.channel)
+            consumer.unacked.append(tag)
+            frames = [_method(consumer.channel, 60, 60, _shortstr(consumer.tag), struct.pack('!QB', tag, 0),
+                              _shortstr(exchange), _shortstr(routing_key)),
+                      _frame(FRAME_HEADER, consumer.channel, header)]
+            for offset in range(0, len(body), FRAME_MAX - 8):
+                frames.append(_frame(FRAME_BODY, consumer.channel, body[offset:offset + FRAME_MAX - 8]))
+            self.write(b''.join(frames))
+
+    def next_tag(self, channel):
+        tag = self.prefetch.get(('tag', channel), 0) + 1
+        self.prefetch[('tag', channel)] = tag
+        return tag
+
+    def closed(self):
+        for exchange, routing_key, queue in self.bindings:
+            self.broker.exchange(exchange).remove(routing_key, queue)
+        for queue in self.queues:
+            self.broker.consumers.pop(queue, None)
+
+
+BROKERS = {
+    'redis': (RedisBroker, RedisProtocol, 6379),
+    'nats': (NATSBroker, NATSProtocol, 4222),
+    'mqtt': (MQTTBroker, MQTTProtocol, 1883),
+    'amqp': (AMQPBroker, AMQPProtocol, 5672),
+}
+
+
+@asyncio.coroutine
+def start(kind, host='127.0.0.1', port=None):
+    # Returns the broker and the asyncio server, port 0 picks a free one
+    broker_class, protocol_class, default_port = BROKERS[kind]
+    broker = broker_class()
+    server = yield from asyncio.get_event_loop().create_server(lambda: protocol_class(broker), host,
+                                                               default_port if port is None else port)
+    return broker, server
+
+
+def serve(kind, host='127.0.0.1', port=None, ready=None):
+    # Runs a stand-in until terminated, ready gets the port it listens on
+    loop = asyncio.get_event_loop()
+    broker, server = loop.run_until_complete(start(kind, host, port))
+    port = server.sockets[0].getsockname()[1]
+    LOG.info("%s stand-in listening on %s:%d", kind, host, port)
+    if ready is not None:
+        ready(port)
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('kind', choices=sorted(BROKERS))
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    serve(args.kind, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
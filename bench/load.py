@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# An HTTP/2 load generator for a running h2a: subscribers stream application/x-h2a-frames from GET /q/<backend>/<topic>,
+# publishers POST to /q/<backend>?k=<topic>. Every payload starts with the time it was sent, so each delivery gives
+# the end-to-end latency. Needs the h2 package (pip install h2), which h2a itself does not.
+#
+#   python3 bench/load.py --port 8443 --backend bench --subscribers 100 --publishers 4 --duration 10
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from itertools import cycle
+import argparse
+import asyncio
+import json
+import logging
+import ssl
+import struct
+import time
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import h2.settings
+
+LOG = logging.getLogger('bench.load')
+
+# u32 length, u64 id, u64 timestamp, u16 topic length, as in stream.BinaryStream
+FRAME_HEADER = struct.Struct('!IQQH')
+SENT = struct.Struct('!d')
+
+WINDOW = 2 ** 30
+
+
+class Connection(asyncio.Protocol):
+    # A client connection, each stream handled by an object with on_response(status), on_data(data) and on_end(error)
+    def __init__(self, authority):
+        self.authority = authority
+        self.h2 = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding=None))
+        self.transport = None
+        self.streams = {}
+        self.pending = {}
+        self.closed = asyncio.Future()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.h2.initiate_connection()
+        # Large windows, so flow control does not throttle the subscribers
+        self.h2.update_settings({h2.settings.SettingCodes.ENABLE_PUSH: 0,
+                                 h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: WINDOW})
+        self.h2.increment_flow_control_window(WINDOW)
+        self.flush()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        streams, self.streams = self.streams, {}
+        for handler in streams.values():
+            handler.on_end(exc or ConnectionError('Connection closed'))
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    def data_received(self, data):
+        try:
+            events = self.h2.receive_data(data)
+        except h2.exceptions.ProtocolError as e:
+            LOG.error("Protocol error: %s", e)
+            self.flush()
+            self.transport.close()
+            return
+
+        for event in events:
+            if isinstance(event, h2.events.ResponseReceived):
+                handler = self.streams.get(event.stream_id, None)
+                if handler is not None:
+                    handler.on_response(int(dict(event.headers)[b':status']))
+            elif isinstance(event, h2.events.DataReceived):
+                self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                handler = self.streams.get(event.stream_id, None)
+                if handler is not None:
+                    handler.on_data(event.data)
+            elif isinstance(event, h2.events.StreamEnded):
+                handler = self.streams.pop(event.stream_id, None)
+                if handler is not None:
+                    handler.on_end(None)
+            elif isinstance(event, h2.events.StreamReset):
+                self.pending.pop(event.stream_id, None)
+                handler = self.streams.pop(event.stream_id, None)
+                if handler is not None:
+                    handler.on_end(ConnectionError('Stream reset with {}'.format(event.error_code)))
+            elif isinstance(event, h2.events.WindowUpdated):
+                self._send_pending()
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.flush()
+
+    def flush(self):
+        data = self.h2.data_to_send()
+        if data and self.transport is not None:
+            self.transport.write(data)
+
+    def request(self, method, path, handler, headers=(), body=None):
+        if self.transport is None:
+            handler.on_end(ConnectionError('Not connected'))
+            return
+        stream_id = self.h2.get_next_available_stream_id()
+        self.h2.send_headers(stream_id, [(b':method', method), (b':scheme', b'https'), (b':authority', self.authority),
+                                         (b':path', path.encode('utf-8'))] + list(headers), end_stream=body is None)
+        self.streams[stream_id] = handler
+        if body is not None:
+            self.pending[stream_id] = body
+            self._send_pending()
+        self.flush()
+
+    def _send_pending(self):
+        for stream_id, body in list(self.pending.items()):
+            while body:
+                size = min(len(body), self.h2.local_flow_control_window(stream_id), self.h2.max_outbound_frame_size)
+                if size <= 0:
+                    break
+                self.h2.send_data(stream_id, body[:size])
+                body = body[size:]
+            if body:
+                self.pending[stream_id] = body
+            else:
+                del self.pending[stream_id]
+                self.h2.end_stream(stream_id)
+
+    def close(self):
+        if self.transport is not None:
+            self.h2.close_connection()
+            self.flush()
+            self.transport.close()
+
+
+class Latencies(object):
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    def summary(self):
+        # In milliseconds
+        values = sorted(self.values)
+        if not values:
+            return {}
+        summary = {'count': len(values), 'mean': sum(values) / len(values) * 1000, 'max': values[-1] * 1000}
+        for name, p in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999)):
+            summary[name] = values[min(len(values) - 1, int(p * len(values)))] * 1000
+        return summary
+
+
+class Subscriber(object):
+    def __init__(self, topic, latencies):
+        self.topic = topic
+        self.latencies = latencies
+        self.buf = bytearray()
+        self.delivered = 0
+        self.ready = asyncio.Future()
+
+    def on_response(self, status):
+        if not self.ready.done():
+            self.ready.set_result(status)
+
+    def on_data(self, data):
+        buf = self.buf
+        buf.extend(data)
+        now = time.time()
+        offset = 0
+        while len(buf) - offset >= FRAME_HEADER.size:
+            length, _, _, topic_length = FRAME_HEADER.unpack_from(buf, offset)
+            end = offset + 4 + length
+            if len(buf) < end:
+                break
+            start = offset + FRAME_HEADER.size + topic_length
+            if end - start >= SENT.size:
+                self.latencies.add(now - SENT.unpack_from(buf, start)[0])
+            self.delivered += 1
+            offset = end
+        del buf[:offset]
+
+    def on_end(self, error):
+        if not self.ready.done():
+            self.ready.set_result(error)
+
+
+class Publish(object):
+    def __init__(self, publisher, topic, sent):
+        self.publisher = publisher
+        self.topic = topic
+        self.sent = sent
+        self.status = None
+
+    def on_response(self, status):
+        self.status = status
+
+    def on_data(self, data):
+        pass
+
+    def on_end(self, error):
+        self.publisher.done(self, error)
+
+
+class Publisher(object):
+    # Keeps up to window POSTs outstanding, at most rate per second if set
+    def __init__(self, connection, backend, topics, size, window, rate, latencies):
+        self.connection = connection
+        self.backend = backend
+        self.topics = topics
+        self.padding = b'x' * max(0, size - SENT.size)
+        self.window = asyncio.Semaphore(window)
+        self.size = window
+        self.rate = rate
+        self.latencies = latencies
+        self.published = {}
+        self.errors = 0
+
+    @asyncio.coroutine
+    def run(self, deadline):
+        loop = asyncio.get_event_loop()
+        next_send = loop.time()
+        while loop.time() < deadline:
+            yield from self.window.acquire()
+            if self.rate:
+                next_send += 1.0 / self.rate
+                delay = next_send - loop.time()
+                if delay > 0:
+                    yield from asyncio.sleep(delay)
+            topic = next(self.topics)
+            body = SENT.pack(time.time()) + self.padding
+            request = Publish(self, topic, time.time())
+            self.connection.request(b'POST', '/q/{}?k={}'.format(self.backend, topic), request,
+                                    [(b'content-type', b'application/octet-stream'), (b'content-length', str(len(body)).encode('ascii'))],
+                                    body)
+        # The outstanding ones
+        for _ in range(self.size):
+            yield from self.window.acquire()
+
+    def done(self, request, error):
+        if error is None and request.status == 200:
+            self.latencies.add(time.time() - request.sent)
+            self.published[request.topic] = self.published.get(request.topic, 0) + 1
+        else:
+            self.errors += 1
+        self.window.release()
+
+
+def context(cafile=None):
+    if cafile:
+        ctx = ssl.create_default_context(cafile=cafile)
+    else:
+        ctx = ssl.create_default_context()
+        ctx.check_hostname = False
+        ctx.verify_mode = ssl.CERT_NONE
+    ctx.set_alpn_protocols(['h2'])
+    return ctx
+
+
+@asyncio.coroutine
+def connect(host, port, ctx):
+    _, connection = yield from asyncio.get_event_loop().create_connection(
+        lambda: Connection('{}:{}'.format(host, port).encode('ascii')), host, port, ssl=ctx, server_hostname=host)
+    return connection
+
+
+@asyncio.coroutine
+def run(host='127.0.0.1', port=443, backend='bench', subscribers=100, publishers=1, connections=8, topics=1,
+        size=64, duration=10.0, window=16, rate=0.0, warmup=1.0, drain=1.0, cafile=None):
+    # Returns the results as a dict
+    loop = asyncio.get_event_loop()
+    ctx = context(cafile)
+    names = ['bench-{}'.format(i) for i in range(topics)]
+    delivery = Latencies()
+    publish = Latencies()
+
+    subscriber_connections = []
+    for _ in range(min(connections, subscribers) if subscribers else 0):
+        subscriber_connections.append((yield from connect(host, port, ctx)))
+    streams = []
+    for i in range(subscribers):
+        subscriber = Subscriber(names[i % topics], delivery)
+        subscriber_connections[i % len(subscriber_connections)].request(
+            b'GET', '/q/{}/{}'.format(backend, subscriber.topic), subscriber, [(b'accept', b'application/x-h2a-frames')])
+        streams.append(subscriber)
+    statuses = yield from asyncio.gather(*[subscriber.ready for subscriber in streams])
+    failed = [status for status in statuses if status != 200]
+    if failed:
+        raise RuntimeError('{} of {} subscriptions failed, e.g. with {}'.format(len(failed), subscribers, failed[0]))
+    # The subscriptions at the broker are made in the background
+    yield from asyncio.sleep(warmup)
+
+    senders = []
+    for i in range(publishers):
+        connection = yield from connect(host, port, ctx)
+        senders.append(Publisher(connection, backend, cycle(names[i % topics:] + names[:i % topics]), size, window, rate, publish))
+    started = loop.time()
+    yield from asyncio.gather(*[sender.run(started + duration) for sender in senders])
+    elapsed = loop.time() - started
+    yield from asyncio.sleep(drain)
+
+    for connection in subscriber_connections + [sender.connection for sender in senders]:
+        connection.close()
+
+    published = sum(sum(sender.published.values()) for sender in senders)
+    subscribed = {}
+    for subscriber in streams:
+        subscribed[subscriber.topic] = subscribed.get(subscriber.topic, 0) + 1
+    expected = sum(count * subscribed.get(topic, 0) for sender in senders for topic, count in sender.published.items())
+    delivered = sum(subscriber.delivered for subscriber in streams)
+    return {
+        'elapsed': elapsed,
+        'published': published,
+        'publish_errors': sum(sender.errors for sender in senders),
+        'delivered': delivered,
+        'expected': expected,
+        'publish_rate': published / elapsed,
+        'delivery_rate': delivered / elapsed,
+        'publish_latency': publish.summary(),
+        'delivery_latency': delivery.summary(),
+    }
+
+
+def arguments(parser):
+    parser.add_argument('--backend', default='bench', help='the section of the backend in h2a.ini')
+    parser.add_argument('--subscribers', type=int, default=100)
+    parser.add_argument('--publishers', type=int, default=1)
+    parser.add_argument('--connections', type=int, default=8, help='connections shared by the subscribers')
+    parser.add_argument('--topics', type=int, default=1, help='the subscribers are spread over this many topics')
+    parser.add_argument('--size', type=int, default=64, help='payload size in bytes')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--window', type=int, default=16, help='outstanding POSTs per publisher')
+    parser.add_argument('--rate', type=float, default=0.0, help='messages per second per publisher, 0 for unlimited')
+    parser.add_argument('--warmup', type=float, default=1.0)
+    parser.add_argument('--drain', type=float, default=1.0)
+    return parser
+
+
+def main():
+    parser = arguments(argparse.ArgumentParser())
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=443)
+    parser.add_argument('--cafile', default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    results = asyncio.get_event_loop().run_until_complete(run(**vars(args)))
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# The cost of resolving a request to its handler, with the routes of a few backends as in h2a.ini.
+# Compares against routes.Mapper, as used before, if it is installed (pip install routes).
+#
+#   python3 bench/routing.py [--backends 4] [--number 100000]
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import argparse
+import timeit
+from http2broker.router import Router
+
+METHODS = [b'GET', b'PUT', b'POST', b'DELETE']
+
+
+def handler(request, start_response):
+    pass
+
+
+def backends(count):
+    return ['backend{}'.format(i) for i in range(count)]
+
+
+def requests(names):
+    paths = [(b'GET', '/'), (b'GET', '/favicon.ico'), (b'GET', '/static/app.js'), (b'GET', '/static/css/app.css')]
+    for name in names:
+        paths.append((b'GET', '/q/{}'.format(name)))
+        paths.append((b'GET', '/q/{}/sensors/room1/temperature'.format(name)))
+        paths.append((b'POST', '/q/{}?k=sensors.room1'.format(name)))
+    return paths
+
+
+def router(names, cache):
+    r = Router(cache)
+    r.exact('/', handler)
+    r.prefix('/static/', handler, 'filename', keep_prefix=True)
+    r.exact('/favicon.ico', handler)
+    for name in names:
+        for method in METHODS:
+            r.exact('/q/{}'.format(name), handler, [method])
+            r.prefix('/q/{}/'.format(name), handler, 'subscription', [method])
+    return lambda method, path: r.match(path, method)
+
+
+def mapper(names):
+    from routes import Mapper
+    m = Mapper()
+    m.connect('/', handler=handler)
+    m.connect('{filename:/static/.*?}', handler=handler)
+    m.connect('/favicon.ico', handler=handler)
+    for name in names:
+        for method in METHODS:
+            conditions = dict(method=[method])
+            m.connect('/q/{}'.format(name), conditions=conditions, handler=handler)
+            m.connect('/q/{}/?{{subscription:.*?}}'.format(name), conditions=conditions, handler=handler)
+    return lambda method, path: m.match(environ={'PATH_INFO': path, 'REQUEST_METHOD': method})
+
+
+def mapper_requests(paths, names):
+    # The '?' of the subscription route is a literal one for routes.Mapper, and the path included the query
+    # string, so subscriptions were requested as /q/<name>/?<subscription>
+    prefixes = ['/q/{}/'.format(name) for name in names]
+    out = []
+    for method, path in paths:
+        for prefix in prefixes:
+            if path.startswith(prefix):
+                path = prefix + '?' + path[len(prefix):]
+                break
+        out.append((method, path))
+    return out
+
+
+def run(name, match, paths, number, complete=True):
+    missing = [(method, path) for method, path in paths if match(method, path) is None]
+    if missing and complete:
+        raise SystemExit('{}: no match for {}'.format(name, missing))
+
+    def loop():
+        for method, path in paths:
+            match(method, path)
+
+    best = min(timeit.repeat(loop, number=max(1, number // len(paths)), repeat=5))
+    per_request = best / (max(1, number // len(paths)) * len(paths))
+    print('{:<20} {:>10.2f} us/request{}'.format(name, per_request * 1e6, ', {} of {} not matched'.format(len(missing), len(paths)) if missing else ''))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--backends', type=int, default=4)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    names = backends(args.backends)
+    paths = requests(names)
+    try:
+        # Publishes with a query string did not match any route of it at all
+        run('routes.Mapper', mapper(names), mapper_requests(paths, names), args.number // 10, complete=False)
+    except ImportError:
+        print('routes.Mapper       not installed')
+    run('Router, uncached', router(names, 0), paths, args.number)
+    run('Router', router(names, 1024), paths, args.number)
+
+
+if __name__ == "__main__":
+    main()
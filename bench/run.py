@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# End-to-end load test: starts a stand-in broker (see brokers.py) and h2a with a backend for it, drives it with
+# load.py and writes the latencies, message rates, and the CPU time and RSS of the h2a processes as JSON.
+# Needs the openssl command for a self-signed certificate, and whatever h2a and the backend need.
+#
+#   python3 bench/run.py nats --subscribers 1000 --publishers 4 --topics 10 --size 256 --output nats.json
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import argparse
+import asyncio
+import json
+import logging
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import load
+
+LOG = logging.getLogger('bench.run')
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+BACKENDS = {
+    'redis': ['module = http2broker.backend.redis', 'host = 127.0.0.1', 'port = {port}'],
+    'nats': ['module = http2broker.backend.pynats', 'url = nats://127.0.0.1:{port}'],
+    'mqtt': ['module = http2broker.backend.mqtt', 'host = 127.0.0.1', 'port = {port}'],
+    'amqp': ['module = http2broker.backend.amqp', 'host = 127.0.0.1', 'port = {port}', 'username = guest',
+             'password = guest', 'virtual_host = /', 'exchange_name = bench'],
+    # In-process, no stand-in needed: the cost of h2a alone
+    'memory': ['module = http2broker.backend.memory'],
+}
+
+TICKS = os.sysconf('SC_CLK_TCK')
+PAGE = os.sysconf('SC_PAGE_SIZE')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, process, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{} exited with {}'.format(process.args, process.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('Nothing listening on port {} after {}s'.format(port, timeout))
+
+
+def certificate(directory):
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                           '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+                           '-keyout', os.path.join(directory, 'server.key'), '-out', os.path.join(directory, 'server.crt')],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def configuration(args, port, broker_port):
+    content = os.path.abspath(os.path.join(ROOT, 'content'))
+    lines = ['[h2a]', 'host = 127.0.0.1', 'port = {}'.format(port), 'certfile = server.crt', 'keyfile = server.key',
+             'cafile = server.crt', 'workers = {}'.format(args.workers), 'relay = {}'.format(str(args.relay).lower()),
+             '', '[static]', 'root = {}'.format(content),
+             '', '[templates]', 'search_path = {0}/templates-wheezy;{0}'.format(content),
+             '', '[{}]'.format(args.backend)]
+    lines.extend(line.format(port=broker_port) for line in BACKENDS[args.broker])
+    lines.extend(option.replace('=', ' = ', 1) for option in args.option)
+    return '\n'.join(lines) + '\n'
+
+
+def processes(pid):
+    # The process and all its descendants, e.g. the workers
+    children = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    ppid = int(f.read().rpartition(')')[2].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    pids = [pid]
+    for pid in pids:
+        pids.extend(children.get(pid, []))
+    return pids
+
+
+def usage(pid):
+    # CPU seconds and RSS bytes over the process and its descendants
+    cpu = 0.0
+    rss = 0
+    for pid in processes(pid):
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                fields = f.read().rpartition(')')[2].split()
+            with open('/proc/{}/statm'.format(pid)) as f:
+                rss += int(f.read().split()[1]) * PAGE
+        except (OSError, IndexError, ValueError):
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / TICKS
+    return cpu, rss
+
+
+@asyncio.coroutine
+def sample(pid, peak, interval=0.5):
+    while True:
+        peak[0] = max(peak[0], usage(pid)[1])
+        yield from asyncio.sleep(interval)
+
+
+def measure(args, pid, broker_pid, port, cafile):
+    loop = asyncio.get_event_loop()
+    peak = [0]
+    cpu, rss = usage(pid)
+    broker_cpu = usage(broker_pid)[0] if broker_pid else 0.0
+    sampler = asyncio.async(sample(pid, peak))
+    started = time.time()
+    try:
+        results = loop.run_until_complete(load.run('127.0.0.1', port, args.backend, args.subscribers, args.publishers,
+                                                   args.connections, args.topics, args.size, args.duration, args.window,
+                                                   args.rate, args.warmup, args.drain, cafile))
+    finally:
+        sampler.cancel()
+    elapsed = time.time() - started
+    cpu_end, rss_end = usage(pid)
+    results['h2a'] = {'cpu_seconds': cpu_end - cpu, 'cpu_utilisation': (cpu_end - cpu) / elapsed,
+                      'rss_start': rss, 'rss_end': rss_end, 'rss_max': max(peak[0], rss_end)}
+    if broker_pid:
+        results['broker'] = {'cpu_seconds': usage(broker_pid)[0] - broker_cpu}
+    return results
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = load.arguments(argparse.ArgumentParser())
+    parser.add_argument('broker', choices=sorted(BACKENDS))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--relay', action='store_true', help='relay the messages between the workers')
+    parser.add_argument('--option', action='append', default=[], help='key=value added to the backend section')
+    parser.add_argument('--output', default=None, help='JSON file for the results, printed if not given')
+    parser.add_argument('--keep', action='store_true', help='keep the directory with h2a.ini and the logs')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    directory = tempfile.mkdtemp(prefix='h2a-bench-')
+    port, broker_port = free_port(), free_port()
+    certificate(directory)
+    with open(os.path.join(directory, 'h2a.ini'), 'w') as f:
+        f.write(configuration(args, port, broker_port))
+
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [os.path.abspath(os.path.join(ROOT, 'src')),
+                                                                     os.environ.get('PYTHONPATH')])))
+    broker = h2a = None
+    try:
+        if args.broker != 'memory':
+            with open(os.path.join(directory, 'broker.log'), 'w') as log:
+                broker = subprocess.Popen([sys.executable, os.path.join(ROOT, 'bench', 'brokers.py'), args.broker, '--port', str(broker_port)],
+                                          stdout=log, stderr=subprocess.STDOUT, env=env)
+            wait_for_port(broker_port, broker)
+        with open(os.path.join(directory, 'h2a.log'), 'w') as log:
+            h2a = subprocess.Popen([sys.executable, os.path.abspath(os.path.join(ROOT, 'src', 'h2a.py'))], cwd=directory,
+                                   stdout=log, stderr=subprocess.STDOUT, env=env)
+        wait_for_port(port, h2a)
+        LOG.info("h2a on port %d with the %s backend, in %s", port, args.broker, directory)
+
+        results = measure(args, h2a.pid, broker and broker.pid, port, os.path.join(directory, 'server.crt'))
+    finally:
+        for process in (h2a, broker):
+            if process is not None and process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    output = json.dumps({'parameters': vars(args), 'revision': revision(), 'results': results}, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -3,15 +3,38 @@
 import sys
 sys.path.append('.')
 
+import os
 import ssl
+import signal
+import asyncio
 import logging
-from http2broker.session import Session
-from http2broker.config import get_config
+import tempfile
+from http2broker.config import get_config, reload
+from http2broker.workers import Supervisor, reuse_port
+from http2broker import metrics, relay, stream
 import nghttp2
 
 LOG = logging.getLogger('http2broker')
 
 
+def serve(config, ctx, index=None, workers=1):
+    stream.seed_ids(index or 0)
+    if index is not None:
+        reuse_port(asyncio.get_event_loop())
+        metrics.LABELS['worker'] = str(index)
+        if config.get('relay', 'false').lower() in ('1', 'true', 'yes', 'on'):
+            # One socket per worker, named after the supervisor
+            path = os.path.join(config['relay_path'], 'h2a-{}-{{}}.sock'.format(os.getppid()))
+            asyncio.async(relay.setup(index, workers, path, int(config.get('relay_buffer', 4 * 1024 * 1024))).start())
+
+    # Imported only here, so every worker sets up its own event loop and backends after the fork
+    from http2broker.session import Session
+    server = nghttp2.HTTP2Server((config['host'], int(config['port'])), Session, ssl=ctx)
+    # SIGHUP reloads h2a.ini and drops the rendered pages
+    asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, reload)
+    server.serve_forever()
+
+
 def main():
     logging.basicConfig(level=logging.WARNING)
     LOG.setLevel(logging.DEBUG)
@@ -21,7 +44,9 @@ def main():
         'certfile': 'server.crt',
         'keyfile': 'server.key',
         'host': None,
-        'port': 443
+        'port': 443,
+        'workers': 1,
+        'relay_path': tempfile.gettempdir()
     }
     config.update(get_config().get('h2a', {}))
 
@@ -33,8 +58,11 @@ def main():
 
     ctx.verify_mode = ssl.CERT_OPTIONAL
 
-    server = nghttp2.HTTP2Server((config['host'], int(config['port'])), Session, ssl=ctx)
-    server.serve_forever()
+    workers = int(config['workers'])
+    if workers > 1:
+        Supervisor(workers, lambda index: serve(config, ctx, index, workers)).run()
+    else:
+        serve(config, ctx)
 
 
 if __name__ == "__main__":
@@ -1,2 +1,2 @@
 __author__ = 'fabian'
-__all__ = ['amqp', 'mqtt', 'redis', 'pynats']
+__all__ = ['amqp', 'mqtt', 'redis', 'pynats', 'memory']
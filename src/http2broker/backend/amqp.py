@@ -1,225 +1,243 @@
-from collections import deque
 import logging
-import nghttp2
 import asynqp
+from asynqp import spec
 import asyncio
-import urllib
-import io
-from fnmatch import fnmatch
-from urllib.parse import urlparse, parse_qs
+from functools import partial
+from collections import deque
+from .. import batch, metrics
+from ..headers import header
+from ..topic import TopicTrie, Broadcast
+from .core import Adapter, Controller
 
 LOG = logging.getLogger(__name__)
 
-
-def create(config):
-    return Controller(config)
-
-
-def _topic_translation(key, translation=str.maketrans('/', '.')):
-    return key.translate(translation)
-
-
-class Serialiser(object):
-    pass
-
-class TextEventStream(Serialiser):
-    @staticmethod
-    def content_type():
-        return 'text/event-stream'
-
-    @staticmethod
-    def serialise(message):
-        body_in = io.BytesIO(message.body)
-        out = bytearray()
-        for line in body_in:
-            out.extend(b'data: ')
-            out.extend(line)
-            out.extend(b"\n")
-        out.extend(b"\n")
-        return out
-
-class PlainTextStream(Serialiser):
-    @staticmethod
-    def content_type():
-        return 'text/plain'
-
-    @staticmethod
-    def serialise(message):
-        return b''.join([message.body, b"\n"])
-
-
-def create_serialiser(accept_string):
-    media_ranges = { media_range: { key: value for key, value in map(lambda x: x.split('=', 1), param_list) } for media_range, *param_list in map(lambda x: map(lambda y: y.strip(), x.split(';')), accept_string.decode('ascii').split(',')) }
-
-    for media_range, _ in sorted(media_ranges.items(), key=lambda x: float(x[1].get('q', 1.0)), reverse=True):
-        # if fnmatch(TextEventStream.content_type(), media_range):
-        return TextEventStream
-        #elif fnmatch(PlainTextStream.content_type(), media_range):
-        #    return PlainTextStream
+# The exchange types whose routing the controller can match the messages of the queue against
+EXCHANGE_TYPES = ('topic', 'direct', 'fanout')
 
 
+def create(config):
+    return Controller(config, AMQP)
 
-class Controller(object):
-    def __init__(self, config):
-        self._config = config
-        self._sessions = {}
 
-    @property
-    def config(self):
-        return self._config
+class AMQP(Adapter):
+    # One connection, with a single queue bound once for every distinct pattern, which also carries the publishes
+    PUBLISH_KEY = 'routing_key'
+    ACKNOWLEDGED = True
 
-    def session(self, request):
-        try:
-            return self._sessions[request.session_id]
-        except KeyError:
-            session = Session(self.config, request)
-            self._sessions[request.session_id] = session
-            return session
-
-    def post(self, request, start_response):
-        return self.session(request).publish(request, start_response)
-
-    def get(self, request, start_response):
-        accept = next(i for i in request.headers if i[0] == b'accept')
-        accept = accept[1] if not accept is None else b'text/event-stream'
-        serialiser = create_serialiser(accept)
-
-        start_response(200, [('content-type', serialiser.content_type()), ('cache-control', 'no-cache')])
-        return self.session(request).subscribe(request, serialiser)
-
-class Session(object):
-    def __init__(self, config, request):
-        self._config = config
+    def __init__(self, config, controller):
+        super().__init__(config, controller)
+        self.exchange_type = config.get('exchange_type', 'topic')
+        if self.exchange_type not in EXCHANGE_TYPES:
+            raise ValueError("Unsupported exchange_type '{}', use one of {}".format(self.exchange_type, ', '.join(EXCHANGE_TYPES)))
+        self._bindings = {}
+        self._queue = None
         self._connection = None
         self._channel = None
         self._exchange = None
-        self.setup_done = asyncio.async(self.setup())
+        self._sender = None
+        # The delivery tags not acknowledged cumulatively yet, in order, those of them done but not acknowledged,
+        # and those acknowledged one by one
+        self._outstanding = deque()
+        self._done = set()
+        self._acked = set()
+        self.prefetch = int(config.get('prefetch', 256))
+        self.ack_batch = max(1, self.prefetch // 2) if self.prefetch else 128
+        buffer_messages = controller.buffering.messages
+        if controller.buffering.policy == 'pause' and 0 < self.prefetch < buffer_messages:
+            LOG.warning("prefetch %d of %s is below buffer_messages %d: a single stream holding messages stops the broker "
+                        "delivering to all of them", self.prefetch, config.get('name', ''), buffer_messages)
+        self.acks = metrics.counter('h2a_amqp_acks_total', 'Acknowledgements sent to the broker', backend=config.get('name', ''))
+        self.reconnects = metrics.counter('h2a_broker_reconnects_total', 'Connections to the broker lost and reconnecting', backend=config.get('name', ''))
+        # Set while connected, with the exchange declared
+        self._ready = asyncio.Event()
+        # How long a publish waits for the connection while connecting, after that it fails
+        self.wait = float(config.get('reconnect_wait', 5.0))
+        # Counts the connection attempts, so only losing the current connection causes a reconnect
+        self._attempt = 0
+        self._setup = None
+
+    @property
+    def setup_done(self):
+        if self._setup is None:
+            self._setup = asyncio.async(self._connect())
+        return self._setup
+
+    @asyncio.coroutine
+    def _connect(self):
+        # Retried until connected, from the first use on, and again whenever the connection got lost
+        delay = 0.1
+        while True:
+            try:
+                yield from self.setup()
+                break
+            except (OSError, asynqp.AMQPError) as e:
+                LOG.warning("Could not connect to %s: %s", self.config['host'], e)
+                yield from self._close()
+            yield from asyncio.sleep(delay)
+            delay = min(delay * 2, 10.0)
+        self._ready.set()
 
     @asyncio.coroutine
     def setup(self):
-        LOG.debug("Connecting to %s", self._config)
-        self._connection = yield from asynqp.connect(host=self._config['host'],
-                                                     username=self._config['username'],
-                                                     password=self._config['password'],
-                                                     virtual_host=self._config['virtual_host'])
+        LOG.debug("Connecting to %s", self.config)
+        self._attempt += 1
+        self._connection = None
+        self._connection = yield from asynqp.connect(host=self.config['host'],
+                                                     port=int(self.config.get('port', 5672)),
+                                                     username=self.config['username'],
+                                                     password=self.config['password'],
+                                                     virtual_host=self.config['virtual_host'],
+                                                     on_connection_close=partial(self._connection_closed, self._attempt))
         self._channel = yield from self._connection.open_channel()
-        exchange_type = self._config.get('exchange_type', 'topic')
-        self._exchange = yield from self._channel.declare_exchange(self._config.get('exchange_name', "amq.{}".format(exchange_type)),
+        exchange_type = self.exchange_type
+        self._exchange = yield from self._channel.declare_exchange(self.config.get('exchange_name', "amq.{}".format(exchange_type)),
                                                                    exchange_type, durable=False, auto_delete=False)
 
-    @property
-    def config(self):
-        return self._config
-
-    @property
-    def connection(self):
-        return self._connection
+    @asyncio.coroutine
+    def _close(self):
+        # A connection set up only partly
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            try:
+                yield from connection.close()
+            except (OSError, asynqp.AMQPError) as e:
+                LOG.debug("Could not close connection to %s: %s", self.config['host'], e)
 
-    @property
-    def channel(self):
-        return self._channel
+    @asyncio.coroutine
+    def _connection_closed(self, attempt, exc):
+        # Connects again, with a new queue bound to all patterns. The delivery tags start over on the new channel,
+        # so the messages of the lost one are never acknowledged.
+        if attempt != self._attempt or not self._ready.is_set():
+            return
+        LOG.warning("Lost connection to %s: %s", self.config['host'], exc)
+        self.reconnects.inc()
+        self._ready.clear()
+        self._setup = None
+        self._queue = None
+        self._sender = None
+        self._outstanding.clear()
+        self._done.clear()
+        self._acked.clear()
+        yield from self.setup_done
+        for pattern in list(self._bindings):
+            self._bindings[pattern] = asyncio.async(self._bind(pattern))
+
+    def trie(self):
+        # The queue gets the messages of all bindings, matched to the patterns as the exchange routed them
+        if self.exchange_type == 'direct':
+            return TopicTrie('.', None, None)
+        elif self.exchange_type == 'fanout':
+            return Broadcast()
+        return TopicTrie('.', '*', '#')
 
     @property
-    def exchange(self):
-        return self._exchange
-
-    def subscribe(self, request, serialiser):
-        return Subscription(self, request, serialiser)
-
-    def publish(self, request, start_response):
-        return Sender(self, request, start_response)
-
-class Subscription(object):
-    def __init__(self, session, request, serialiser):
-        self.session = session
-        self.request = request
-        self.serialiser = serialiser
-        self.request.eof = False
-        self.buf = deque()
-        self.queue = None
-        self.binding = None
-        self.consumer = None
-        asyncio.async(self.setup())
-
-    def __call__(self, n):
-        items = len(self.buf)
-        message = self.buf.popleft() if items > 0 else None
-
-        if not message and not self.request.eof:
-            return None, nghttp2.DATA_DEFERRED
-        else:
-            if items > 1:
-                self.request.resume()
-            data = self.serialiser.serialise(message)
-            message.ack()
-            return data, nghttp2.DATA_EOF if self.request.eof else nghttp2.DATA_OK
+    def queue(self):
+        if self._queue is None:
+            self._queue = asyncio.async(self._declare_queue())
+        return self._queue
 
     @asyncio.coroutine
-    def setup(self):
-        yield from self.session.setup_done
-        self.queue = yield from self.session.channel.declare_queue(str(self.request.session_id), durable=False, auto_delete=False, arguments={'x-expires': 5*60*1000})
-        subscription = _topic_translation(self.session.config.get('subscription', urllib.parse.unquote(self.request.match.get('subscription', '#'))))
-
-        LOG.debug('Subscribing to %s', subscription)
-        self.binding = yield from self.queue.bind(self.session.exchange, subscription)
-        self.consumer = yield from self.queue.consume(self.consume)
+    def _declare_queue(self):
+        try:
+            return (yield from self._consume_queue())
+        except (OSError, asynqp.AMQPError):
+            # Declared again by the next binding
+            self._queue = None
+            raise
 
-    def consume(self, message):
-        self.buf.append(message)
-        self.request.resume()
+    @asyncio.coroutine
+    def _consume_queue(self):
+        yield from self.setup_done
+        # prefetch limits the unacknowledged messages of the consumer, channel_prefetch those of the whole channel
+        channel_prefetch = int(self.config.get('channel_prefetch', 0))
+        yield from self._channel.set_qos(prefetch_count=self.prefetch)
+        if channel_prefetch > 0:
+            yield from self._channel.set_qos(prefetch_count=channel_prefetch, apply_globally=True)
+        queue = yield from self._channel.declare_queue(self.config.get('queue_name', ''), durable=False, exclusive=True, auto_delete=True)
+        yield from queue.consume(self._consume)
+        return queue
+
+    def _consume(self, message):
+        # Acknowledged once the message is sent to or dropped by all subscriptions it was fanned out to
+        timestamp = message.timestamp.timestamp() if getattr(message, 'timestamp', None) else None
+        self._outstanding.append(message.delivery_tag)
+        self._sender = message.sender
+        self.controller.dispatch(self.controller.frame(message.routing_key, message.body, message, timestamp))
+
+    def ack_many(self, frames):
+        # A single basic.ack with multiple set covers all messages up to the last one, before which every message is done.
+        # Those done after one still held by a stream are acknowledged one by one, so it does not hold back the others.
+        outstanding = self._outstanding
+        done = self._done
+        acked = self._acked
+        for frame in frames:
+            if frame.message.sender is not self._sender:
+                # Delivered on a channel lost since
+                continue
+            tag = frame.message.delivery_tag
+            # Not those acknowledged already, a second basic.ack for them would close the channel
+            if outstanding and tag >= outstanding[0] and tag not in acked:
+                done.add(tag)
+        last = None
+        while outstanding and (outstanding[0] in done or outstanding[0] in acked):
+            tag = outstanding.popleft()
+            if tag in done:
+                done.discard(tag)
+                last = tag
+            else:
+                acked.discard(tag)
+        if last is not None:
+            self.acks.inc()
+            self._sender.send_method(spec.BasicAck(last, True))
+        for tag in sorted(done):
+            self.acks.inc()
+            self._sender.send_method(spec.BasicAck(tag, False))
+        acked.update(done)
+        done.clear()
+
+    def pause(self):
+        # Buffered messages are not acknowledged, so the broker stops delivering once the prefetch window is full
+        # (see Controller.frame)
+        LOG.debug('Pausing consumer')
+
+    def resume(self):
+        LOG.debug('Resuming consumer')
+
+    def subscribe(self, pattern, sink):
+        self._bindings[pattern] = asyncio.async(self._bind(pattern))
+
+    def unsubscribe(self, pattern):
+        asyncio.async(self._unbind(self._bindings.pop(pattern)))
 
     @asyncio.coroutine
-    def close(self):
-        if not self.binding is None:
-            yield from self.binding.unbind()
-        if not self.consumer is None:
-            yield from self.consumer.cancel()
-        if not self.queue is None:
-            yield from self.queue.delete(if_unused=False, if_empty=False)
-
-    def on_request_done(self):
-        pass
-
-
-class Sender(object):
-    def __init__(self, session, request, start_response):
-        self.start_response = start_response
-        self.session = session
-        self.request = request
-        self.response = None
-        self.data = io.BytesIO()
-
-    def __call__(self, n):
-        if self.response is None:
-            return None, nghttp2.DATA_DEFERRED
-        else:
-            return self.response, nghttp2.DATA_EOF
+    def _bind(self, pattern):
+        queue = yield from self.queue
+        return (yield from queue.bind(self._exchange, pattern))
 
     @asyncio.coroutine
-    def publish(self):
-        yield from self.session.setup_done
-        params = parse_qs(urlparse(self.request.path).query)
-        data = self.data.getvalue()
-        try:
-            content_type = next(i for i in self.request.headers if i[0] == b'content-type')
-            if content_type:
-                content_type = content_type[1]
-            else:
-                content_type = 'text/plain'
-            message = asynqp.Message(data, content_type=content_type)
-            key = self.session.config.get('routing_key', params.get(b'k', ['default'])[0])
-            self.session.exchange.publish(message, key, mandatory=False)
-            self.start_response(200, [('content-type', 'application/json'), ('cache-control', 'no-cache')])
-            self.response = b'{}'
-            self.request.resume()
-        except KeyError as e:
-            self.start_response(500, [('content-type', 'application/json'), ('cache-control', 'no-cache')])
-            self.response = "{'e': {} }".format(e)
-            self.request.resume()
-
-    def on_data(self, data):
-        self.data.write(data)
-
-    def on_request_done(self):
-        asyncio.async(self.publish())
+    def _unbind(self, binding):
+        binding = yield from binding
+        yield from binding.unbind()
 
+    @asyncio.coroutine
+    def publish_many(self, records, request):
+        # basic.publish is asynchronous, so the whole batch goes out back to back on the channel. A single message
+        # keeps the content type of the request.
+        setup = self.setup_done
+        if not self._ready.is_set():
+            try:
+                yield from asyncio.wait_for(asyncio.shield(setup), self.wait)
+            except asyncio.TimeoutError:
+                raise ConnectionError('Not connected to {}'.format(self.config['host']))
+        content_type = header(request, b'content-type', b'text/plain')
+        if batch.parser(content_type) is not None:
+            content_type = b'application/octet-stream'
+        content_type = content_type.decode('ascii')
+        errors = []
+        for key, payload in records:
+            try:
+                self._exchange.publish(asynqp.Message(payload, content_type=content_type), key, mandatory=False)
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
@@ -0,0 +1,216 @@
+import logging
+import urllib.parse
+import asyncio
+from abc import ABCMeta, abstractmethod
+from functools import partial
+from .. import metrics, relay
+from ..topic import TopicTrie, Fanout
+from ..headers import header
+from ..publish import Sender
+from ..stream import Frame, Stream, Buffering, FlowControl
+from ..negotiation import negotiate
+from ..replay import Replay
+
+LOG = logging.getLogger(__name__)
+
+
+def query(request):
+    # The parameters of the request, each a list of values
+    return urllib.parse.parse_qs(urllib.parse.urlparse(request.path.decode('utf-8')).query)
+
+
+class Adapter(metaclass=ABCMeta):
+    # What a broker module provides to the Controller, which does everything else: HTTP, streams,
+    # buffering, fan-out, replay and relaying. Patterns and publish keys arrive translated already.
+    #
+    # Messages are handed to the controller as frames made with controller.frame(). Brokers sending a message once
+    # per matching subscription hand it to the sink given to subscribe, those sending it once per connection
+    # to controller.dispatch().
+
+    # Applied to subscription patterns and publish keys, from the '/' separated paths of the URLs
+    TRANSLATION = str.maketrans('/', '.')
+    # The configuration option overriding the key of every publish
+    PUBLISH_KEY = 'publish_topic'
+    # Whether the broker can stop sending while a stream is full, see stream.Buffering
+    PAUSABLE = True
+    # Whether frames have to be acknowledged through ack_many: once fanned out, or with the pause overflow policy,
+    # once no stream holds them anymore
+    ACKNOWLEDGED = False
+    # Whether the subscriptions may be held by another worker, see relay.py
+    RELAYED = True
+
+    def __init__(self, config, controller):
+        self.config = config
+        self.controller = controller
+        # The default of ack_batch, the frames acknowledged at once
+        self.ack_batch = 128
+
+    def trie(self):
+        # Matches topics against patterns the way the broker does
+        return TopicTrie('.', '*', '#')
+
+    @abstractmethod
+    def subscribe(self, pattern, sink):
+        pass
+
+    @abstractmethod
+    def unsubscribe(self, pattern):
+        pass
+
+    @asyncio.coroutine
+    def publish(self, key, payload, request):
+        # Brokers publishing single messages more cheaply than a batch of one override this
+        error, = yield from self.publish_many([(key, payload)], request)
+        if error is not None:
+            raise error
+
+    @abstractmethod
+    @asyncio.coroutine
+    def publish_many(self, records, request):
+        # records are (key, payload) tuples, returns the error, or None, for each of them
+        pass
+
+    def ack_many(self, frames):
+        pass
+
+    def pause(self):
+        pass
+
+    def resume(self):
+        pass
+
+
+class Acknowledgements(object):
+    # Collects the frames no stream holds anymore, and passes them on to ack_many after interval seconds,
+    # or right away once batch of them are waiting
+    def __init__(self, ack_many, interval, batch):
+        self._ack_many = ack_many
+        self.interval = interval
+        self.batch = batch
+        self._frames = []
+        self._timer = None
+        self._loop = asyncio.get_event_loop()
+
+    def done(self, frame):
+        self._frames.append(frame)
+        if len(self._frames) >= self.batch:
+            self._cancel()
+            self._loop.call_soon(self.flush)
+        elif self._timer is None:
+            self._timer = self._loop.call_later(self.interval, self.flush)
+
+    def _cancel(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def flush(self):
+        self._cancel()
+        if self._frames:
+            frames, self._frames = self._frames, []
+            self._ack_many(frames)
+
+
+class Controller(object):
+    def __init__(self, config, adapter):
+        self._config = config
+        name = config.get('name', '')
+        self.buffering = Buffering(config, adapter.PAUSABLE)
+        self.adapter = adapter(config, self)
+        self._fanout = Fanout(self.adapter.trie())
+        self._acks = None
+        if self.adapter.ACKNOWLEDGED:
+            self._acks = Acknowledgements(self.adapter.ack_many, float(config.get('ack_interval', 0.05)), int(config.get('ack_batch', self.adapter.ack_batch)))
+        self.flow = FlowControl(self.adapter.pause, self.adapter.resume, name)
+        self.publish_seconds = metrics.histogram('h2a_publish_seconds', 'Time until the broker took a publishing request', backend=name)
+        self.published = metrics.counter('h2a_published_total', 'Messages published to the broker', backend=name)
+        self.replay = Replay(self.subscribe, self.unsubscribe, int(config.get('replay', 256)), float(config.get('linger', 5.0)), name,
+                             int(config.get('replay_bytes', 1024 * 1024)))
+
+    @property
+    def config(self):
+        return self._config
+
+    def translate(self, key):
+        return key.translate(self.adapter.TRANSLATION)
+
+    def frame(self, topic, payload, message=None, timestamp=None):
+        # Only while the streams pause the broker, a message is acknowledged as late as the last stream sent it.
+        # Otherwise a stream holding messages would hold back the broker from all streams, instead of losing them.
+        done = self._acks.done if self._acks is not None and self.buffering.policy == 'pause' else None
+        return Frame(topic, payload, message, done, timestamp)
+
+    def dispatch(self, frame):
+        # To every stream once, however many of its patterns match. Returns the number of them. With relaying,
+        # only to the patterns this worker owns: their owners relay the others.
+        sinks = self._fanout.publish(frame.topic, frame)
+        self._dispatched(frame)
+        return sinks
+
+    def _deliver(self, pattern, frame):
+        self._fanout.deliver(pattern, frame)
+        self._dispatched(frame)
+
+    def _dispatched(self, frame):
+        if frame.done is None:
+            if self._acks is not None:
+                self._acks.done(frame)
+        elif not frame.retained:
+            # Not kept by any stream, so done right away
+            frame.finish()
+
+    def _relayed(self, pattern):
+        return self.adapter.RELAYED and relay.subscribe(self.config.get('name', ''), pattern, self._fanout.deliver)
+
+    def _unrelayed(self, pattern):
+        return self.adapter.RELAYED and relay.unsubscribe(self.config.get('name', ''), pattern)
+
+    def patterns(self, topic):
+        # Those subscribed at the broker by this worker and matching topic
+        return self._fanout.match(topic)
+
+    def subscribe(self, pattern, sink):
+        if self._fanout.add(pattern, sink) and not self._relayed(pattern):
+            LOG.debug('Subscribing to %s', pattern)
+            self._fanout.own(pattern)
+            self.adapter.subscribe(pattern, partial(self._deliver, pattern))
+
+    def unsubscribe(self, pattern, sink):
+        if self._fanout.discard(pattern, sink) and not self._unrelayed(pattern):
+            LOG.debug('Unsubscribing from %s', pattern)
+            self._fanout.disown(pattern)
+            self.adapter.unsubscribe(pattern)
+
+    def topic(self, key):
+        # The broker key a publish to key goes to
+        return self.translate(self.config.get(self.adapter.PUBLISH_KEY, key))
+
+    def post(self, request, start_response):
+        # Publishes go through the adapter, so a client holds nothing of the broker between requests
+        return Sender(self, request, start_response)
+
+    def get(self, request, start_response):
+        serialiser = negotiate(header(request, b'accept'))
+        if serialiser is None:
+            start_response(406, [])
+            return None
+
+        start_response(200, [('content-type', serialiser.content_type()), ('cache-control', 'no-cache')])
+        return Subscription(self, request, serialiser)
+
+
+class Subscription(Stream):
+    def __init__(self, controller, request, serialiser):
+        super().__init__(request, serialiser, controller.buffering, controller.flow)
+        self.controller = controller
+        self.pattern = controller.translate(controller.config.get('subscription', urllib.parse.unquote(self.request.match.get('subscription', '#'))))
+        controller.replay.attach(self.pattern, self.consume, header(request, b'last-event-id'))
+        controller.subscribe(self.pattern, self.consume)
+
+    def close(self):
+        self.controller.unsubscribe(self.pattern, self.consume)
+        self.controller.replay.detach(self.pattern)
+        super().close()
+
+    def on_request_done(self):
+        pass
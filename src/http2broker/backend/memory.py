@@ -0,0 +1,44 @@
+import logging
+import asyncio
+from .. import metrics
+from .core import Adapter, Controller
+
+LOG = logging.getLogger(__name__)
+
+
+def create(config):
+    return Controller(config, Memory)
+
+class Memory(Adapter):
+    # A broker within the process: a publish is handed to the matching streams right away, as one frame sharing
+    # the body of the request. Only the streams of the same process get it, so with several workers, each of them
+    # is a broker of its own. The wildcards are those of amqp: '*' one word, '#' zero or more words.
+    RELAYED = False
+
+    def __init__(self, config, controller):
+        super().__init__(config, controller)
+        # With overflow = pause, cleared while a stream is full: publishes wait for it, instead of the broker holding back messages
+        self._accepting = asyncio.Event()
+        self._accepting.set()
+        self.delivered = metrics.counter('h2a_memory_delivered_total', 'Messages handed to streams by the in-process broker', backend=config.get('name', ''))
+
+    def pause(self):
+        self._accepting.clear()
+
+    def resume(self):
+        self._accepting.set()
+
+    def subscribe(self, pattern, sink):
+        pass
+
+    def unsubscribe(self, pattern):
+        pass
+
+    @asyncio.coroutine
+    def publish_many(self, records, request):
+        controller = self.controller
+        for key, payload in records:
+            if not self._accepting.is_set():
+                yield from self._accepting.wait()
+            self.delivered.inc(controller.dispatch(controller.frame(key, payload)))
+        return [None] * len(records)
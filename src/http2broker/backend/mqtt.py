@@ -1,205 +1,141 @@
-from collections import deque
 import logging
-import nghttp2
-import urllib
-from urllib.parse import urlparse, parse_qs
-import io
-import paho.mqtt.client as mqtt
-import paho.mqtt.publish as publish
 import asyncio
+from uuid import uuid4 as uuid
+from ..protocol.mqtt import Client, MQTT_3_1_1, MQTT_5
+from .. import metrics
+from ..topic import TopicTrie
+from .core import Adapter, Controller, query
 
 LOG = logging.getLogger(__name__)
 loop = asyncio.get_event_loop()
 
-def _topic_translation(key, translation=str.maketrans('/', '.')):
-    return key.translate(translation)
-
 
 def create(config):
-    return Controller(config)
-
-class Serialiser(object):
-    pass
-
-class TextEventStream(Serialiser):
-    @staticmethod
-    def content_type():
-        return 'text/event-stream'
-
-    @staticmethod
-    def serialise(message):
-        body_in = io.BytesIO(message.payload)
-        out = bytearray()
-        for line in body_in:
-            out.extend(b'data: ')
-            out.extend(line)
-            out.extend(b"\n")
-        out.extend(b"\n")
-        return out
-
-class PlainTextStream(Serialiser):
-    @staticmethod
-    def content_type():
-        return 'text/plain'
-
-    @staticmethod
-    def serialise(message):
-        return b''.join([message.payload, b"\n"])
-
-
-def create_serialiser(accept_string):
-    media_ranges = { media_range: { key: value for key, value in map(lambda x: x.split('=', 1), param_list) } for media_range, *param_list in map(lambda x: map(lambda y: y.strip(), x.split(';')), accept_string.decode('ascii').split(',')) }
-
-    for media_range, _ in sorted(media_ranges.items(), key=lambda x: float(x[1].get('q', 1.0)), reverse=True):
-        # if fnmatch(TextEventStream.content_type(), media_range):
-        return TextEventStream
-        #elif fnmatch(PlainTextStream.content_type(), media_range):
-        #    return PlainTextStream
+    return Controller(config, MQTT)
+
+class MQTT(Adapter):
+    def __init__(self, config, controller):
+        super().__init__(config, controller)
+        self._clients = None
+        self._next = 0
+        self.version = MQTT_5 if config.get('protocol_version', '3.1.1') in ('5', '5.0') else MQTT_3_1_1
+        # With MQTT 5, every pattern gets a subscription identifier, and the messages go to the sinks of those they carry
+        self._identifiers = {}
+        self._sinks = {}
+        self._next_identifier = 0
+        # With MQTT 3.1.1 and copies on, the copies of the last message still expected: [count, topic, payload]
+        self._copies = None
+        self.copies = config.get('copies', 'false').lower() in ('1', 'true', 'yes', 'on')
+        self.qos = int(config.get('qos', 0))
+        self.ack_latency = { qos: metrics.histogram('h2a_publish_ack_seconds', 'Time until the broker acknowledged a publish',
+                                                    backend=config.get('name', ''), qos=qos)
+                             for qos in (1, 2) }
+        self.reconnects = metrics.counter('h2a_broker_reconnects_total', 'Connections to the broker lost and reconnecting', backend=config.get('name', ''))
+
+    def trie(self):
+        return TopicTrie('.', '+', '#')
 
-
-
-class Controller(object):
-    def __init__(self, config):
-        self._config = config
-        self._sessions = {}
+    @property
+    def clients(self):
+        # All clients are multiplexed over a few connections, the first one also carries all subscriptions
+        if self._clients is None:
+            config = self.config
+            prefix = config.get('client_id', 'h2a-{}'.format(uuid()))
+            self._clients = []
+            for i in range(max(1, int(config.get('connections', 1)))):
+                client = Client(config['host'], int(config.get('port', 1883)), '{}-{}'.format(prefix, i),
+                                username=config.get('username', None), password=config.get('password', None),
+                                keepalive=int(config.get('keepalive', 5)), version=self.version, inflight=int(config.get('inflight', 64)))
+                client.on_connection_lost = lambda exc: self.reconnects.inc()
+                client.start()
+                self._clients.append(client)
+            self._clients[0].on_message = self.dispatch
+        return self._clients
 
     @property
-    def config(self):
-        return self._config
-
-    def session(self, request):
-        try:
-            return self._sessions[request.session_id]
-        except KeyError:
-            session = Session(self.config, request)
-            self._sessions[request.session_id] = session
-            return session
-
-    def post(self, request, start_response):
-        return self.session(request).publish(request, start_response)
-
-    def get(self, request, start_response):
-        accept = next(i for i in request.headers if i[0] == b'accept')
-        accept = accept[1] if not accept is None else b'text/event-stream'
-        serialiser = create_serialiser(accept)
-
-        start_response(200, [('content-type', serialiser.content_type()), ('cache-control', 'no-cache')])
-        return self.session(request).subscribe(request, serialiser)
-
-
-class Session(object):
-    def __init__(self, config, request):
-        self._config = config
-        self._client = mqtt.Client(request.session_id, clean_session=False)
-        self._client.on_connect = self._mqtt_on_connect
-        self._client.on_log = self._mqtt_log
-        self._client.username_pw_set(config.get('username', None), config.get('password', None))
-        self._client.connect(config['host'], int(config.get('port', 1883)), int(config.get('keepalive', 5)))
-        self._client.on_message = self._mqtt_message
-        self._subscriptions = []
-        self._stop = False
-        asyncio.async(self.setup())
+    def upstream(self):
+        return self.clients[0]
+
+    def publisher(self):
+        # The connected client with the fewest unacknowledged publishes, round robin among equals
+        clients = self.clients
+        self._next = (self._next + 1) % len(clients)
+        ordered = clients[self._next:] + clients[:self._next]
+        return min(ordered, key=lambda client: (not client.connected, client.pending))
+
+    def pause(self):
+        self.upstream.pause_reading()
+
+    def resume(self):
+        self.upstream.resume_reading()
+
+    def dispatch(self, message):
+        controller = self.controller
+        frame = controller.frame(message.topic, message.payload, message)
+        if message.subscriptions:
+            for identifier in message.subscriptions:
+                sink = self._sinks.get(identifier, None)
+                if sink is not None:
+                    sink(frame)
+            return
+
+        # Without subscription identifiers, every copy the broker sends goes to all matching streams. With copies on,
+        # for brokers like mosquitto sending a copy per matching subscription back to back, as many as there are
+        # matching patterns beyond the first one are dropped, unless another message comes first. That guesses wrong
+        # while the subscriptions change, so it is not done then. Retained messages are sent for the new
+        # subscription only.
+        copies = self._copies
+        if copies is not None and copies[1] == message.topic and copies[2] == message.payload:
+            copies[0] -= 1
+            if copies[0] <= 0:
+                self._copies = None
+            return
+        self._copies = None
+        if self.copies and not message.retain and not self.upstream.subscribing:
+            count = len(controller.patterns(message.topic)) - 1
+            if count > 0:
+                self._copies = [count, message.topic, message.payload]
+        controller.dispatch(frame)
+
+    def subscribe(self, pattern, sink):
+        identifier = None
+        if self.version >= MQTT_5:
+            identifier = self._identifier()
+            self._identifiers[pattern] = identifier
+            self._sinks[identifier] = sink
+        self.upstream.subscribe(pattern, identifier=identifier)
+
+    def unsubscribe(self, pattern):
+        self._sinks.pop(self._identifiers.pop(pattern, None), None)
+        self.upstream.unsubscribe(pattern)
+
+    def _identifier(self):
+        while True:
+            self._next_identifier = self._next_identifier % 268435455 + 1
+            if self._next_identifier not in self._sinks:
+                return self._next_identifier
+
+    def request_qos(self, request):
+        # With QoS 1 or 2, from the backend setting or the qos parameter, the response waits for the broker's acknowledgement
+        qos = int(query(request).get('qos', [self.qos])[0])
+        if qos not in (0, 1, 2):
+            raise ValueError('Invalid QoS {}'.format(qos))
+        return qos
 
     @asyncio.coroutine
-    def setup(self):
-        LOG.debug("Connecting to %s", self._config)
-        loop = asyncio.get_event_loop()
-        loop.add_reader(self._client.socket(), self._client.loop_read)
-        loop.add_writer(self._client.socket(), self._client.loop_write)
-        while not self._stop:
-            self._client.loop_misc()
-            yield from asyncio.sleep(1.0, loop=loop)
-
-    @property
-    def config(self):
-        return self._config
+    def _publish(self, key, payload, qos):
+        started = loop.time()
+        yield from self.publisher().publish(key, payload, qos)
+        if qos:
+            self.ack_latency[qos].observe(loop.time() - started)
 
-    @property
-    def client(self):
-        return self._client
-
-    def subscribe(self, request, serialiser):
-        subscription = Subscription(self, request, serialiser)
-        self._subscriptions.append(subscription)
-        subscription.subscribe()
-        return subscription
-
-    def publish(self, request, start_response):
-        return Sender(self, request, start_response)
-
-    def _mqtt_on_connect(self, client, userdata, flags_dict, result):
-        for subscription in self._subscriptions:
-            subscription.subscribe()
-
-    def _mqtt_message(self, client, userdata, msg):
-        LOG.debug(msg)
-
-    def _mqtt_log(self, client, userdata, level, string):
-        LOG.debug(string)
-
-class Subscription(object):
-    def __init__(self, session, request, serialiser):
-        self.session = session
-        self.request = request
-        self.serialiser = serialiser
-        self.request.eof = False
-        self.buf = deque()
-
-    def __call__(self, n):
-        items = len(self.buf)
-        message = self.buf.popleft() if items > 0 else None
-
-        if not message and not self.request.eof:
-            return None, nghttp2.DATA_DEFERRED
-        else:
-            if items > 1:
-                self.request.resume()
-            data = self.serialiser.serialise(message)
-            return data, nghttp2.DATA_EOF if self.request.eof else nghttp2.DATA_OK
-
-    def subscribe(self):
-        subscription = _topic_translation(self.session.config.get('subscription', urllib.parse.unquote(self.request.match.get('subscription', '#'))))
-        self.session.client.subscribe(subscription)
-        loop = asyncio.get_event_loop()
-        loop.call_soon(self.session.client.message_callback_add, subscription, self.consume)
-
-    def consume(self, client, userdata, message):
-        self.buf.append(message)
-        self.request.resume()
-
-    def on_request_done(self):
-        pass
-
-class Sender(object):
-    def __init__(self, session, request, start_response):
-        self.start_response = start_response
-        self.session = session
-        self.request = request
-        self.data = io.BytesIO()
-        self.response = None
-
-    def __call__(self, n):
-        if self.response is None:
-            return None, nghttp2.DATA_DEFERRED
-        else:
-            return self.response, nghttp2.DATA_EOF
-
-    def on_data(self, data):
-        self.data.write(data)
-
-    def on_request_done(self):
-        params = parse_qs(urlparse(self.request.path).query)
-        self.data.seek(0)
-        with io.TextIOWrapper(self.data, write_through=True) as ios:
-            payload = ios.read()
-        try:
-            key = self.session.config.get('publish_topic', params.get(b'k', ['default'])[0])
-            self.session.client.publish(key, payload)
-            self.start_response(200, [('content-type', 'application/json'), ('cache-control', 'no-cache')])
-            self.response = b'{}'
-            self.request.resume()
-        except KeyError as e:
-            self.start_response(500, [('content-type', 'application/json'), ('cache-control', 'no-cache')])
-            self.response = "{'e': {} }".format(e)
-            self.request.resume()
+    @asyncio.coroutine
+    def publish(self, key, payload, request):
+        yield from self._publish(key, payload, self.request_qos(request))
 
+    @asyncio.coroutine
+    def publish_many(self, records, request):
+        # All records of a batch go out at once, the in-flight windows of the clients bound the outstanding ones
+        qos = self.request_qos(request)
+        results = yield from asyncio.gather(*[self._publish(key, payload, qos) for key, payload in records], return_exceptions=True)
+        return [result if isinstance(result, Exception) else None for result in results]
@@ -1,200 +1,235 @@
-from collections import deque
 import logging
-import nghttp2
-import urllib
-from urllib.parse import urlparse, parse_qs
-import io
 import asyncio
 import asyncio_redis
+from asyncio_redis.encoders import BytesEncoder
+from .. import metrics
+from ..topic import TopicTrie
+from .core import Adapter, Controller
 
 LOG = logging.getLogger(__name__)
 
-loop = asyncio.get_event_loop()
-
-
-def _topic_translation(key, translation=str.maketrans('/#', ':*')):
-    return key.translate(translation)
-
-
 
 def create(config):
-    return Controller(config)
-
-class Serialiser(object):
-    pass
-
-class TextEventStream(Serialiser):
-    @staticmethod
-    def content_type():
-        return 'text/event-stream'
-
-    @staticmethod
-    def serialise(message):
-        body_in = io.StringIO(message.value)
-        bytes_out = io.BytesIO()
-        body_out = io.TextIOWrapper(bytes_out, write_through=True)
-        for line in body_in:
-            body_out.write('data: ')
-            body_out.write(line)
-            body_out.write("\n")
-        body_out.write("\n")
-        return bytes_out.getvalue()
-
-class PlainTextStream(Serialiser):
-    @staticmethod
-    def content_type():
-        return 'text/plain'
+    return Controller(config, Redis)
 
-    @staticmethod
-    def serialise(message):
-        return ''.join([message.value, "\n"])
 
+class Protocol(asyncio_redis.RedisProtocol):
+    # Tells the owner of the connection whenever it got connected or lost
+    on_connection_made = None
+    on_connection_lost = None
 
-def create_serialiser(accept_string):
-    media_ranges = { media_range: { key: value for key, value in map(lambda x: x.split('=', 1), param_list) } for media_range, *param_list in map(lambda x: map(lambda y: y.strip(), x.split(';')), accept_string.decode('ascii').split(',')) }
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if self.on_connection_made is not None:
+            self.on_connection_made()
 
-    for media_range, _ in sorted(media_ranges.items(), key=lambda x: float(x[1].get('q', 1.0)), reverse=True):
-        # if fnmatch(TextEventStream.content_type(), media_range):
-        return TextEventStream
-        #elif fnmatch(PlainTextStream.content_type(), media_range):
-        #    return PlainTextStream
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self.on_connection_lost is not None:
+            self.on_connection_lost(exc)
 
 
-
-class Controller(object):
-    def __init__(self, config):
+class PublishPool(object):
+    # A fixed number of publishing connections shared by all senders. asyncio_redis pipelines
+    # the commands issued while others are still pending, so the least loaded connection is picked, not a free one.
+    def __init__(self, config, size):
         self._config = config
-        self._sessions = {}
+        self._connections = [None] * size
+        self._pending = [0] * size
+        # Set while any of the connections is connected
+        self._ready = asyncio.Event()
+        # How long a publish waits for a connection while all of them are reconnecting
+        self.wait = float(config.get('reconnect_wait', 5.0))
+        for i in range(size):
+            asyncio.async(self._connect(i))
 
-    @property
-    def config(self):
-        return self._config
+    @asyncio.coroutine
+    def _connect(self, i):
+        # Connections reconnect on their own once established (auto_reconnect), this only retries the first attempt
+        delay = 0.1
+        while self._connections[i] is None:
+            try:
+                connection = yield from asyncio_redis.Connection.create(host=self._config['host'], port=int(self._config.get('port', 6379)),
+                                                                        encoder=BytesEncoder(), auto_reconnect=True, protocol_class=Protocol)
+            except OSError as e:
+                LOG.warning("Could not connect to %s: %s", self._config['host'], e)
+                yield from asyncio.sleep(delay)
+                delay = min(delay * 2, 10.0)
+                continue
+            connection.protocol.on_connection_made = self._ready.set
+            connection.protocol.on_connection_lost = self._connection_lost
+            self._connections[i] = connection
+            self._ready.set()
+
+    def _connection_lost(self, exc):
+        if not any(connection is not None and connection.protocol.is_connected for connection in self._connections):
+            self._ready.clear()
+
+    def close(self):
+        for connection in self._connections:
+            if connection is not None:
+                connection.close()
 
-    def session(self, request):
-        try:
-            return self._sessions[request.session_id]
-        except KeyError:
-            session = Session(self.config)
-            self._sessions[request.session_id] = session
-            return session
+    @asyncio.coroutine
+    def _pick(self):
+        # A publish waits up to wait seconds for any connection to be connected, after that it fails
+        if not self._ready.is_set():
+            try:
+                yield from asyncio.wait_for(self._ready.wait(), self.wait)
+            except asyncio.TimeoutError:
+                pass
+        best = None
+        for i, connection in enumerate(self._connections):
+            if connection is None or not connection.protocol.is_connected:
+                continue
+            if best is None or self._pending[i] < self._pending[best]:
+                best = i
+        if best is None:
+            raise asyncio_redis.NotConnectedError('Not connected to {}'.format(self._config['host']))
+        return best
 
-    def post(self, request, start_response):
-        return self.session(request).publish(request, start_response)
+    @asyncio.coroutine
+    def publish(self, channel, payload):
+        i = yield from self._pick()
+        self._pending[i] += 1
+        try:
+            return (yield from self._connections[i].publish(channel, payload))
+        finally:
+            self._pending[i] -= 1
 
-    def get(self, request, start_response):
-        accept = next(i for i in request.headers if i[0] == b'accept')
-        accept = accept[1] if not accept is None else b'text/event-stream'
-        serialiser = create_serialiser(accept)
+    @asyncio.coroutine
+    def publish_many(self, items):
+        # A batch stays on one connection, so it goes out as one pipeline
+        i = yield from self._pick()
+        connection = self._connections[i]
+        self._pending[i] += len(items)
+        try:
+            return (yield from asyncio.gather(*[connection.publish(channel, payload) for channel, payload in items], return_exceptions=True))
+        finally:
+            self._pending[i] -= len(items)
 
-        start_response(200, [('content-type', serialiser.content_type()), ('cache-control', 'no-cache')])
-        return self.session(request).subscribe(request, serialiser)
 
+class Redis(Adapter):
+    TRANSLATION = str.maketrans('/#', ':*')
+    PUBLISH_KEY = 'publish_channel'
 
-class Session(object):
-    def __init__(self, config):
-        self._config = config
+    def __init__(self, config, controller):
+        super().__init__(config, controller)
         self._connection = None
-        self._subscriptions = []
-        self._stop = False
-        self.setup_done = asyncio.async(self.setup())
+        self._subscriber = None
+        self._dispatcher = None
+        self._paused = False
+        self._pool = None
+        self._sinks = {}
+        self.reconnects = metrics.counter('h2a_broker_reconnects_total', 'Connections to the broker lost and reconnecting', backend=config.get('name', ''))
 
-    @asyncio.coroutine
-    def setup(self):
-        self._connection = yield from asyncio_redis.Connection.create(host=self.config['host'], port=int(self.config.get('port', 6379)))
+    def trie(self):
+        return TopicTrie(':', None, '*')
 
     @property
-    def config(self):
-        return self._config
+    def pool(self):
+        if self._pool is None:
+            self._pool = PublishPool(self.config, int(self.config.get('publish_connections', 4)))
+        return self._pool
 
     @property
-    def connection(self):
-        return self._connection
-
-    def subscribe(self, request, serialiser):
-        subscription = Subscription(self, request, serialiser)
-        self._subscriptions.append(subscription)
-        return subscription
+    def subscriber(self):
+        if self._subscriber is None:
+            self._subscriber = asyncio.async(self._connect())
+        return self._subscriber
 
-    def publish(self, request, start_response):
-        return Sender(self, request, start_response)
-
-class Subscription(object):
-    def __init__(self, session, request, serialiser):
-        self.session = session
+    @asyncio.coroutine
+    def _connect(self):
+        # Retried until connected, and again whenever the connection got lost, subscribing to all patterns again
+        delay = 0.1
+        while True:
+            LOG.debug("Connecting to %s", self.config)
+            connection = None
+            try:
+                connection = yield from asyncio_redis.Connection.create(host=self.config['host'], port=int(self.config.get('port', 6379)),
+                                                                        encoder=BytesEncoder(), auto_reconnect=False, protocol_class=Protocol)
+                subscriber = yield from connection.start_subscribe()
+                channels = [pattern.encode('utf-8') for pattern in self._sinks if pattern.find('*') < 0]
+                patterns = [pattern.encode('utf-8') for pattern in self._sinks if pattern.find('*') >= 0]
+                if channels:
+                    yield from subscriber.subscribe(channels)
+                if patterns:
+                    yield from subscriber.psubscribe(patterns)
+                if connection.protocol.is_connected:
+                    break
+            except (OSError, asyncio_redis.Error) as e:
+                LOG.warning("Could not connect to %s: %s", self.config['host'], e)
+                if connection is not None:
+                    connection.close()
+            yield from asyncio.sleep(delay)
+            delay = min(delay * 2, 10.0)
+
+        connection.protocol.on_connection_lost = self._connection_lost
+        self._connection = connection
+        if self._paused:
+            connection.transport.pause_reading()
+        self._dispatcher = asyncio.async(self._dispatch(subscriber))
+        return subscriber
+
+    def _connection_lost(self, exc):
+        LOG.warning("Lost connection to %s: %s", self.config['host'], exc)
+        self.reconnects.inc()
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
         self._connection = None
-        self.request = request
-        self.serialiser = serialiser
-        self.request.eof = False
-        self.subscriber = None
-        self.buf = deque()
-        asyncio.async(self.setup())
-
-    def __call__(self, n):
-        items = len(self.buf)
-        message = self.buf.popleft() if items > 0 else None
-
-        if not message and not self.request.eof:
-            return None, nghttp2.DATA_DEFERRED
-        else:
-            if items > 1:
-                self.request.resume()
-            data = self.serialiser.serialise(message)
-            return data, nghttp2.DATA_EOF if self.request.eof else nghttp2.DATA_OK
+        self._subscriber = asyncio.async(self._connect())
 
     @asyncio.coroutine
-    def setup(self):
-        LOG.debug("Connecting to %s", self.session.config)
-        self._connection = yield from asyncio_redis.Connection.create(host=self.session.config['host'], port=int(self.session.config.get('port', 6379)))
-        self.subscriber = yield from self._connection.start_subscribe()
-        subscription = _topic_translation(self.session.config.get('subscription', urllib.parse.unquote(self.request.match.get('subscription', '#'))))
-
-        LOG.debug('Subscribing to %s', subscription)
-        if subscription.find('*') < 0:
-            yield from self.subscriber.subscribe([subscription])
-        else:
-            yield from self.subscriber.psubscribe([subscription])
+    def _dispatch(self, subscriber):
         while True:
-            reply = yield from self.subscriber.next_published()
-            self.buf.append(reply)
-            self.request.resume()
-
-    def on_request_done(self):
-        pass
-
-class Sender(object):
-    def __init__(self, session, request, start_response):
-        self.start_response = start_response
-        self.session = session
-        self.request = request
-        self.data = io.BytesIO()
-        self.response = None
-
-    def __call__(self, n):
-        if self.response is None:
-            return None, nghttp2.DATA_DEFERRED
+            reply = yield from subscriber.next_published()
+            channel = reply.channel.decode('utf-8')
+            pattern = reply.pattern.decode('utf-8') if reply.pattern else channel
+            sink = self._sinks.get(pattern, None)
+            if sink is not None:
+                sink(self.controller.frame(channel, reply.value, reply))
+
+    def pause(self):
+        # Leaves the messages in the socket, so redis has to buffer them (up to client-output-buffer-limit)
+        self._paused = True
+        if self._connection is not None and self._connection.transport is not None:
+            self._connection.transport.pause_reading()
+
+    def resume(self):
+        self._paused = False
+        if self._connection is not None and self._connection.transport is not None:
+            self._connection.transport.resume_reading()
+
+    def subscribe(self, pattern, sink):
+        self._sinks[pattern] = sink
+        asyncio.async(self._subscribe(pattern))
+
+    def unsubscribe(self, pattern):
+        self._sinks.pop(pattern, None)
+        asyncio.async(self._unsubscribe(pattern))
+
+    @asyncio.coroutine
+    def _subscribe(self, pattern):
+        subscriber = yield from self.subscriber
+        if pattern.find('*') < 0:
+            yield from subscriber.subscribe([pattern.encode('utf-8')])
         else:
-            return self.response, nghttp2.DATA_EOF
+            yield from subscriber.psubscribe([pattern.encode('utf-8')])
 
-    def on_data(self, data):
-        self.data.write(data)
+    @asyncio.coroutine
+    def _unsubscribe(self, pattern):
+        subscriber = yield from self.subscriber
+        if pattern.find('*') < 0:
+            yield from subscriber.unsubscribe([pattern.encode('utf-8')])
+        else:
+            yield from subscriber.punsubscribe([pattern.encode('utf-8')])
 
-    def on_request_done(self):
-        asyncio.async(self.publish())
+    @asyncio.coroutine
+    def publish(self, key, payload, request):
+        yield from self.pool.publish(key.encode('utf-8'), payload)
 
     @asyncio.coroutine
-    def publish(self):
-        yield from self.session.setup_done
-        params = parse_qs(urlparse(self.request.path).query)
-        self.data.seek(0)
-        with io.TextIOWrapper(self.data, write_through=True) as ios:
-            payload = ios.read()
-        try:
-            channel = _topic_translation(self.session.config.get('publish_channel', params.get(b'k', ['default'])[0]))
-            yield from self.session.connection.publish(channel, payload)
-            self.start_response(200, [('content-type', 'application/json'), ('cache-control', 'no-cache')])
-            self.response = b'{}'
-            self.request.resume()
-        except KeyError as e:
-            self.start_response(500, [('content-type', 'application/json'), ('cache-control', 'no-cache')])
-            self.response = "{'e': {} }".format(e)
-            self.request.resume()
+    def publish_many(self, records, request):
+        replies = yield from self.pool.publish_many([(key.encode('utf-8'), payload) for key, payload in records])
+        return [reply if isinstance(reply, Exception) else None for reply in replies]
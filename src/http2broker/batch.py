@@ -0,0 +1,92 @@
+from base64 import b64decode
+from collections import namedtuple
+import json
+import logging
+import struct
+
+LOG = logging.getLogger(__name__)
+
+# A batch body carries many messages, each one with its own routing key:
+#  application/x-ndjson       one JSON object per line: {"k": "<key>", "v": "<text>"} or {"k": "<key>", "b64": "<base64>"}
+#  application/x-h2a-batch    records of a big-endian u16 key length, the utf-8 key, a u32 payload length and the payload
+NDJSON = b'application/x-ndjson'
+LENGTH_PREFIXED = b'application/x-h2a-batch'
+
+Record = namedtuple('Record', ['key', 'payload', 'error'])
+
+_KEY_LENGTH = struct.Struct('!H')
+_PAYLOAD_LENGTH = struct.Struct('!I')
+
+
+def parse_ndjson(body):
+    records = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line.decode('utf-8'))
+            if 'b64' in item:
+                payload = b64decode(item['b64'])
+            else:
+                payload = item['v'].encode('utf-8')
+            records.append(Record(str(item['k']), payload, None))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            records.append(Record(None, None, e))
+    return records
+
+
+def parse_length_prefixed(body):
+    records = []
+    offset = 0
+    end = len(body)
+    while offset < end:
+        if offset + _KEY_LENGTH.size > end:
+            records.append(Record(None, None, ValueError('Truncated record at {}'.format(offset))))
+            break
+        length, = _KEY_LENGTH.unpack_from(body, offset)
+        offset += _KEY_LENGTH.size
+        key = body[offset:offset + length]
+        offset += length
+        if offset + _PAYLOAD_LENGTH.size > end:
+            records.append(Record(None, None, ValueError('Truncated record at {}'.format(offset))))
+            break
+        length, = _PAYLOAD_LENGTH.unpack_from(body, offset)
+        offset += _PAYLOAD_LENGTH.size
+        if offset + length > end:
+            records.append(Record(None, None, ValueError('Truncated record at {}'.format(offset))))
+            break
+        try:
+            records.append(Record(key.decode('utf-8'), body[offset:offset + length], None))
+        except UnicodeDecodeError as e:
+            records.append(Record(None, None, e))
+        offset += length
+    return records
+
+
+PARSERS = {
+    NDJSON: parse_ndjson,
+    LENGTH_PREFIXED: parse_length_prefixed,
+}
+
+
+def parser(content_type):
+    if content_type is None:
+        return None
+    return PARSERS.get(content_type.split(b';', 1)[0].strip().lower(), None)
+
+
+def results(records, errors):
+    # Merges the errors of the published records back with the ones which could not be parsed
+    errors = iter(errors)
+    out = []
+    for record in records:
+        error = record.error
+        if error is not None:
+            out.append({'k': record.key, 's': 400, 'e': str(error)})
+            continue
+        error = next(errors)
+        if error is None:
+            out.append({'k': record.key, 's': 200})
+        else:
+            out.append({'k': record.key, 's': 500, 'e': str(error)})
+    return out
@@ -5,6 +5,8 @@ from os import path
 LOG = logging.getLogger('http2broker')
 
 CONFIG = [None]
+# Bumped on every reload, so anything derived from the configuration or the templates knows when to redo it
+GENERATION = [0]
 
 class MyParser(ConfigParser):
   def as_dict(self):
@@ -24,3 +26,12 @@ def get_config():
         CONFIG[0] = parser.as_dict()
 
     return CONFIG[0]
+
+def generation():
+    return GENERATION[0]
+
+def reload():
+    CONFIG[0] = None
+    GENERATION[0] += 1
+    LOG.info("Reloading configuration, generation %d", GENERATION[0])
+    return get_config()
@@ -0,0 +1,17 @@
+def header(request, name, default=None):
+    # HTTP/2 header names are always lower case
+    for key, value in request.headers:
+        if key == name:
+            return value
+    return default
+
+
+def cookie(request, name, default=None):
+    # A HTTP/2 client may send its cookies in several headers
+    for key, value in request.headers:
+        if key == b'cookie':
+            for item in value.decode('latin-1').split(';'):
+                key, _, value = item.strip().partition('=')
+                if key == name:
+                    return value
+    return default
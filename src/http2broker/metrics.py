@@ -0,0 +1,128 @@
+from bisect import bisect_left
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# Plain in-process counters, only ever touched from the event loop, so no locking is needed
+
+REGISTRY = {}
+
+# In seconds, from sub-millisecond loop latencies up to slow broker round trips
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metric(object):
+    __slots__ = ('name', 'description', 'labels', 'value')
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.value = 0
+
+
+class Counter(Metric):
+    __slots__ = ()
+
+    def inc(self, n=1):
+        self.value += n
+
+
+class Gauge(Metric):
+    __slots__ = ()
+
+    def inc(self, n=1):
+        self.value += n
+
+    def dec(self, n=1):
+        self.value -= n
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram(Metric):
+    # value is the number of observations, counts holds them per bucket, the last one for everything above the buckets
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, name, description, labels, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.value += 1
+
+
+def _get(cls, name, description, labels, *args):
+    key = (name, tuple(sorted(labels.items())))
+    metric = REGISTRY.get(key, None)
+    if metric is None:
+        metric = REGISTRY[key] = cls(name, description, dict(labels), *args)
+    return metric
+
+
+def counter(name, description='', **labels):
+    return _get(Counter, name, description, labels)
+
+
+def gauge(name, description='', **labels):
+    return _get(Gauge, name, description, labels)
+
+
+def histogram(name, description='', buckets=DEFAULT_BUCKETS, **labels):
+    return _get(Histogram, name, description, labels, buckets)
+
+
+# Prometheus text exposition format
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+TYPES = {Counter: 'counter', Gauge: 'gauge', Histogram: 'histogram'}
+
+# Added to every metric when rendering, e.g. the worker, so the series of the workers sharing a port stay apart
+LABELS = {}
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    items = sorted(dict(LABELS, **labels).items()) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, _escape(value)) for key, value in items) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render():
+    # All metrics of the registry, grouped by name
+    by_name = {}
+    for metric in REGISTRY.values():
+        by_name.setdefault(metric.name, []).append(metric)
+
+    lines = []
+    for name in sorted(by_name):
+        metrics = by_name[name]
+        lines.append('# HELP {} {}'.format(name, metrics[0].description.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE {} {}'.format(name, TYPES[type(metrics[0])]))
+        for metric in sorted(metrics, key=lambda metric: sorted(metric.labels.items())):
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, count in zip(metric.buckets + (float('inf'),), metric.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(name, _labels(metric.labels, le=_number(bound)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, _labels(metric.labels), _number(metric.sum)))
+                lines.append('{}_count{} {}'.format(name, _labels(metric.labels), metric.value))
+            else:
+                lines.append('{}{} {}'.format(name, _labels(metric.labels), _number(metric.value)))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
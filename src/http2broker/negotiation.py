@@ -0,0 +1,77 @@
+import logging
+from .cache import LRUCache
+from .stream import TextEventStream, NDJSONStream, PlainTextStream, BinaryStream
+
+LOG = logging.getLogger(__name__)
+
+# The stream formats in order of preference, for a client accepting several equally
+SERIALISERS = [TextEventStream, NDJSONStream, PlainTextStream, BinaryStream]
+
+# Clients send the same few Accept headers over and over, so each distinct one is only parsed once
+CACHE = LRUCache(256)
+
+_NONE = object()
+
+
+def parse(accept):
+    # A list of (type, subtype, q), skipping anything malformed
+    media_ranges = []
+    for item in accept.decode('latin-1').split(','):
+        media_range, *params = item.split(';')
+        media_type, _, subtype = media_range.strip().lower().partition('/')
+        if not media_type or not subtype:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        media_ranges.append((media_type, subtype, q))
+    return media_ranges
+
+
+def quality(media_ranges, content_type):
+    # The q of the most specific media range matching the content type, 0 for none
+    media_type, _, subtype = content_type.partition('/')
+    best = (-1, 0.0)
+    for range_type, range_subtype, q in media_ranges:
+        if range_type == media_type and range_subtype == subtype:
+            specificity = 2
+        elif range_type == media_type and range_subtype == '*':
+            specificity = 1
+        elif range_type == '*' and range_subtype == '*':
+            specificity = 0
+        else:
+            continue
+        if specificity > best[0]:
+            best = (specificity, q)
+    return best[1]
+
+
+def select(accept):
+    media_ranges = parse(accept)
+    if not media_ranges:
+        # Nothing usable in it, as good as no Accept header at all
+        return SERIALISERS[0]
+    best = None
+    best_q = 0.0
+    for serialiser in SERIALISERS:
+        q = quality(media_ranges, serialiser.content_type())
+        if q > best_q:
+            best, best_q = serialiser, q
+    return best
+
+
+def negotiate(accept):
+    # The serialiser for the Accept header, the first one without any, and None if nothing is acceptable
+    if not accept:
+        return SERIALISERS[0]
+
+    serialiser = CACHE.get(accept, _NONE)
+    if serialiser is _NONE:
+        serialiser = select(accept)
+        CACHE.put(accept, serialiser)
+    return serialiser
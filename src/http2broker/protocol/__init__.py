@@ -0,0 +1,2 @@
+__author__ = 'fabian'
+__all__ = ['mqtt', 'nats']
@@ -0,0 +1,436 @@
+from collections import namedtuple
+import asyncio
+import logging
+import struct
+
+LOG = logging.getLogger(__name__)
+
+# A minimal asyncio MQTT 3.1.1 / 5 client: incremental parsing of the packets as they arrive,
+# all packets written within one loop iteration go out in one write, and timers instead of polling.
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = range(1, 15)
+
+MQTT_3_1_1 = 4
+MQTT_5 = 5
+
+# subscriptions are the MQTT 5 subscription identifiers the message matched, empty with MQTT 3.1.1
+Message = namedtuple('Message', ['topic', 'payload', 'qos', 'retain', 'mid', 'subscriptions'])
+
+_U16 = struct.Struct('!H')
+
+SUBSCRIPTION_IDENTIFIER = 0x0b
+# The sizes of the fixed size properties a PUBLISH may have, the others are variable byte integers (0x0b),
+# length prefixed strings or binary data, and string pairs (0x26)
+PUBLISH_PROPERTIES = {0x01: 1, 0x02: 4, 0x23: 2}
+
+PINGREQ_PACKET = b'\xc0\x00'
+DISCONNECT_PACKET = b'\xe0\x00'
+
+
+class MQTTError(Exception):
+    pass
+
+
+def encode_length(n):
+    out = bytearray()
+    while True:
+        byte = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def decode_length(data, offset):
+    # Returns the variable byte integer at offset and the offset after it, or None if it did not arrive completely
+    value = 0
+    shift = 0
+    for _ in range(4):
+        if offset >= len(data):
+            return None, offset
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7
+    raise MQTTError('Malformed variable length')
+
+
+def publish_subscriptions(data, offset, end):
+    # The subscription identifiers among the MQTT 5 properties of a PUBLISH from offset to end
+    identifiers = []
+    while offset < end:
+        identifier = data[offset]
+        offset += 1
+        if identifier == SUBSCRIPTION_IDENTIFIER:
+            value, offset = decode_length(data, offset)
+            if value is None:
+                raise MQTTError('Malformed subscription identifier')
+            identifiers.append(value)
+        elif identifier in PUBLISH_PROPERTIES:
+            offset += PUBLISH_PROPERTIES[identifier]
+        elif identifier in (0x03, 0x08, 0x09):
+            offset += 2 + _U16.unpack_from(data, offset)[0]
+        elif identifier == 0x26:
+            for _ in range(2):
+                offset += 2 + _U16.unpack_from(data, offset)[0]
+        else:
+            raise MQTTError('Unexpected property {} in PUBLISH'.format(identifier))
+    return tuple(identifiers)
+
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return _U16.pack(len(value)) + value
+
+
+def packet(kind, flags, *parts):
+    body = b''.join(parts)
+    return b''.join([bytes([kind << 4 | flags]), encode_length(len(body)), body])
+
+
+class Protocol(asyncio.Protocol):
+    def __init__(self, client):
+        self._client = client
+        self._loop = client.loop
+        self._buf = bytearray()
+        self._out = []
+        self.transport = None
+        self.written = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._client._connection_lost(self, exc)
+
+    def data_received(self, data):
+        buf = self._buf
+        buf.extend(data)
+        offset = 0
+        end = len(buf)
+        try:
+            while end - offset >= 2:
+                length, start = decode_length(buf, offset + 1)
+                if length is None or start + length > end:
+                    break
+                header = buf[offset]
+                self._client._packet(header >> 4, header & 0x0f, bytes(buf[start:start + length]))
+                offset = start + length
+        except (MQTTError, IndexError, struct.error, UnicodeDecodeError) as e:
+            LOG.error("Invalid packet from broker: %s", e)
+            if self.transport is not None:
+                self.transport.close()
+        del buf[:offset]
+
+    def write(self, data):
+        if not self._out:
+            self._loop.call_soon(self._flush)
+        self._out.append(data)
+
+    def _flush(self):
+        out, self._out = self._out, []
+        if self.transport is not None and out:
+            self.written = True
+            self.transport.write(b''.join(out))
+
+    def close(self):
+        self._flush()
+        if self.transport is not None:
+            self.transport.close()
+
+
+class Client(object):
+    def __init__(self, host, port=1883, client_id='', username=None, password=None, keepalive=60, clean_session=True,
+                 version=MQTT_3_1_1, ssl=None, inflight=64, loop=None):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self.clean_session = clean_session
+        self.version = version
+        self.ssl = ssl
+        self.loop = loop or asyncio.get_event_loop()
+        self.on_message = None
+        # Called with the exception, whenever an established connection got lost and is reconnecting
+        self.on_connection_lost = None
+        self._protocol = None
+        self._ready = asyncio.Event(loop=self.loop)
+        self._connack = None
+        self._closing = False
+        self._paused = False
+        self._topics = {}
+        self._waiting = {}
+        # QoS 1/2 publishes awaiting their PUBACK / PUBCOMP, by packet id: [packet, future, released]
+        self._inflight = {}
+        self._window = asyncio.Semaphore(inflight, loop=self.loop)
+        self._next_id = 0
+        self._received = set()
+        self._ping_outstanding = False
+        self._keepalive_handle = None
+
+    @property
+    def connected(self):
+        return self._ready.is_set()
+
+    @property
+    def pending(self):
+        return len(self._inflight)
+
+    @property
+    def subscribing(self):
+        # Whether a SUBSCRIBE or UNSUBSCRIBE is still waiting for its acknowledgement
+        return bool(self._waiting)
+
+    def start(self):
+        return asyncio.async(self.connect(), loop=self.loop)
+
+    @asyncio.coroutine
+    def connect(self):
+        delay = 0.1
+        while not self._closing:
+            protocol = None
+            try:
+                _, protocol = yield from self.loop.create_connection(lambda: Protocol(self), self.host, self.port, ssl=self.ssl)
+                self._connack = asyncio.Future(loop=self.loop)
+                protocol.write(self._connect_packet())
+                yield from asyncio.wait_for(self._connack, max(self.keepalive, 10), loop=self.loop)
+                self._connected(protocol)
+                return
+            except (OSError, MQTTError, asyncio.TimeoutError) as e:
+                LOG.warning("Could not connect to %s:%s: %s", self.host, self.port, e)
+                if protocol is not None:
+                    protocol.close()
+                yield from asyncio.sleep(delay, loop=self.loop)
+                delay = min(delay * 2, 30.0)
+
+    def _connect_packet(self):
+        flags = 0x02 if self.clean_session else 0
+        if self.username is not None:
+            flags |= 0x80
+        if self.password is not None:
+            flags |= 0x40
+        parts = [encode_string('MQTT'), bytes([self.version, flags]), _U16.pack(self.keepalive)]
+        if self.version >= MQTT_5:
+            parts.append(b'\x00')
+        parts.append(encode_string(self.client_id))
+        if self.username is not None:
+            parts.append(encode_string(self.username))
+        if self.password is not None:
+            parts.append(encode_string(self.password))
+        return packet(CONNECT, 0, *parts)
+
+    def _connected(self, protocol):
+        LOG.debug("Connected to %s:%s as %s", self.host, self.port, self.client_id)
+        self._protocol = protocol
+        self._ping_outstanding = False
+        self._ready.set()
+        if self._paused:
+            protocol.transport.pause_reading()
+        for topic, (qos, identifier) in self._topics.items():
+            self._send_subscribe(topic, qos, identifier)
+        # Unacknowledged publishes are sent again, flagged as duplicates, or continued with their PUBREL
+        for packet_id, (data, _, released) in self._inflight.items():
+            if released:
+                protocol.write(packet(PUBREL, 0x02, _U16.pack(packet_id)))
+            else:
+                protocol.write(bytes([data[0] | 0x08]) + data[1:])
+        self._schedule_keepalive()
+
+    def _connection_lost(self, protocol, exc):
+        if self._connack is not None and not self._connack.done():
+            self._connack.set_exception(MQTTError('Connection lost'))
+        if protocol is not self._protocol:
+            return
+        self._protocol = None
+        self._ready.clear()
+        if self._keepalive_handle is not None:
+            self._keepalive_handle.cancel()
+            self._keepalive_handle = None
+        waiting, self._waiting = self._waiting, {}
+        for future in waiting.values():
+            future.cancel()
+        if not self._closing:
+            LOG.warning("Lost connection to %s:%s: %s", self.host, self.port, exc)
+            if self.on_connection_lost is not None:
+                self.on_connection_lost(exc)
+            self.start()
+
+    def _schedule_keepalive(self):
+        # Checked twice per keepalive period, so the broker sees a packet at least once within it
+        if self.keepalive > 0:
+            self._keepalive_handle = self.loop.call_later(self.keepalive / 2.0, self._keepalive)
+
+    def _keepalive(self):
+        protocol = self._protocol
+        if protocol is None:
+            return
+        if self._ping_outstanding:
+            LOG.warning("No PINGRESP from %s:%s", self.host, self.port)
+            protocol.close()
+            return
+        if not protocol.written:
+            self._ping_outstanding = True
+            protocol.write(PINGREQ_PACKET)
+        protocol.written = False
+        self._schedule_keepalive()
+
+    def _packet_id(self):
+        while True:
+            self._next_id = self._next_id % 0xffff + 1
+            if self._next_id not in self._waiting and self._next_id not in self._inflight:
+                return self._next_id
+
+    def _expect(self, packet_id):
+        future = asyncio.Future(loop=self.loop)
+        self._waiting[packet_id] = future
+        return future
+
+    def _packet(self, kind, flags, body):
+        if kind == PUBLISH:
+            self._on_publish(flags, body)
+        elif kind in (PUBACK, PUBCOMP):
+            inflight = self._inflight.pop(_U16.unpack_from(body)[0], None)
+            if inflight is not None and not inflight[1].done():
+                inflight[1].set_result(body)
+        elif kind in (SUBACK, UNSUBACK):
+            future = self._waiting.pop(_U16.unpack_from(body)[0], None)
+            if future is not None and not future.done():
+                future.set_result(body)
+        elif kind == PUBREC:
+            self._on_pubrec(body)
+        elif kind == PUBREL:
+            packet_id = _U16.unpack_from(body)[0]
+            self._received.discard(packet_id)
+            self._protocol.write(packet(PUBCOMP, 0, _U16.pack(packet_id)))
+        elif kind == PINGRESP:
+            self._ping_outstanding = False
+        elif kind == CONNACK:
+            code = body[1]
+            if self._connack is not None and not self._connack.done():
+                if code == 0:
+                    self._connack.set_result(body)
+                else:
+                    self._connack.set_exception(MQTTError('Connection refused with code {}'.format(code)))
+        elif kind == DISCONNECT:
+            LOG.warning("Disconnected by %s:%s", self.host, self.port)
+        else:
+            raise MQTTError('Unexpected packet type {}'.format(kind))
+
+    def _on_publish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        length = _U16.unpack_from(body)[0]
+        topic = body[2:2 + length].decode('utf-8')
+        offset = 2 + length
+        packet_id = None
+        if qos:
+            packet_id = _U16.unpack_from(body, offset)[0]
+            offset += 2
+        subscriptions = ()
+        if self.version >= MQTT_5:
+            length, offset = decode_length(body, offset)
+            if length is None:
+                raise MQTTError('Malformed properties')
+            if length:
+                subscriptions = publish_subscriptions(body, offset, offset + length)
+            offset += length
+
+        if qos == 1:
+            self._protocol.write(packet(PUBACK, 0, _U16.pack(packet_id)))
+        elif qos == 2:
+            self._protocol.write(packet(PUBREC, 0, _U16.pack(packet_id)))
+            if packet_id in self._received:
+                return
+            self._received.add(packet_id)
+
+        if self.on_message is not None:
+            self.on_message(Message(topic, body[offset:], qos, bool(flags & 0x01), packet_id, subscriptions))
+
+    def _on_pubrec(self, body):
+        packet_id = _U16.unpack_from(body)[0]
+        inflight = self._inflight.get(packet_id, None)
+        if inflight is not None:
+            inflight[2] = True
+            self._protocol.write(packet(PUBREL, 0x02, _U16.pack(packet_id)))
+
+    def _send_subscribe(self, topic, qos, identifier):
+        packet_id = self._packet_id()
+        future = self._expect(packet_id)
+        properties = b''
+        if self.version >= MQTT_5:
+            properties = b'\x00'
+            if identifier is not None:
+                identifier = bytes([SUBSCRIPTION_IDENTIFIER]) + encode_length(identifier)
+                properties = encode_length(len(identifier)) + identifier
+        self._protocol.write(packet(SUBSCRIBE, 0x02, _U16.pack(packet_id), properties, encode_string(topic), bytes([qos])))
+        return future
+
+    def subscribe(self, topic, qos=0, identifier=None):
+        # Remembered and sent again after a reconnect. With MQTT 5, the messages matching it carry the identifier
+        # (1 to 268435455) in their subscriptions.
+        self._topics[topic] = (qos, identifier)
+        if self.connected:
+            return self._send_subscribe(topic, qos, identifier)
+
+    def unsubscribe(self, topic):
+        self._topics.pop(topic, None)
+        if self.connected:
+            packet_id = self._packet_id()
+            future = self._expect(packet_id)
+            properties = b'\x00' if self.version >= MQTT_5 else b''
+            self._protocol.write(packet(UNSUBSCRIBE, 0x02, _U16.pack(packet_id), properties, encode_string(topic)))
+            return future
+
+    @asyncio.coroutine
+    def publish(self, topic, payload, qos=0, retain=False):
+        # QoS 1 and 2 publishes return once the broker acknowledged them. At most inflight of them are outstanding,
+        # and they survive reconnects.
+        properties = b'\x00' if self.version >= MQTT_5 else b''
+        if qos == 0:
+            if not self.connected:
+                yield from self._ready.wait()
+            self._protocol.write(packet(PUBLISH, int(retain), encode_string(topic), properties, payload))
+            return
+
+        yield from self._window.acquire()
+        try:
+            if not self.connected:
+                yield from self._ready.wait()
+            packet_id = self._packet_id()
+            data = packet(PUBLISH, qos << 1 | int(retain), encode_string(topic), _U16.pack(packet_id), properties, payload)
+            future = asyncio.Future(loop=self.loop)
+            self._inflight[packet_id] = [data, future, False]
+            self._protocol.write(data)
+            yield from future
+        finally:
+            self._window.release()
+
+    def pause_reading(self):
+        self._paused = True
+        if self._protocol is not None and self._protocol.transport is not None:
+            self._protocol.transport.pause_reading()
+
+    def resume_reading(self):
+        self._paused = False
+        if self._protocol is not None and self._protocol.transport is not None:
+            self._protocol.transport.resume_reading()
+
+    def close(self):
+        self._closing = True
+        inflight, self._inflight = self._inflight, {}
+        for _, future, _ in inflight.values():
+            future.cancel()
+        if self._keepalive_handle is not None:
+            self._keepalive_handle.cancel()
+            self._keepalive_handle = None
+        protocol = self._protocol
+        if protocol is not None:
+            protocol.write(DISCONNECT_PACKET)
+            protocol.close()
@@ -0,0 +1,283 @@
+from collections import namedtuple, deque
+from urllib.parse import urlparse
+import asyncio
+import json
+import logging
+import ssl
+
+LOG = logging.getLogger(__name__)
+
+# A minimal asyncio NATS client: a streaming parser for the server operations, all operations written
+# within one loop iteration go out in one write, and messages get dispatched by subscription id.
+
+Message = namedtuple('Message', ['subject', 'sid', 'reply', 'data'])
+
+PING = b'PING\r\n'
+PONG = b'PONG\r\n'
+CRLF = b'\r\n'
+
+MAX_CONTROL_LINE = 4096
+
+
+class NATSError(Exception):
+    pass
+
+
+class Protocol(asyncio.Protocol):
+    def __init__(self, client):
+        self._client = client
+        self._loop = client.loop
+        self._buf = bytearray()
+        self._out = []
+        self._msg = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._client._connection_lost(self, exc)
+
+    def data_received(self, data):
+        buf = self._buf
+        buf.extend(data)
+        offset = 0
+        end = len(buf)
+        try:
+            while offset < end:
+                if self._msg is not None:
+                    # The payload of a MSG, followed by CRLF
+                    subject, sid, reply, size = self._msg
+                    if end - offset < size + 2:
+                        break
+                    self._msg = None
+                    self._client._message(Message(subject, sid, reply, bytes(buf[offset:offset + size])))
+                    offset += size + 2
+                    continue
+
+                eol = buf.find(CRLF, offset)
+                if eol < 0:
+                    if end - offset > MAX_CONTROL_LINE:
+                        raise NATSError('Control line too long')
+                    break
+                line = bytes(buf[offset:eol])
+                offset = eol + 2
+                self._operation(line)
+        except (NATSError, ValueError, IndexError) as e:
+            LOG.error("Invalid data from server: %s", e)
+            if self.transport is not None:
+                self.transport.close()
+        del buf[:offset]
+
+    def _operation(self, line):
+        op, _, args = line.partition(b' ')
+        op = op.upper()
+        if op == b'MSG':
+            args = args.split()
+            if len(args) == 4:
+                subject, sid, reply, size = args
+            else:
+                subject, sid, size = args
+                reply = None
+            self._msg = (subject.decode('utf-8'), int(sid), reply and reply.decode('utf-8'), int(size))
+        elif op == b'PING':
+            self.write(PONG)
+        elif op == b'PONG':
+            self._client._pong()
+        elif op == b'+OK':
+            pass
+        elif op == b'INFO':
+            self._client._info(json.loads(args.decode('utf-8')))
+        elif op == b'-ERR':
+            self._client._error(args.decode('utf-8', 'replace'))
+        else:
+            raise NATSError('Unknown operation {}'.format(op))
+
+    def write(self, data):
+        if not self._out:
+            self._loop.call_soon(self._flush)
+        self._out.append(data)
+
+    def _flush(self):
+        out, self._out = self._out, []
+        if self.transport is not None and out:
+            self.transport.write(b''.join(out))
+
+    def close(self):
+        self._flush()
+        if self.transport is not None:
+            self.transport.close()
+
+
+class Client(object):
+    def __init__(self, url, name='', ssl_required=False, loop=None):
+        url = urlparse(url)
+        self.host = url.hostname or 'localhost'
+        self.port = url.port or 4222
+        self.user = url.username
+        self.password = url.password
+        self.name = name
+        self.ssl = ssl.create_default_context() if ssl_required else None
+        self.loop = loop or asyncio.get_event_loop()
+        self.info = {}
+        self._protocol = None
+        self._pending = None
+        self._ready = asyncio.Event(loop=self.loop)
+        self._connected = None
+        self._closing = False
+        self._paused = False
+        self._next_sid = 0
+        self._subscriptions = {}
+        self._pongs = deque()
+        # Called with the exception, whenever an established connection got lost and is reconnecting
+        self.on_connection_lost = None
+
+    @property
+    def connected(self):
+        return self._ready.is_set()
+
+    def start(self):
+        return asyncio.async(self.connect(), loop=self.loop)
+
+    @asyncio.coroutine
+    def connect(self):
+        delay = 0.1
+        while not self._closing:
+            protocol = None
+            try:
+                _, protocol = yield from self.loop.create_connection(lambda: Protocol(self), self.host, self.port, ssl=self.ssl,
+                                                                     server_hostname=self.host if self.ssl else None)
+                # The server greets with INFO, a PONG to the PING after CONNECT confirms the connection
+                self._connected = asyncio.Future(loop=self.loop)
+                self._pending = protocol
+                yield from asyncio.wait_for(self._connected, 10, loop=self.loop)
+                self._established(protocol)
+                return
+            except (OSError, NATSError, asyncio.TimeoutError) as e:
+                LOG.warning("Could not connect to %s:%s: %s", self.host, self.port, e)
+                if protocol is not None:
+                    protocol.close()
+                yield from asyncio.sleep(delay, loop=self.loop)
+                delay = min(delay * 2, 30.0)
+
+    def _info(self, info):
+        self.info = info
+        protocol = self._pending
+        if protocol is None or self._connected is None or self._connected.done():
+            return
+        options = {'verbose': False, 'pedantic': False, 'lang': 'python', 'version': '0.1', 'name': self.name,
+                   'ssl_required': self.ssl is not None}
+        if self.user is not None:
+            options['user'] = self.user
+            options['pass'] = self.password
+        protocol.write(b''.join([b'CONNECT ', json.dumps(options).encode('utf-8'), CRLF, PING]))
+
+    def _pong(self):
+        if self._connected is not None and not self._connected.done():
+            self._connected.set_result(True)
+        elif self._pongs:
+            future = self._pongs.popleft()
+            if not future.done():
+                future.set_result(True)
+
+    def _error(self, error):
+        LOG.error("Error from %s:%s: %s", self.host, self.port, error)
+        if self._connected is not None and not self._connected.done():
+            self._connected.set_exception(NATSError(error))
+
+    def _established(self, protocol):
+        LOG.debug("Connected to %s:%s as %s", self.host, self.port, self.name)
+        self._pending = None
+        self._protocol = protocol
+        self._ready.set()
+        if self._paused:
+            protocol.transport.pause_reading()
+        for sid, (subject, queue, _) in self._subscriptions.items():
+            protocol.write(self._sub(subject, queue, sid))
+
+    def _connection_lost(self, protocol, exc):
+        if self._connected is not None and not self._connected.done():
+            self._connected.set_exception(NATSError('Connection lost'))
+        if protocol is not self._protocol:
+            return
+        self._protocol = None
+        self._ready.clear()
+        pongs, self._pongs = self._pongs, deque()
+        for future in pongs:
+            future.cancel()
+        if not self._closing:
+            LOG.warning("Lost connection to %s:%s: %s", self.host, self.port, exc)
+            if self.on_connection_lost is not None:
+                self.on_connection_lost(exc)
+            self.start()
+
+    def _message(self, message):
+        subscription = self._subscriptions.get(message.sid, None)
+        if subscription is not None:
+            subscription[2](message)
+
+    @staticmethod
+    def _sub(subject, queue, sid):
+        if queue:
+            return 'SUB {} {} {}\r\n'.format(subject, queue, sid).encode('utf-8')
+        return 'SUB {} {}\r\n'.format(subject, sid).encode('utf-8')
+
+    def subscribe(self, subject, callback, queue=None):
+        # Returns the subscription id. Subscriptions are remembered and sent again after a reconnect.
+        self._next_sid += 1
+        sid = self._next_sid
+        self._subscriptions[sid] = (subject, queue, callback)
+        if self.connected:
+            self._protocol.write(self._sub(subject, queue, sid))
+        return sid
+
+    def unsubscribe(self, sid):
+        if self._subscriptions.pop(sid, None) is not None and self.connected:
+            self._protocol.write('UNSUB {}\r\n'.format(sid).encode('utf-8'))
+
+    def _pub(self, subject, payload, reply=None):
+        if reply:
+            line = 'PUB {} {} {}\r\n'.format(subject, reply, len(payload))
+        else:
+            line = 'PUB {} {}\r\n'.format(subject, len(payload))
+        return b''.join([line.encode('utf-8'), payload, CRLF])
+
+    @asyncio.coroutine
+    def publish(self, subject, payload, reply=None):
+        if not self.connected:
+            yield from self._ready.wait()
+        self._protocol.write(self._pub(subject, payload, reply))
+
+    @asyncio.coroutine
+    def publish_many(self, messages):
+        # One write for all PUB operations, and a PING/PONG round trip confirming the server processed them
+        if not self.connected:
+            yield from self._ready.wait()
+        self._protocol.write(b''.join([self._pub(subject, payload) for subject, payload in messages]))
+        yield from self.flush()
+
+    @asyncio.coroutine
+    def flush(self):
+        if not self.connected:
+            yield from self._ready.wait()
+        future = asyncio.Future(loop=self.loop)
+        self._pongs.append(future)
+        self._protocol.write(PING)
+        yield from future
+
+    def pause_reading(self):
+        self._paused = True
+        if self._protocol is not None and self._protocol.transport is not None:
+            self._protocol.transport.pause_reading()
+
+    def resume_reading(self):
+        self._paused = False
+        if self._protocol is not None and self._protocol.transport is not None:
+            self._protocol.transport.resume_reading()
+
+    def close(self):
+        self._closing = True
+        protocol = self._protocol
+        if protocol is not None:
+            protocol.close()
@@ -0,0 +1,115 @@
+import asyncio
+import json
+import logging
+import nghttp2
+from urllib.parse import urlparse, parse_qs
+from . import batch
+from .headers import header
+
+LOG = logging.getLogger(__name__)
+
+
+class Sender(object):
+    # The body of a publishing request. The payload is passed on to the broker as received, without decoding it,
+    # and bodies larger than max_body are rejected, if possible before they arrive.
+    # A batch content type (see batch.py) publishes all messages of the body at once, limited by max_batch_body.
+    # The messages go to the broker through the adapter of the controller.
+    def __init__(self, controller, request, start_response):
+        self.start_response = start_response
+        self.controller = controller
+        self.request = request
+        self.response = None
+        self.parser = batch.parser(header(request, b'content-type'))
+        if self.parser is None:
+            self.limit = int(controller.config.get('max_body', 1024 * 1024))
+        else:
+            self.limit = int(controller.config.get('max_batch_body', 16 * 1024 * 1024))
+        self.chunks = []
+        self.size = 0
+
+        length = header(request, b'content-length')
+        if length is not None:
+            try:
+                length = int(length)
+            except ValueError:
+                length = -1
+            if length < 0:
+                self.reject(400, 'Invalid content-length')
+            elif length > self.limit:
+                self.reject(413, 'Request body exceeds {} bytes'.format(self.limit))
+
+    def __call__(self, n):
+        if self.response is None:
+            return None, nghttp2.DATA_DEFERRED
+        else:
+            return self.response, nghttp2.DATA_EOF
+
+    @property
+    def params(self):
+        return parse_qs(urlparse(self.request.path.decode('utf-8')).query)
+
+    @property
+    def key(self):
+        return self.params.get('k', ['default'])[0]
+
+    @property
+    def body(self):
+        if len(self.chunks) == 1:
+            return self.chunks[0]
+        return b''.join(self.chunks)
+
+    def on_data(self, data):
+        if self.response is not None:
+            return
+        self.size += len(data)
+        if self.size > self.limit:
+            self.chunks = []
+            self.reject(413, 'Request body exceeds {} bytes'.format(self.limit))
+        else:
+            self.chunks.append(data)
+
+    def on_request_done(self):
+        if self.response is None:
+            asyncio.async(self._publish())
+
+    @asyncio.coroutine
+    def _publish(self):
+        controller = self.controller
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            if self.parser is None:
+                yield from self.publish(self.key, self.body)
+                published = 1
+                self.respond(200, b'{}')
+            else:
+                records = self.parser(self.body)
+                errors = yield from self.publish_many([record for record in records if record.error is None])
+                published = errors.count(None)
+                self.respond(200, json.dumps(batch.results(records, errors)).encode('utf-8'))
+            controller.publish_seconds.observe(loop.time() - started)
+            controller.published.inc(published)
+        except ValueError as e:
+            self.reject(400, e)
+        except Exception as e:
+            LOG.error("Could not publish: %s", e)
+            self.reject(500, e)
+
+    @asyncio.coroutine
+    def publish(self, key, payload):
+        controller = self.controller
+        yield from controller.adapter.publish(controller.topic(key), payload, self.request)
+
+    @asyncio.coroutine
+    def publish_many(self, records):
+        # Returns the error, or None, for each record
+        controller = self.controller
+        return (yield from controller.adapter.publish_many([(controller.topic(record.key), record.payload) for record in records], self.request))
+
+    def respond(self, status, body):
+        self.start_response(status, [('content-type', 'application/json'), ('cache-control', 'no-cache')])
+        self.response = body
+        self.request.resume()
+
+    def reject(self, status, error):
+        self.respond(status, json.dumps({'e': str(error)}).encode('utf-8'))
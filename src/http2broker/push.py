@@ -0,0 +1,67 @@
+from hashlib import sha1
+import logging
+from .cache import LRUCache
+from .headers import header, cookie
+
+LOG = logging.getLogger(__name__)
+
+
+class Pusher(object):
+    # Pushes the static files listed for a page along with it. A file is pushed only once per HTTP/2 connection,
+    # unless it changed since. With a cookie name set, clients get a digest of the pushed versions, and when they
+    # come back with it, they have all of them cached already and nothing gets pushed.
+    def __init__(self, static_files, manifests, cookie_name=None, cookie_max_age=86400, connections=4096):
+        self.static_files = static_files
+        self.manifests = manifests
+        self.cookie_name = cookie_name
+        self.cookie_max_age = cookie_max_age
+        self._pushed = LRUCache(connections)
+
+    def digest(self, paths):
+        entries = [self.static_files.get(path) for path in paths]
+        return sha1(' '.join(entry.identity.etag for entry in entries if entry is not None).encode('ascii')).hexdigest()[:16]
+
+    def push(self, request, page):
+        # Returns the headers to add to the response of the page
+        paths = self.manifests.get(page, None)
+        if not paths:
+            return []
+
+        digest = None
+        if self.cookie_name:
+            digest = self.digest(paths)
+            if cookie(request, self.cookie_name) == digest:
+                return []
+
+        # By the id of the connection, so closed ones are not kept alive, along with the client address, so a later
+        # connection getting the same id starts over
+        key = id(request.http2)
+        entry = self._pushed.get(key, None)
+        if entry is None or entry[0] != request.client_address:
+            entry = (request.client_address, {})
+            self._pushed.put(key, entry)
+        pushed = entry[1]
+
+        accept_encoding = header(request, b'accept-encoding')
+        request_headers = [(b'accept-encoding', accept_encoding)] if accept_encoding is not None else []
+        for path in paths:
+            entry = self.static_files.get(path)
+            if entry is None or pushed.get(path, None) == entry.identity.etag:
+                continue
+            status, headers, body = self.static_files.response(request, path, conditional=False)
+            try:
+                request.push(path, request_headers=request_headers, status=status, headers=headers, body=body)
+            except Exception as e:
+                # The client may have disabled push
+                LOG.debug("Could not push %s: %s", path, e)
+                break
+            pushed[path] = entry.identity.etag
+
+        if digest is None:
+            return []
+        return [(b'set-cookie', '{}={}; Path=/; Max-Age={}'.format(self.cookie_name, digest, self.cookie_max_age))]
+
+
+def manifests(config):
+    # Each key of the [push] section is a page, listing the paths to push with it
+    return { page: paths.split() for page, paths in config.items() }
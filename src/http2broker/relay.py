@@ -0,0 +1,249 @@
+from functools import partial
+from zlib import crc32
+import asyncio
+import logging
+import os
+import struct
+from . import metrics
+from .stream import Frame
+
+LOG = logging.getLogger(__name__)
+
+# With several workers, every pattern of a backend is owned by one of them. Only the owner holds the subscription
+# at the broker, the other workers subscribe at the owner over a unix socket and get the matching messages from it.
+
+RELAY = [None]
+BACKENDS = {}
+
+SUB = 1
+UNSUB = 2
+MSG = 3
+
+HEADER = struct.Struct('!BB')
+LENGTH = struct.Struct('!I')
+# The id and timestamp of a relayed message, kept so that all workers replay it the same way
+META = struct.Struct('!Qd')
+
+
+def encode(op, *fields):
+    parts = [HEADER.pack(op, len(fields))]
+    for field in fields:
+        parts.append(LENGTH.pack(len(field)))
+        parts.append(field)
+    return b''.join(parts)
+
+
+class Protocol(asyncio.Protocol):
+    # Both ends of a link: an operation and its length prefixed fields, handed on to the handler
+    def __init__(self, handler):
+        self._handler = handler
+        self._buf = bytearray()
+        self._out = []
+        self._pending = 0
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._handler.connection_lost(self, exc)
+
+    def data_received(self, data):
+        buf = self._buf
+        buf.extend(data)
+        offset = 0
+        end = len(buf)
+        while end - offset >= HEADER.size:
+            op, count = HEADER.unpack_from(buf, offset)
+            pos = offset + HEADER.size
+            fields = []
+            while len(fields) < count and end - pos >= LENGTH.size:
+                size, = LENGTH.unpack_from(buf, pos)
+                if end - pos - LENGTH.size < size:
+                    break
+                pos += LENGTH.size
+                fields.append(bytes(buf[pos:pos + size]))
+                pos += size
+            if len(fields) < count:
+                break
+            offset = pos
+            try:
+                self._handler.operation(self, op, fields)
+            except (ValueError, IndexError, struct.error) as e:
+                LOG.error("Invalid operation %d from worker: %s", op, e)
+        del buf[:offset]
+
+    @property
+    def buffered(self):
+        if self.transport is None:
+            return 0
+        return self._pending + self.transport.get_write_buffer_size()
+
+    def write(self, data):
+        # Everything written within one loop iteration goes out at once
+        if not self._out:
+            asyncio.get_event_loop().call_soon(self._flush)
+        self._out.append(data)
+        self._pending += len(data)
+
+    def _flush(self):
+        out, self._out = self._out, []
+        self._pending = 0
+        if self.transport is not None and out:
+            self.transport.write(b''.join(out))
+
+
+class Peer(object):
+    # A worker subscribed to patterns owned by this one
+    def __init__(self, relay):
+        self._relay = relay
+        self._sinks = {}
+
+    def operation(self, protocol, op, fields):
+        name, pattern = fields[0].decode('utf-8'), fields[1].decode('utf-8')
+        controller = BACKENDS.get(name, None)
+        if controller is None:
+            LOG.error("Worker subscribed to unknown backend %s", name)
+            return
+
+        key = (name, pattern)
+        if op == SUB and key not in self._sinks:
+            sink = self._sinks[key] = partial(self._send, protocol, fields[0], fields[1])
+            controller.subscribe(pattern, sink)
+        elif op == UNSUB and key in self._sinks:
+            controller.unsubscribe(pattern, self._sinks.pop(key))
+
+    def _send(self, protocol, name, pattern, frame):
+        # A worker not reading fast enough loses messages, instead of holding back the broker for all
+        if protocol.buffered > self._relay.limit:
+            self._relay.dropped.inc()
+            return
+        protocol.write(encode(MSG, name, pattern, frame.topic.encode('utf-8'), META.pack(frame.id, frame.timestamp), frame.payload))
+
+    def connection_lost(self, protocol, exc):
+        sinks, self._sinks = self._sinks, {}
+        for (name, pattern), sink in sinks.items():
+            BACKENDS[name].unsubscribe(pattern, sink)
+
+
+class Link(object):
+    # The connection to the worker owning some of the patterns subscribed here
+    def __init__(self, path):
+        self.path = path
+        self._protocol = None
+        self._connecting = None
+        self._subscriptions = {}
+
+    def subscribe(self, name, pattern, deliver):
+        self._subscriptions[(name, pattern)] = deliver
+        if self._protocol is not None:
+            self._protocol.write(encode(SUB, name.encode('utf-8'), pattern.encode('utf-8')))
+        elif self._connecting is None:
+            self._connecting = asyncio.async(self._connect())
+
+    def unsubscribe(self, name, pattern):
+        if self._subscriptions.pop((name, pattern), None) is not None and self._protocol is not None:
+            self._protocol.write(encode(UNSUB, name.encode('utf-8'), pattern.encode('utf-8')))
+
+    @asyncio.coroutine
+    def _connect(self):
+        delay = 0.1
+        loop = asyncio.get_event_loop()
+        while self._subscriptions:
+            try:
+                _, protocol = yield from loop.create_unix_connection(lambda: Protocol(self), self.path)
+            except OSError as e:
+                LOG.debug("Could not connect to worker at %s: %s", self.path, e)
+                yield from asyncio.sleep(delay)
+                delay = min(delay * 2, 5.0)
+                continue
+
+            self._protocol = protocol
+            for name, pattern in self._subscriptions:
+                protocol.write(encode(SUB, name.encode('utf-8'), pattern.encode('utf-8')))
+            break
+        self._connecting = None
+
+    def operation(self, protocol, op, fields):
+        if op != MSG:
+            return
+        name, pattern = fields[0].decode('utf-8'), fields[1].decode('utf-8')
+        deliver = self._subscriptions.get((name, pattern), None)
+        if deliver is not None:
+            id, timestamp = META.unpack(fields[3])
+            deliver(pattern, Frame(fields[2].decode('utf-8'), fields[4], timestamp=timestamp, id=id))
+
+    def connection_lost(self, protocol, exc):
+        if protocol is not self._protocol:
+            return
+        self._protocol = None
+        if self._subscriptions:
+            LOG.warning("Lost connection to worker at %s: %s", self.path, exc)
+            self._connecting = asyncio.async(self._connect())
+
+
+class Relay(object):
+    def __init__(self, index, workers, path, limit=4 * 1024 * 1024):
+        self.index = index
+        self.workers = workers
+        self.path = path
+        self.limit = limit
+        self._links = {}
+        self._server = None
+        self.dropped = metrics.counter('h2a_relay_dropped_total', 'Messages not relayed to a worker falling behind')
+
+    def socket(self, index):
+        return self.path.format(index)
+
+    def owner(self, name, pattern):
+        # Has to be the same in every worker, so not the randomised hash()
+        return crc32('{}:{}'.format(name, pattern).encode('utf-8')) % self.workers
+
+    @asyncio.coroutine
+    def start(self):
+        path = self.socket(self.index)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._server = yield from asyncio.get_event_loop().create_unix_server(lambda: Protocol(Peer(self)), path)
+        LOG.debug("Worker %d relaying at %s", self.index, path)
+
+    def subscribe(self, name, pattern, deliver):
+        owner = self.owner(name, pattern)
+        if owner == self.index:
+            return False
+
+        link = self._links.get(owner, None)
+        if link is None:
+            link = self._links[owner] = Link(self.socket(owner))
+        link.subscribe(name, pattern, deliver)
+        return True
+
+    def unsubscribe(self, name, pattern):
+        link = self._links.get(self.owner(name, pattern), None)
+        if link is None:
+            return False
+        link.unsubscribe(name, pattern)
+        return True
+
+
+def setup(index, workers, path, limit=4 * 1024 * 1024):
+    RELAY[0] = Relay(index, workers, path, limit)
+    return RELAY[0]
+
+
+def register(name, controller):
+    BACKENDS[name] = controller
+
+
+def subscribe(name, pattern, deliver):
+    # True, if another worker holds the subscription at the broker, and relays the messages through deliver
+    relay = RELAY[0]
+    return relay is not None and relay.subscribe(name, pattern, deliver)
+
+
+def unsubscribe(name, pattern):
+    relay = RELAY[0]
+    return relay is not None and relay.unsubscribe(name, pattern)
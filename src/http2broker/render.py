@@ -0,0 +1,52 @@
+from hashlib import sha1
+import logging
+from .config import generation
+from .headers import header
+
+LOG = logging.getLogger(__name__)
+
+
+class Page(object):
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, body, etag):
+        self.body = body
+        self.etag = etag
+
+    def not_modified(self, request):
+        if_none_match = header(request, b'if-none-match')
+        if if_none_match is None:
+            return False
+        tags = [tag.strip() for tag in if_none_match.decode('latin-1').split(',')]
+        return '*' in tags or self.etag in tags or 'W/' + self.etag in tags
+
+
+class RenderCache(object):
+    # Rendered templates, encoded and with their ETag. The output only depends on the templates and the configuration,
+    # so a page is rendered once per configuration generation.
+    def __init__(self, engine):
+        self.engine = engine
+        self._pages = {}
+        self._generation = generation()
+
+    def get(self, name, context):
+        # context is only called, when the template has to be rendered
+        if self._generation != generation():
+            self.invalidate()
+
+        page = self._pages.get(name, None)
+        if page is None:
+            template = self.engine.get_template(name)
+            if not template:
+                return None
+            body = template.render(context()).encode('utf-8')
+            page = self._pages[name] = Page(body, '"{}"'.format(sha1(body).hexdigest()))
+            LOG.debug("Rendered %s, generation %d", name, self._generation)
+        return page
+
+    def invalidate(self):
+        # The compiled templates go as well, so changed templates get loaded again
+        self._generation = generation()
+        self._pages.clear()
+        for name in list(self.engine.templates):
+            self.engine.remove(name)
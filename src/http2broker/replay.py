@@ -0,0 +1,102 @@
+from collections import deque
+import asyncio
+import logging
+from . import metrics
+
+LOG = logging.getLogger(__name__)
+
+
+class Ring(object):
+    # The last messages of a pattern, itself subscribed like a stream. It stays subscribed for linger seconds
+    # after the last stream closed, so a client reconnecting meanwhile neither misses messages nor causes a new
+    # subscription at the broker.
+    # The frames are not retained, as with the pause overflow policy they would hold back acknowledgements, so they
+    # are not part of the buffer budget: the ring has a byte limit of its own instead.
+    def __init__(self, size, limit, used):
+        self.frames = deque()
+        self.size = size
+        self.limit = limit
+        self.bytes = 0
+        self.used = used
+        self.streams = 0
+        self.timer = None
+
+    def __call__(self, frame):
+        frames = self.frames
+        frames.append(frame)
+        self.bytes += frame.size
+        self.used.inc(frame.size)
+        while len(frames) > self.size or (self.bytes > self.limit and len(frames) > 1):
+            self._popleft()
+
+    def _popleft(self):
+        frame = self.frames.popleft()
+        self.bytes -= frame.size
+        self.used.dec(frame.size)
+
+    def clear(self):
+        while self.frames:
+            self._popleft()
+
+    def since(self, last_id):
+        # The messages after the one with last_id. If that is not held anymore, but older than all of them,
+        # everything held. Nothing for an id not known at all.
+        frames = self.frames
+        if not frames:
+            return []
+        if last_id < frames[0].id:
+            return list(frames)
+        for i, frame in enumerate(frames):
+            if frame.id == last_id:
+                return list(frames)[i + 1:]
+        return []
+
+
+class Replay(object):
+    def __init__(self, subscribe, unsubscribe, size=256, linger=5.0, name='', limit=1024 * 1024):
+        self._subscribe = subscribe
+        self._unsubscribe = unsubscribe
+        self.size = size
+        self.limit = limit
+        self.linger = linger
+        self._rings = {}
+        self.replayed = metrics.counter('h2a_replayed_total', 'Messages replayed to reconnecting streams', backend=name)
+        self.used = metrics.gauge('h2a_replay_bytes', 'Bytes of broker messages held for replay', backend=name)
+
+    def attach(self, pattern, sink, last_event_id=None):
+        ring = self._rings.get(pattern, None)
+        if ring is None:
+            ring = self._rings[pattern] = Ring(self.size, self.limit, self.used)
+            self._subscribe(pattern, ring)
+        elif ring.timer is not None:
+            ring.timer.cancel()
+            ring.timer = None
+        ring.streams += 1
+
+        if last_event_id is not None:
+            try:
+                last_id = int(last_event_id)
+            except ValueError:
+                LOG.debug("Ignoring Last-Event-ID %s", last_event_id)
+                return
+            frames = ring.since(last_id)
+            self.replayed.inc(len(frames))
+            for frame in frames:
+                sink(frame)
+
+    def detach(self, pattern):
+        ring = self._rings.get(pattern, None)
+        if ring is None:
+            return
+        ring.streams -= 1
+        if ring.streams <= 0:
+            if self.linger > 0:
+                ring.timer = asyncio.get_event_loop().call_later(self.linger, self._expire, pattern)
+            else:
+                self._expire(pattern)
+
+    def _expire(self, pattern):
+        ring = self._rings.pop(pattern, None)
+        if ring is not None:
+            self._unsubscribe(pattern, ring)
+            ring.clear()
@@ -0,0 +1,114 @@
+import logging
+from .cache import LRUCache
+
+LOG = logging.getLogger(__name__)
+
+# Resolves a request to its handler without any regular expressions: fixed paths by a dictionary lookup,
+# everything below a prefix by walking a trie of path segments, and then the handler by method.
+# The result for recently requested paths comes straight from a cache.
+
+# Routes registered without methods take any method
+ANY = None
+_MISSING = object()
+
+
+class Route(object):
+    __slots__ = ('handler', 'name', 'keep_prefix')
+
+    def __init__(self, handler, name=None, keep_prefix=False):
+        self.handler = handler
+        self.name = name
+        self.keep_prefix = keep_prefix
+
+
+class Node(object):
+    __slots__ = ('children', 'routes')
+
+    def __init__(self):
+        self.children = {}
+        self.routes = None
+
+
+def _methods(methods):
+    if methods is None:
+        return [ANY]
+    return [method if isinstance(method, bytes) else method.encode('ascii') for method in methods]
+
+
+def _select(routes, method):
+    route = routes.get(method, None)
+    if route is None:
+        route = routes.get(ANY, None)
+    return route
+
+
+class Router(object):
+    def __init__(self, cache=1024):
+        self._exact = {}
+        self._root = Node()
+        self._cache = LRUCache(cache)
+
+    def exact(self, path, handler, methods=None):
+        routes = self._exact.setdefault(path, {})
+        for method in _methods(methods):
+            routes[method] = Route(handler)
+        self._cache.clear()
+
+    def prefix(self, prefix, handler, name, methods=None, keep_prefix=False):
+        # prefix has to end with a slash, the rest of the path gets passed on as name,
+        # including the prefix itself with keep_prefix
+        if not prefix.startswith('/') or not prefix.endswith('/'):
+            raise ValueError('Prefix {} has to start and end with /'.format(prefix))
+        node = self._root
+        for segment in prefix[1:-1].split('/'):
+            node = node.children.setdefault(segment, Node())
+        if node.routes is None:
+            node.routes = {}
+        for method in _methods(methods):
+            node.routes[method] = Route(handler, name, keep_prefix)
+        self._cache.clear()
+
+    def match(self, path, method):
+        # A new dictionary each time, as handlers may change their match
+        path = path.partition('?')[0]
+        key = (method, path)
+        result = self._cache.get(key, _MISSING)
+        if result is _MISSING:
+            result = self._match(path, method)
+            self._cache.put(key, result)
+        if result is None:
+            return None
+        return dict(result)
+
+    def _match(self, path, method):
+        routes = self._exact.get(path, None)
+        if routes is not None:
+            route = _select(routes, method)
+            if route is not None:
+                return {'handler': route.handler}
+
+        # The longest matching prefix wins
+        node = self._root
+        found = None
+        pos = 1
+        while True:
+            if node.routes is not None:
+                route = _select(node.routes, method)
+                if route is not None:
+                    found = (route, pos)
+            end = path.find('/', pos)
+            if end < 0:
+                break
+            node = node.children.get(path[pos:end], None)
+            if node is None:
+                break
+            pos = end + 1
+
+        if found is None:
+            return None
+        route, pos = found
+        result = {'handler': route.handler}
+        rest = path if route.keep_prefix else path[pos:]
+        if rest:
+            result[route.name] = rest
+        return result
@@ -2,10 +2,14 @@ import nghttp2
 import logging
 import asyncio
 import sys
-import os, time, io
+import os, time
+import json
+import ipaddress
 from base64 import b64decode
-from copy import copy, deepcopy
+from copy import deepcopy
 from .config import get_config
+from . import metrics, relay
+from .trace import tracer
 from datetime import timedelta, datetime
 from uuid import uuid4 as uuid
 
@@ -13,7 +17,10 @@ from wheezy.template.engine import Engine
 from wheezy.template.ext.core import CoreExtension
 from wheezy.template.loader import FileLoader
 
-from routes import Mapper
+from .router import Router
+from .static import StaticCache
+from .push import Pusher, manifests
+from .render import RenderCache
 from importlib import import_module
 import mimetypes
 
@@ -28,46 +35,70 @@ template_engine = Engine(
     extensions=[CoreExtension()]
 )
 
+pages = RenderCache(template_engine)
+
+def create_static_files(config):
+    files = StaticCache(config.get('root', 'content'), check_interval=float(config.get('check_interval', 1.0)),
+                        mmap_threshold=int(config.get('mmap_threshold', 1024 * 1024)), max_age=int(config.get('max_age', 60)))
+    files.preload()
+    return files
+
+static_files = create_static_files(get_config().get('static', {}))
+
+pusher = Pusher(static_files, manifests(get_config().get('push', {})),
+                get_config().get('h2a', {}).get('push_cookie', None), int(get_config().get('h2a', {}).get('push_cookie_max_age', 86400)))
+
 def last_modified(path):
     return (b'last-modified', time.strftime("%a, %d %b %Y %H:%M:%S %Z", time.gmtime(os.path.getmtime(path))))
 
 def index(request, start_response):
-    template = template_engine.get_template('index.html')
-    if template:
-        _status = None
-        _headers = None
-
-        def local_start(status, headers):
-            nonlocal _status
-            nonlocal _headers
-            _status = status
-            _headers.extend(headers)
-
-        for path in []: # ['/static/app.js', '/static/app.css']:
-            _status = 404
-            _headers = copy(request.response['headers'])
-            request.match['filename'] = path
-            body = static_content(request, local_start)
-            request.push(path, status=_status, headers=_headers, body=body)
+    page = pages.get('index.html', lambda: {'backends': { k: v for k,v in get_config().items() if 'module' in v }})
+    if page:
         request._setup_session()
-        start_response(200, [(b'content-type', 'text/html'), (b'cache-control', b'public, must-revalidate, max-age=60')])
-        return template.render({'backends': { k: v for k,v in get_config().items() if 'module' in v }})
+        headers = [(b'content-type', 'text/html'), (b'cache-control', b'public, must-revalidate, max-age=60'), (b'etag', page.etag)]
+        if page.not_modified(request):
+            start_response(304, headers)
+            return None
+        headers.extend(pusher.push(request, 'index'))
+        start_response(200, headers)
+        return page.body
 
 def favicon(request, start_response):
     start_response(200, [(b'content-type', b'image-x-icon'), (b'cache-control', b'public, max-age=432000000'), last_modified(__file__)])
     return b64decode('iVBORw0KGgoAAAANSUhEUgAAABAAAAAQEAYAAABPYyMiAAAABmJLR0T///////8JWPfcAAAACXBIWXMAAABIAAAASABGyWs+AAAAF0lEQVRIx2NgGAWjYBSMglEwCkbBSAcACBAAAeaR9cIAAAAASUVORK5CYII=')
 
+def metrics_page(request, start_response):
+    start_response(200, [(b'content-type', metrics.CONTENT_TYPE), (b'cache-control', b'no-cache')])
+    return metrics.render()
+
+def slow_traces(request, start_response):
+    start_response(200, [(b'content-type', b'application/json'), (b'cache-control', b'no-cache')])
+    return json.dumps(tracer().slow_traces()).encode('utf-8')
+
+def admin_networks(config):
+    # The clients allowed to see the metrics and traces, none at all if empty
+    return [ipaddress.ip_network(network.strip()) for network in config.get('admin_networks', '127.0.0.0/8, ::1').split(',') if network.strip()]
+
+def admin(handler, networks):
+    def allowed(request, start_response):
+        try:
+            address = ipaddress.ip_address(request.client_address[0])
+        except ValueError:
+            address = None
+        if address is not None and address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if address is None or not any(address in network for network in networks):
+            start_response(403, [])
+            return None
+        return handler(request, start_response)
+    return allowed
 
 def not_found(request, start_response):
     start_response(404, [])
     return None
 
 def static_content(request, start_response):
-    local_path = "content%s" % request.match['filename']
-    mimetype, _ = mimetypes.guess_type(local_path)
-    start_response(200, [(b'content-type', mimetype), (b'cache-control', b'public, max-age=60'), last_modified(local_path)])
-    f = io.open(local_path, 'rb', io.DEFAULT_BUFFER_SIZE)
-    return f
+    return static_files.serve(request, start_response, request.match['filename'])
 
 class Request(nghttp2.BaseRequestHandler):
     def __init__(self, *args, **kwargs):
@@ -91,30 +122,35 @@ class Request(nghttp2.BaseRequestHandler):
 
 
 def generate_routes():
-    m = Mapper()
-    m.connect('/', handler=index)
-    m.connect('{filename:/static/.*?}', handler=static_content)
-    m.connect('/favicon.ico', handler=favicon)
+    router = Router(int(get_config().get('h2a', {}).get('route_cache', 1024)))
+    router.exact('/', index)
+    router.prefix('/static/', static_content, 'filename', keep_prefix=True)
+    router.exact('/favicon.ico', favicon)
+    networks = admin_networks(get_config().get('h2a', {}))
+    if networks:
+        router.exact('/metrics', admin(metrics_page, networks))
+        router.exact('/admin/traces', admin(slow_traces, networks))
     for (k, config) in get_config().items():
         config = deepcopy(config)
+        config['name'] = k
         backend_module = config.pop('module', None)
         if not backend_module is None:
             LOG.warn("Configuring %s", backend_module)
             module = import_module(backend_module)
             try:
                 backend = module.create(config)
+                relay.register(k, backend)
                 for method in [b'GET', b'PUT', b'POST', b'DELETE']:
                     try:
                         attr = getattr(backend, method.decode().lower())
-                        conditions = dict(method=[method])
-                        m.connect("/q/%s" % k, conditions=conditions, handler=attr)
-                        m.connect("/q/%s/?{subscription:.*?}" % k, conditions=conditions, handler=attr)
+                        router.exact("/q/%s" % k, attr, [method])
+                        router.prefix("/q/%s/" % k, attr, 'subscription', [method])
                     except AttributeError:
                         pass
-            except AttributeError as e:
+            except (AttributeError, ValueError) as e:
                 LOG.error("Could not create controller for %s: %s", k, backend_module)
                 LOG.error(e)
-    return m
+    return router
 
 routes = generate_routes()
 
@@ -137,6 +173,7 @@ class Session(Request):
                 return None
 
             config = deepcopy(config)
+            config['name'] = name
             backend_module = config.pop('module')
             try:
                 backend = getattr(sys.modules.get(backend_module, None), 'create')(config)
@@ -169,8 +206,7 @@ class Session(Request):
     def on_headers(self):
         self._setup_session()
         LOG.debug("{} {}".format(self.method, self.path))
-        self.match = routes.match(environ={'PATH_INFO': self.path.decode('utf-8'),
-                                           'REQUEST_METHOD': self.method})
+        self.match = routes.match(self.path.decode('utf-8'), self.method)
 
         if self.match:
             body = self.match['handler'](self, self.start_response)
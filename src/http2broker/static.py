@@ -0,0 +1,230 @@
+from email.utils import formatdate, parsedate_to_datetime
+from hashlib import sha1
+import gzip
+import logging
+import mimetypes
+import mmap
+import os
+import time
+import nghttp2
+from .headers import header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+LOG = logging.getLogger(__name__)
+
+# The files below content/static, held in memory with their compressed variants. A file gets checked
+# for changes at most every check_interval seconds, and then loaded again.
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'application/xml', 'image/svg+xml')
+
+# The encodings in order of preference, and the suffix of prebuilt files next to the original
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+class Reader(object):
+    # A body for nghttp2 reading a shared buffer, each request at its own offset
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._offset = 0
+
+    def __call__(self, n):
+        chunk = self._data[self._offset:self._offset + n]
+        self._offset += len(chunk)
+        if self._offset >= len(self._data):
+            return bytes(chunk), nghttp2.DATA_EOF
+        return bytes(chunk), nghttp2.DATA_OK
+
+
+class Variant(object):
+    __slots__ = ('data', 'etag', 'encoding')
+
+    def __init__(self, data, etag, encoding=None):
+        self.data = data
+        self.etag = etag
+        self.encoding = encoding
+
+
+class StaticFile(object):
+    def __init__(self, path, mtime, size, data, etag, content_type, variants):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.content_type = content_type
+        self.last_modified = formatdate(mtime, usegmt=True)
+        self.identity = Variant(data, '"{}"'.format(etag))
+        self.variants = variants
+        self.etags = frozenset([self.identity.etag] + [variant.etag for variant in variants.values()])
+        self.checked = time.monotonic()
+
+    def select(self, accept_encoding):
+        if self.variants and accept_encoding:
+            accepted = accepted_encodings(accept_encoding)
+            for encoding, _ in ENCODINGS:
+                if encoding in accepted and encoding in self.variants:
+                    return self.variants[encoding]
+        return self.identity
+
+    def not_modified(self, request):
+        # If-None-Match takes precedence, and compares weakly
+        if_none_match = header(request, b'if-none-match')
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.decode('latin-1').split(',')]
+            return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) in self.etags for tag in tags)
+
+        if_modified_since = header(request, b'if-modified-since')
+        if if_modified_since is not None:
+            try:
+                return int(self.mtime) <= parsedate_to_datetime(if_modified_since.decode('latin-1')).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+def accepted_encodings(accept_encoding):
+    accepted = set()
+    for item in accept_encoding.decode('latin-1').split(','):
+        coding, _, params = item.partition(';')
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticCache(object):
+    def __init__(self, root='content', prefix='/static/', check_interval=1.0, mmap_threshold=1024 * 1024, max_age=60, level=9):
+        self.root = os.path.abspath(root)
+        self.prefix = prefix
+        # Only files below it are served, e.g. content/static for /static/
+        self.directory = os.path.join(self.root, prefix.strip('/'))
+        self.check_interval = check_interval
+        self.mmap_threshold = mmap_threshold
+        self.max_age = max_age
+        self.level = level
+        self._files = {}
+
+    def preload(self):
+        directory = self.directory
+        for path, _, names in os.walk(directory):
+            for name in names:
+                if name.endswith(tuple(suffix for _, suffix in ENCODINGS)):
+                    continue
+                local_path = os.path.join(path, name)
+                self.get('/' + os.path.relpath(local_path, self.root).replace(os.sep, '/'))
+        LOG.debug("Loaded %d static files from %s", len(self._files), directory)
+
+    def _local_path(self, filename):
+        # The path resolved, so '..' cannot leave the directory of the prefix
+        local_path = os.path.abspath(os.path.join(self.root, filename.lstrip('/')))
+        if not local_path.startswith(self.directory + os.sep):
+            return None
+        return local_path
+
+    def get(self, filename):
+        entry = self._files.get(filename, None)
+        now = time.monotonic()
+        if entry is not None and now - entry.checked < self.check_interval:
+            return entry
+
+        local_path = self._local_path(filename)
+        if local_path is None:
+            return None
+        # Cached by the resolved name, so other spellings of a path do not add entries
+        filename = '/' + os.path.relpath(local_path, self.root).replace(os.sep, '/')
+        entry = self._files.get(filename, None)
+        try:
+            stat = os.stat(local_path)
+        except OSError:
+            self._files.pop(filename, None)
+            return None
+
+        if entry is not None and entry.mtime == stat.st_mtime and entry.size == stat.st_size:
+            entry.checked = now
+            return entry
+
+        try:
+            entry = self._files[filename] = self._load(local_path, stat)
+        except OSError as e:
+            LOG.error("Could not load %s: %s", local_path, e)
+            self._files.pop(filename, None)
+            return None
+        return entry
+
+    def _read(self, local_path, size):
+        with open(local_path, 'rb') as f:
+            if size >= self.mmap_threshold:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return f.read()
+
+    def _load(self, local_path, stat):
+        LOG.debug("Loading %s", local_path)
+        data = self._read(local_path, stat.st_size)
+        content_type, _ = mimetypes.guess_type(local_path)
+        content_type = content_type or 'application/octet-stream'
+        etag = sha1(data).hexdigest()
+
+        variants = {}
+        if content_type.startswith(COMPRESSIBLE) and stat.st_size > 0:
+            for encoding, suffix in ENCODINGS:
+                encoded = self._prebuilt(local_path + suffix, stat.st_mtime)
+                if encoded is None:
+                    encoded = self._compress(encoding, data)
+                if encoded is not None and len(encoded) < stat.st_size:
+                    variants[encoding] = Variant(encoded, '"{}-{}"'.format(etag, encoding), encoding)
+        return StaticFile(local_path, stat.st_mtime, stat.st_size, data, etag, content_type, variants)
+
+    def _prebuilt(self, path, mtime):
+        # Only as long as it is not older than the original
+        try:
+            if os.stat(path).st_mtime >= mtime:
+                with open(path, 'rb') as f:
+                    return f.read()
+        except OSError:
+            pass
+        return None
+
+    def _compress(self, encoding, data):
+        if encoding == 'gzip':
+            return gzip.compress(data, self.level)
+        if encoding == 'br' and brotli is not None:
+            return brotli.compress(bytes(data))
+        return None
+
+    def body(self, data):
+        if len(data) >= self.mmap_threshold:
+            return Reader(data)
+        return data
+
+    def response(self, request, filename, conditional=True):
+        # Status, headers and body for the file, the variant chosen by the Accept-Encoding of the request
+        entry = self.get(filename)
+        if entry is None:
+            return 404, [], None
+
+        variant = entry.select(header(request, b'accept-encoding'))
+        headers = [(b'etag', variant.etag), (b'last-modified', entry.last_modified),
+                   (b'cache-control', 'public, max-age={}'.format(self.max_age))]
+        if entry.variants:
+            headers.append((b'vary', b'accept-encoding'))
+
+        if conditional and entry.not_modified(request):
+            return 304, headers, None
+
+        headers.append((b'content-type', entry.content_type))
+        headers.append((b'content-length', str(len(variant.data))))
+        if variant.encoding is not None:
+            headers.append((b'content-encoding', variant.encoding))
+        return 200, headers, self.body(variant.data)
+
+    def serve(self, request, start_response, filename):
+        status, headers, body = self.response(request, filename)
+        start_response(status, headers)
+        return body
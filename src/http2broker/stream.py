@@ -0,0 +1,402 @@
+from base64 import b64encode
+from collections import deque
+from itertools import count
+import asyncio
+import json
+import logging
+import struct
+import time
+import nghttp2
+from . import metrics
+from .config import get_config
+from .trace import tracer
+
+LOG = logging.getLogger(__name__)
+
+OVERFLOW_POLICIES = ('pause', 'drop_oldest', 'drop_newest', 'close')
+
+# Messages waiting in a stream buffer
+DEPTH_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+BUDGET = [None]
+
+# Message ids: a counter starting from the time in microseconds, so it keeps increasing across restarts, with the
+# index of the worker in the lowest WORKER_BITS, so no two workers hand out the same one. See seed_ids.
+WORKER_BITS = 10
+IDS = [None]
+
+
+class Budget(object):
+    # The memory all stream buffers of the process may hold together
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = metrics.gauge('h2a_buffered_bytes', 'Bytes of broker messages held in stream buffers')
+
+    @property
+    def exhausted(self):
+        return self.limit > 0 and self.used.value >= self.limit
+
+
+def budget():
+    if BUDGET[0] is None:
+        BUDGET[0] = Budget(int(get_config().get('h2a', {}).get('buffer_budget', 256 * 1024 * 1024)))
+    return BUDGET[0]
+
+
+def seed_ids(worker=0):
+    # Called by each worker after the fork, as a counter inherited from the supervisor would be the same in all of them
+    step = 1 << WORKER_BITS
+    IDS[0] = count(int(time.time() * 1000000) * step + worker % step, step)
+
+
+def next_id():
+    if IDS[0] is None:
+        seed_ids()
+    return next(IDS[0])
+
+
+class Frame(object):
+    # A broker message as handed to the subscriptions. It is shared by all streams it is fanned out to,
+    # so it gets encoded only once per serialiser, and the encoded bytes are dropped after the last stream sent them.
+    # done, if given, gets called with the frame once no stream holds it anymore. The timestamp is the one of the broker,
+    # if it has any, or else the time the message arrived. Frames relayed from another worker keep its id and timestamp.
+    # trace is set for messages sampled for tracing.
+    __slots__ = ('topic', 'payload', 'size', 'message', 'done', 'id', 'timestamp', 'trace', '_encoded', '_refs')
+
+    def __init__(self, topic, payload, message=None, done=None, timestamp=None, id=None):
+        self.topic = topic
+        self.payload = payload
+        self.size = len(payload)
+        self.message = message
+        self.done = done
+        self.id = next_id() if id is None else id
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.trace = tracer().sample(topic)
+        self._encoded = None
+        self._refs = 0
+
+    @property
+    def retained(self):
+        return self._refs > 0
+
+    def retain(self):
+        if self._refs == 0:
+            budget().used.inc(self.size)
+        self._refs += 1
+
+    def release(self):
+        self._refs -= 1
+        if self._refs <= 0:
+            self._encoded = None
+            budget().used.dec(self.size)
+            self.finish()
+            return True
+        return False
+
+    def finish(self):
+        # done is called once at most, though a frame replayed from a ring gets retained and released again
+        done, self.done = self.done, None
+        if done is not None:
+            done(self)
+
+    def encode(self, serialiser):
+        if self._encoded is None:
+            data = bytes(serialiser.serialise(self))
+            if self._refs > 1:
+                self._encoded = {serialiser: data}
+            return data
+
+        try:
+            return self._encoded[serialiser]
+        except KeyError:
+            data = self._encoded[serialiser] = bytes(serialiser.serialise(self))
+            return data
+
+
+class FlushScheduler(object):
+    # Collects the streams which got data while deferred, and resumes each of them once per loop iteration,
+    # instead of once per message
+    def __init__(self):
+        self._dirty = []
+        self._loop = None
+
+    def mark(self, stream):
+        if not self._dirty:
+            if self._loop is None:
+                self._loop = asyncio.get_event_loop()
+            self._loop.call_soon(self._flush)
+        self._dirty.append(stream)
+
+    def _flush(self):
+        dirty, self._dirty = self._dirty, []
+        for stream in dirty:
+            if not stream.closed:
+                if stream.traced:
+                    stream.stamp('resumed')
+                stream.request.resume()
+
+
+flush_scheduler = FlushScheduler()
+
+
+class Buffering(object):
+    # The per stream limits of a backend, and what to do with a message arriving at a full buffer:
+    #  drop_oldest  make room by discarding the oldest buffered message, the default
+    #  drop_newest  discard the arriving message
+    #  close        end the stream, the client has to reconnect
+    #  pause        keep it, but stop reading from the broker until the stream drained half of its buffer. All streams
+    #               of the backend share the upstream, so one client not reading holds back every other one: only
+    #               for trusted consumers.
+    def __init__(self, config, pausable=True):
+        self.messages = int(config.get('buffer_messages', 1024))
+        self.bytes = int(config.get('buffer_bytes', 1024 * 1024))
+        policy = config.get('overflow', 'drop_oldest')
+        if policy not in OVERFLOW_POLICIES:
+            LOG.error("Unknown overflow policy '%s', using 'drop_oldest'", policy)
+            policy = 'drop_oldest'
+        if policy == 'pause' and not pausable:
+            LOG.warning("Cannot pause %s, using 'drop_newest'", config.get('name', 'backend'))
+            policy = 'drop_newest'
+        self.policy = policy
+        name = self.name = config.get('name', '')
+        self.overflows = { policy: metrics.counter('h2a_buffer_overflow_total', 'Messages arriving at a full stream buffer',
+                                                   backend=name, policy=policy)
+                           for policy in OVERFLOW_POLICIES }
+        # The streams of a backend all count into the same metrics
+        self.subscribers = metrics.gauge('h2a_subscribers', 'Open subscribing streams', backend=name)
+        self.depth = metrics.histogram('h2a_buffer_depth', 'Messages buffered in a stream when nghttp2 asks for data',
+                                       DEPTH_BUCKETS, backend=name)
+        self.delivery = metrics.histogram('h2a_delivery_seconds', 'Time from a message arriving until it is sent to the client',
+                                          backend=name)
+        self.written_frames = metrics.counter('h2a_written_frames_total', 'Messages sent to clients', backend=name)
+        self.written_bytes = metrics.counter('h2a_written_bytes_total', 'Bytes of messages sent to clients', backend=name)
+
+
+class FlowControl(object):
+    # Keeps the upstream of a backend paused as long as any of its streams is full
+    def __init__(self, pause, resume, name=''):
+        self._streams = set()
+        self._pause = pause
+        self._resume = resume
+        self.pauses = metrics.counter('h2a_upstream_pauses_total', 'Times reading from the broker got paused', backend=name)
+
+    @property
+    def paused(self):
+        return len(self._streams) > 0
+
+    def pause(self, stream):
+        if not self._streams:
+            self.pauses.inc()
+            self._pause()
+        self._streams.add(stream)
+
+    def resume(self, stream):
+        if stream in self._streams:
+            self._streams.discard(stream)
+            if not self._streams:
+                self._resume()
+
+
+class Stream(object):
+    # The body of a subscribing request: buffers the frames for the client until nghttp2 asks for data
+    def __init__(self, request, serialiser, buffering, flow=None):
+        self.request = request
+        self.serialiser = serialiser
+        self.request.eof = False
+        self.buf = deque()
+        self.buffered = 0
+        self.paused = False
+        self.deferred = False
+        self.closed = False
+        self._pending = None
+        self._buffering = buffering
+        self._flow = flow
+        # Sampled frames in buf
+        self.traced = 0
+        buffering.subscribers.inc()
+
+    def __call__(self, n):
+        # Packs as many messages as nghttp2 takes into one DATA frame. A message not fitting anymore
+        # is kept for the next frame, and only one larger than a whole frame gets split.
+        buffering = self._buffering
+        if self.buf:
+            buffering.depth.observe(len(self.buf))
+        chunks = []
+        size = 0
+        frames = 0
+        now = None
+        pending = self._pending
+        while size < n:
+            if pending is None:
+                if not self.buf:
+                    break
+                frame = self._popleft()
+                trace = frame.trace
+                if trace is not None:
+                    trace.stamp(self, 'pulled')
+                pending = frame.encode(self.serialiser)
+                if trace is not None:
+                    trace.stamp(self, 'serialised')
+                    trace.finish(self, buffering.name)
+                frame.release()
+                if now is None:
+                    now = time.time()
+                buffering.delivery.observe(now - frame.timestamp)
+                frames += 1
+
+            room = n - size
+            if len(pending) > room:
+                if not chunks:
+                    pending = memoryview(pending)
+                    chunks.append(pending[:room])
+                    pending = pending[room:]
+                break
+
+            chunks.append(pending)
+            size += len(pending)
+            pending = None
+        self._pending = pending
+        buffering.written_frames.inc(frames)
+
+        if not chunks:
+            if self.request.eof:
+                return None, nghttp2.DATA_EOF
+            self.deferred = True
+            return None, nghttp2.DATA_DEFERRED
+
+        data = chunks[0] if len(chunks) == 1 and isinstance(chunks[0], bytes) else b''.join(chunks)
+        buffering.written_bytes.inc(len(data))
+        if self.request.eof and pending is None and not self.buf:
+            return data, nghttp2.DATA_EOF
+        return data, nghttp2.DATA_OK
+
+    def _popleft(self):
+        frame = self.buf.popleft()
+        self.buffered -= frame.size
+        if frame.trace is not None:
+            self.traced -= 1
+        if self.paused and len(self.buf) <= self._buffering.messages // 2 and self.buffered <= self._buffering.bytes // 2:
+            self.paused = False
+            self._flow.resume(self)
+        return frame
+
+    def consume(self, frame):
+        if self.request.eof:
+            return
+
+        buffering = self._buffering
+        if len(self.buf) >= buffering.messages or self.buffered + frame.size > buffering.bytes or budget().exhausted:
+            if not self._overflow(frame):
+                return
+
+        frame.retain()
+        self.buf.append(frame)
+        self.buffered += frame.size
+        if frame.trace is not None:
+            self.traced += 1
+            frame.trace.stamp(self, 'buffered')
+        self._wakeup()
+
+    def stamp(self, stage):
+        for frame in self.buf:
+            if frame.trace is not None:
+                frame.trace.stamp(self, stage)
+
+    def _wakeup(self):
+        if self.deferred:
+            self.deferred = False
+            flush_scheduler.mark(self)
+
+    def _overflow(self, frame):
+        policy = self._buffering.policy
+        self._buffering.overflows[policy].inc()
+        if policy == 'drop_newest':
+            return False
+        elif policy == 'drop_oldest':
+            if self.buf:
+                self._popleft().release()
+            return True
+        elif policy == 'close':
+            # A message written in part is finished first, so the client does not get half of it
+            self._discard()
+            self.request.eof = True
+            self._wakeup()
+            return False
+        else:
+            # The message is kept, but the broker has to hold back any further ones
+            if not self.paused:
+                self.paused = True
+                self._flow.pause(self)
+            return True
+
+    def _discard(self):
+        while self.buf:
+            self.buf.popleft().release()
+        self.buffered = 0
+        self.traced = 0
+
+    def close(self):
+        if not self.closed:
+            self._buffering.subscribers.dec()
+        self.closed = True
+        self._discard()
+        self._pending = None
+        if self.paused:
+            self.paused = False
+            self._flow.resume(self)
+
+
+class Serialiser(object):
+    pass
+
+
+class TextEventStream(Serialiser):
+    @staticmethod
+    def content_type():
+        return 'text/event-stream'
+
+    @staticmethod
+    def serialise(frame):
+        return b''.join([b'id: ', str(frame.id).encode('ascii'), b'\ndata: ', b'\ndata: '.join(frame.payload.splitlines()), b'\n\n'])
+
+
+class PlainTextStream(Serialiser):
+    @staticmethod
+    def content_type():
+        return 'text/plain'
+
+    @staticmethod
+    def serialise(frame):
+        return b''.join([frame.payload, b"\n"])
+
+
+class NDJSONStream(Serialiser):
+    # The same records a batch publish takes: {"k": "<topic>", "v": "<text>"}, or "b64" for payloads not being utf-8
+    @staticmethod
+    def content_type():
+        return 'application/x-ndjson'
+
+    @staticmethod
+    def serialise(frame):
+        try:
+            record = {'k': frame.topic, 'v': bytes(frame.payload).decode('utf-8')}
+        except UnicodeDecodeError:
+            record = {'k': frame.topic, 'b64': b64encode(frame.payload).decode('ascii')}
+        return b''.join([json.dumps(record, separators=(',', ':')).encode('utf-8'), b'\n'])
+
+
+class BinaryStream(Serialiser):
+    # Length prefixed frames without any text parsing, all numbers big-endian:
+    #  u32 length of the rest of the frame, u64 message id, u64 timestamp in microseconds since the epoch,
+    #  u16 topic length, the utf-8 topic, and the payload taking up the rest
+    HEADER = struct.Struct('!IQQH')
+
+    @staticmethod
+    def content_type():
+        return 'application/x-h2a-frames'
+
+    @staticmethod
+    def serialise(frame):
+        topic = frame.topic.encode('utf-8')
+        length = BinaryStream.HEADER.size - 4 + len(topic) + len(frame.payload)
+        return b''.join([BinaryStream.HEADER.pack(length, frame.id, int(frame.timestamp * 1000000), len(topic)), topic, frame.payload])
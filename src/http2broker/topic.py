@@ -0,0 +1,163 @@
+import logging
+
+LOG = logging.getLogger(__name__)
+
+
+class _Node(object):
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = {}
+        self.values = set()
+
+
+class TopicTrie(object):
+    # Matches concrete topics against the wildcard patterns produced by the backends' _topic_translation:
+    #  amqp  '.' separated, '*' one word, '#' zero or more words
+    #  mqtt  '.' separated, '+' one level, '#' zero or more levels
+    #  nats  '.' separated, '*' one token, '>' one or more tokens
+    #  redis ':' separated, '*' anything
+    def __init__(self, separator='.', single='*', multi='#', multi_empty=True):
+        self._separator = separator
+        self._single = single
+        self._multi = multi
+        self._multi_empty = multi_empty
+        self._root = _Node()
+
+    def _split(self, key):
+        return key.split(self._separator) if key else []
+
+    def add(self, pattern, value):
+        node = self._root
+        for word in self._split(pattern):
+            node = node.children.setdefault(word, _Node())
+        node.values.add(value)
+
+    def remove(self, pattern, value):
+        path = [self._root]
+        words = self._split(pattern)
+        for word in words:
+            node = path[-1].children.get(word, None)
+            if node is None:
+                return
+            path.append(node)
+
+        path[-1].values.discard(value)
+        # Prune empty branches, so the trie does not grow with every pattern ever seen
+        for depth in range(len(words), 0, -1):
+            node = path[depth]
+            if node.values or node.children:
+                break
+            del path[depth - 1].children[words[depth - 1]]
+
+    def get(self, pattern):
+        node = self._root
+        for word in self._split(pattern):
+            node = node.children.get(word, None)
+            if node is None:
+                return set()
+        return node.values
+
+    def match(self, topic):
+        out = set()
+        self._match(self._root, self._split(topic), 0, out)
+        return out
+
+    def _match(self, node, words, i, out):
+        multi = node.children.get(self._multi, None) if self._multi else None
+        if multi is not None:
+            for j in range(i if self._multi_empty else i + 1, len(words) + 1):
+                self._match(multi, words, j, out)
+
+        if i == len(words):
+            out.update(node.values)
+            return
+
+        child = node.children.get(words[i], None)
+        if child is not None:
+            self._match(child, words, i + 1, out)
+
+        if self._single and words[i] != self._single:
+            child = node.children.get(self._single, None)
+            if child is not None:
+                self._match(child, words, i + 1, out)
+
+
+class Broadcast(object):
+    # Every pattern matches every topic, like the bindings of an AMQP fanout exchange
+    def __init__(self):
+        self._values = set()
+
+    def add(self, pattern, value):
+        self._values.add(value)
+
+    def remove(self, pattern, value):
+        self._values.discard(value)
+
+    def match(self, topic):
+        return set(self._values)
+
+
+class Fanout(object):
+    # Reference counts the local sinks per pattern, so a backend needs only one upstream
+    # subscription per distinct pattern, and dispatches incoming messages to all of them.
+    # Only the patterns subscribed at the broker (own) are matched by publish, those relayed by another worker
+    # get their messages through deliver.
+    def __init__(self, trie):
+        self._trie = trie
+        self._patterns = {}
+
+    def __contains__(self, pattern):
+        return pattern in self._patterns
+
+    def __len__(self):
+        return len(self._patterns)
+
+    @property
+    def patterns(self):
+        return self._patterns.keys()
+
+    def sinks(self, pattern):
+        return self._patterns.get(pattern, ())
+
+    def add(self, pattern, sink):
+        sinks = self._patterns.setdefault(pattern, set())
+        first = len(sinks) == 0
+        sinks.add(sink)
+        return first
+
+    def discard(self, pattern, sink):
+        sinks = self._patterns.get(pattern, None)
+        if sinks is None or sink not in sinks:
+            return False
+        sinks.discard(sink)
+        if sinks:
+            return False
+        del self._patterns[pattern]
+        return True
+
+    def own(self, pattern):
+        self._trie.add(pattern, pattern)
+
+    def disown(self, pattern):
+        self._trie.remove(pattern, pattern)
+
+    def match(self, topic):
+        # The owned patterns matching topic
+        return self._trie.match(topic)
+
+    def publish(self, topic, message):
+        # For brokers delivering a message once, regardless of how many patterns matched
+        sinks = set()
+        for pattern in self._trie.match(topic):
+            sinks.update(self._patterns.get(pattern, ()))
+        for sink in sinks:
+            sink(message)
+        return len(sinks)
+
+    def deliver(self, pattern, message):
+        # For brokers delivering a message once per matching upstream subscription
+        sinks = tuple(self._patterns.get(pattern, ()))
+        for sink in sinks:
+            sink(message)
+        return len(sinks)
@@ -0,0 +1,77 @@
+from collections import deque
+import logging
+import time
+from . import metrics
+from .config import get_config
+
+LOG = logging.getLogger(__name__)
+
+# The stages of a message on its way to a client, in order:
+#  received    the frame got created from the broker message
+#  buffered    a stream appended it to its buffer
+#  resumed     the stream, deferred until then, got resumed for it
+#  pulled      nghttp2 asked the stream for data, as far as flow control allowed, and got the frame
+#  serialised  it got encoded for the client
+STAGES = ('received', 'buffered', 'resumed', 'pulled', 'serialised')
+
+TRACER = [None]
+
+
+class Trace(object):
+    # The monotonic stage times of one sampled message, per stream it is fanned out to
+    __slots__ = ('tracer', 'topic', 'received', 'streams')
+
+    def __init__(self, tracer, topic):
+        self.tracer = tracer
+        self.topic = topic
+        self.received = time.monotonic()
+        self.streams = {}
+
+    def stamp(self, stream, stage):
+        self.streams.setdefault(stream, []).append((stage, time.monotonic()))
+
+    def finish(self, stream, backend):
+        self.tracer.finish(self, self.streams.pop(stream, []), backend)
+
+
+class Tracer(object):
+    # Traces one in every messages, 0 for none. The stage latencies go into histograms per backend, and traces taking
+    # longer than slow seconds in total are kept in a ring of the last ring ones.
+    def __init__(self, every=0, slow=0.05, ring=256):
+        self.every = every
+        self.slow = slow
+        self.traces = deque(maxlen=ring)
+        self._countdown = every
+
+    def sample(self, topic):
+        if not self.every:
+            return None
+        self._countdown -= 1
+        if self._countdown > 0:
+            return None
+        self._countdown = self.every
+        return Trace(self, topic)
+
+    def finish(self, trace, stamps, backend):
+        previous = trace.received
+        for stage, stamp in stamps:
+            metrics.histogram('h2a_trace_stage_seconds', 'Time a sampled message took to reach a stage from the one before',
+                              backend=backend, stage=stage).observe(stamp - previous)
+            previous = stamp
+        total = previous - trace.received
+        metrics.histogram('h2a_trace_seconds', 'Time a sampled message took from its arrival until it got serialised',
+                          backend=backend).observe(total)
+        if total >= self.slow:
+            self.traces.append({'time': time.time(), 'backend': backend, 'topic': trace.topic, 'total': total,
+                                'stages': [[stage, stamp - trace.received] for stage, stamp in stamps]})
+
+    def slow_traces(self):
+        return list(self.traces)
+
+
+def tracer():
+    if TRACER[0] is None:
+        config = get_config().get('h2a', {})
+        TRACER[0] = Tracer(int(config.get('trace_sample', 0)), float(config.get('trace_slow', 0.05)),
+                           int(config.get('trace_ring', 256)))
+    return TRACER[0]
@@ -0,0 +1,86 @@
+from functools import partial
+import logging
+import os
+import signal
+import time
+
+LOG = logging.getLogger(__name__)
+
+# Workers restarted sooner than this after their start get delayed, so a broken setup does not fork in a tight loop
+MIN_LIFETIME = 1.0
+
+
+def reuse_port(loop):
+    # nghttp2.HTTP2Server binds through loop.create_server, with SO_REUSEPORT every worker can bind the same port
+    # and the kernel spreads the connections over them
+    loop.create_server = partial(loop.create_server, reuse_port=True)
+
+
+class Supervisor(object):
+    # Forks the worker processes, and restarts any of them that dies, until it gets terminated itself
+    def __init__(self, workers, target):
+        self.workers = workers
+        self._target = target
+        self._pids = {}
+        self._started = {}
+        self._stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._forward)
+        for index in range(self.workers):
+            self._spawn(index)
+
+        while self._pids:
+            try:
+                pid, status = os.wait()
+            except InterruptedError:
+                continue
+            except ChildProcessError:
+                break
+
+            index = self._pids.pop(pid, None)
+            if index is None or self._stopping:
+                continue
+
+            if os.WIFSIGNALED(status):
+                LOG.warning("Worker %d (pid %d) killed by signal %d, restarting", index, pid, os.WTERMSIG(status))
+            else:
+                LOG.warning("Worker %d (pid %d) exited with status %d, restarting", index, pid, os.WEXITSTATUS(status))
+            if time.monotonic() - self._started[index] < MIN_LIFETIME:
+                time.sleep(MIN_LIFETIME)
+            if not self._stopping:
+                self._spawn(index)
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_DFL)
+            code = 0
+            try:
+                self._target(index)
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 1
+            except Exception:
+                LOG.exception("Worker %d failed", index)
+                code = 1
+            finally:
+                os._exit(code)
+
+        LOG.debug("Started worker %d (pid %d)", index, pid)
+        self._pids[pid] = index
+        self._started[index] = time.monotonic()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        self._forward(signum, frame)
+
+    def _forward(self, signum, frame):
+        for pid in list(self._pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,44 @@
+# Run from the top of the repository with: python3 -m unittest discover -s tests -t .
+# so this package gets imported first, and puts src and bench on the path
+import asyncio
+import os
+import socket
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [os.path.join(ROOT, 'src'), os.path.join(ROOT, 'bench')]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def until(condition, timeout=5.0):
+    # Runs the loop until condition() holds, or fails after timeout seconds
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError('Timed out waiting for {}'.format(condition))
+        loop.run_until_complete(asyncio.sleep(0.01))
+
+
+class Collector(object):
+    # A sink keeping the frames it gets. Sinks are held in sets, so unlike list.append, it has to be hashable.
+    def __init__(self):
+        self.frames = []
+
+    def __call__(self, frame):
+        self.frames.append(frame)
+
+    @property
+    def payloads(self):
+        return [frame.payload for frame in self.frames]
+
+
+def drop_connections(broker):
+    # Closes all connections of a stand-in, as a broker restart would
+    for connection in list(broker.connections):
+        connection.transport.close()
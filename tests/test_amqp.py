@@ -0,0 +1,103 @@
+import asyncio
+import unittest
+import brokers
+from http2broker.backend import amqp
+from . import free_port, until, drop_connections, Collector
+
+
+class Sender(object):
+    def __init__(self):
+        self.acks = []
+
+    def send_method(self, method):
+        self.acks.append((method.delivery_tag, bool(method.multiple)))
+
+
+class Message(object):
+    def __init__(self, delivery_tag, sender):
+        self.delivery_tag = delivery_tag
+        self.sender = sender
+
+
+class AcknowledgementTest(unittest.TestCase):
+    def setUp(self):
+        self.controller = amqp.create({'name': 'amqp', 'host': '127.0.0.1', 'username': 'guest', 'password': 'guest',
+                                       'virtual_host': '/', 'overflow': 'pause'})
+        self.adapter = self.controller.adapter
+        self.sender = self.adapter._sender = Sender()
+        self.adapter._outstanding.extend([1, 2, 3])
+
+    def frame(self, tag):
+        return self.controller.frame('a.b', b'', Message(tag, self.sender))
+
+    def test_replayed(self):
+        # A frame replayed from the ring is retained and released again, but acknowledged once
+        frames = [self.frame(2), self.frame(3)]
+        for i in range(2):
+            for frame in frames:
+                frame.retain()
+                frame.release()
+            self.controller._acks.flush()
+        self.assertEqual(self.sender.acks, [(2, False), (3, False)])
+
+    def test_acknowledged_twice(self):
+        self.adapter.ack_many([self.frame(2)])
+        self.adapter.ack_many([self.frame(2)])
+        self.adapter.ack_many([self.frame(1), self.frame(1)])
+        self.assertEqual(self.sender.acks, [(2, False), (1, True)])
+
+
+class Request(object):
+    headers = []
+
+
+class ConnectionTest(unittest.TestCase):
+    # Against the stand-in broker, started only after the backend was first used
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.port = free_port()
+        self.controller = amqp.create({'name': 'amqp', 'host': '127.0.0.1', 'port': str(self.port), 'username': 'guest',
+                                       'password': 'guest', 'virtual_host': '/', 'exchange_name': 'test', 'reconnect_wait': '0.2'})
+        self.adapter = self.controller.adapter
+        self.server = None
+
+    def tearDown(self):
+        # Not connecting again once the connection got closed
+        self.adapter._attempt += 1
+        self.adapter._setup.cancel()
+        if self.adapter._connection is not None:
+            self.adapter._connection.protocol.transport.close()
+        if self.server is not None:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+
+    def publish(self, payload):
+        self.loop.run_until_complete(self.adapter.publish('a.b', payload, Request))
+
+    def test_reconnect(self):
+        messages = Collector()
+        self.controller.subscribe('a.b', messages)
+        with self.assertRaises(ConnectionError):
+            self.publish(b'lost')
+        broker, self.server = self.loop.run_until_complete(brokers.start('amqp', port=self.port))
+        until(lambda: self.adapter._ready.is_set() and self.adapter._queue is not None and self.adapter._queue.done())
+        self.publish(b'one')
+        until(lambda: messages.payloads == [b'one'])
+
+        drop_connections(broker)
+        until(lambda: self.adapter.reconnects.value == 1)
+        until(lambda: self.adapter._ready.is_set() and all(binding.done() for binding in self.adapter._bindings.values()))
+        self.publish(b'two')
+        until(lambda: messages.payloads == [b'one', b'two'])
+
+
+class PublishKeyTest(unittest.TestCase):
+    def test_routing_key(self):
+        # The option of the AMQP backend before it moved to core.py
+        controller = amqp.create({'name': 'amqp', 'host': '127.0.0.1', 'username': 'guest', 'password': 'guest',
+                                  'virtual_host': '/', 'routing_key': 'fixed/key'})
+        self.assertEqual(controller.topic('a/b'), 'fixed.key')
+
+
+if __name__ == '__main__':
+    unittest.main()
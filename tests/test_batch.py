@@ -0,0 +1,58 @@
+import struct
+import unittest
+from http2broker import batch
+
+
+def record(key, payload):
+    key = key.encode('utf-8')
+    return struct.pack('!H', len(key)) + key + struct.pack('!I', len(payload)) + payload
+
+
+class NDJSONTest(unittest.TestCase):
+    def test_records(self):
+        records = batch.parse_ndjson(b'{"k": "a/b", "v": "one"}\n\n{"k": "c", "b64": "AAE="}\r\n{"k": 5, "v": "\xc3\xa4"}\n')
+        self.assertEqual(records, [('a/b', b'one', None), ('c', b'\x00\x01', None), ('5', b'\xc3\xa4', None)])
+
+    def test_invalid(self):
+        # Each line on its own, so the others still get published
+        records = batch.parse_ndjson(b'not json\n{"v": "no key"}\n{"k": "a", "v": 1}\n{"k": "a", "b64": "abc"}\n[]\n{"k": "b", "v": "ok"}')
+        self.assertEqual([record.key for record in records], [None] * 5 + ['b'])
+        self.assertTrue(all(record.error is not None for record in records[:5]))
+        self.assertIsNone(records[5].error)
+
+
+class LengthPrefixedTest(unittest.TestCase):
+    def test_records(self):
+        records = batch.parse_length_prefixed(record('a/b', b'one') + record('', b'') + record('c', b'\n' * 3))
+        self.assertEqual(records, [('a/b', b'one', None), ('', b'', None), ('c', b'\n\n\n', None)])
+
+    def test_truncated(self):
+        body = record('a', b'one') + record('b', b'two')
+        for end in (len(body) - 1, len(body) - 5, len(record('a', b'one')) + 1):
+            records = batch.parse_length_prefixed(body[:end])
+            self.assertEqual(records[0], ('a', b'one', None))
+            self.assertEqual(len(records), 2)
+            self.assertIsInstance(records[1].error, ValueError)
+
+    def test_invalid_key(self):
+        records = batch.parse_length_prefixed(struct.pack('!H', 1) + b'\xff' + struct.pack('!I', 0) + record('a', b''))
+        self.assertIsNotNone(records[0].error)
+        self.assertEqual(records[1], ('a', b'', None))
+
+
+class ParserTest(unittest.TestCase):
+    def test_content_type(self):
+        self.assertIs(batch.parser(b'application/x-ndjson'), batch.parse_ndjson)
+        self.assertIs(batch.parser(b'Application/X-H2A-Batch; charset=binary'), batch.parse_length_prefixed)
+        self.assertIsNone(batch.parser(b'text/plain'))
+        self.assertIsNone(batch.parser(None))
+
+    def test_results(self):
+        # The errors of the published records, merged back with those which could not be parsed
+        records = [batch.Record('a', b'', None), batch.Record(None, None, ValueError('bad')), batch.Record('b', b'', None)]
+        self.assertEqual(batch.results(records, [None, OSError('down')]),
+                         [{'k': 'a', 's': 200}, {'k': None, 's': 400, 'e': 'bad'}, {'k': 'b', 's': 500, 'e': 'down'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import asyncio
+import unittest
+import brokers
+from http2broker.backend import mqtt
+from http2broker.protocol.mqtt import Client, Protocol, packet, encode_string, MQTT_5, PUBLISH
+from . import until, drop_connections, Collector
+
+
+class Withholding(brokers.MQTTProtocol):
+    # Drops the connection instead of acknowledging the first QoS 1 publish, and records the flags of all of them
+    publishes = []
+
+    def packet(self, kind, flags, body):
+        if kind == PUBLISH and flags & 0x06:
+            Withholding.publishes.append(flags)
+            if len(Withholding.publishes) == 1:
+                self.transport.close()
+                return
+        super().packet(kind, flags, body)
+
+
+class MQTTClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.broker, self.server = self.loop.run_until_complete(brokers.start('mqtt', port=0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    def client(self, client_id, **kwargs):
+        client = Client('127.0.0.1', self.port, client_id, keepalive=5, **kwargs)
+        client.start()
+        self.clients.append(client)
+        until(lambda: client.connected)
+        return client
+
+    def test_split_packets(self):
+        # Packets arriving a byte at a time, a large one with a multi byte remaining length
+        messages = []
+        client = Client('127.0.0.1', self.port, 'split')
+        client.on_message = messages.append
+        protocol = Protocol(client)
+        client._protocol = protocol
+        large = bytes(range(256)) * 64
+        data = b''.join([packet(PUBLISH, 0, encode_string('a/b'), b'one'),
+                         packet(PUBLISH, 0, encode_string('a/c'), large),
+                         packet(PUBLISH, 0x01, encode_string('a/d'), b'')])
+        for i in range(len(data)):
+            protocol.data_received(data[i:i + 1])
+        self.assertEqual([(message.topic, message.payload, message.retain) for message in messages],
+                         [('a/b', b'one', False), ('a/c', large, False), ('a/d', b'', True)])
+
+    def test_split_packets_5(self):
+        # With MQTT 5, the properties of a PUBLISH are skipped and the subscription identifiers kept
+        messages = []
+        client = Client('127.0.0.1', self.port, 'split', version=MQTT_5)
+        client.on_message = messages.append
+        protocol = Protocol(client)
+        client._protocol = protocol
+        properties = b'\x01\x01' + b'\x0b\x81\x01' + b'\x03' + encode_string('text/plain') + b'\x0b\x02'
+        data = packet(PUBLISH, 0, encode_string('a/b'), bytes([len(properties)]), properties, b'one')
+        for i in range(len(data)):
+            protocol.data_received(data[i:i + 1])
+        self.assertEqual([(message.topic, message.payload, message.subscriptions) for message in messages],
+                         [('a/b', b'one', (129, 2))])
+
+    def test_reconnect_resubscribes(self):
+        messages = []
+        lost = []
+        subscriber = self.client('subscriber')
+        subscriber.on_message = messages.append
+        subscriber.on_connection_lost = lost.append
+        subscriber.subscribe('a/+')
+        publisher = self.client('publisher')
+        until(lambda: self.broker.subscriptions.match('a/b'))
+        self.loop.run_until_complete(publisher.publish('a/b', b'one'))
+        until(lambda: len(messages) == 1)
+
+        drop_connections(self.broker)
+        until(lambda: lost and subscriber.connected and publisher.connected and self.broker.subscriptions.match('a/b'))
+        self.loop.run_until_complete(publisher.publish('a/b', b'two'))
+        until(lambda: len(messages) == 2)
+        self.assertEqual([message.payload for message in messages], [b'one', b'two'])
+        self.assertEqual(len(lost), 1)
+
+    def test_qos_2(self):
+        # PUBLISH, PUBREC, PUBREL and PUBCOMP, then the publish returns and nothing is in flight
+        client = self.client('qos2')
+        for payload in (b'one', b'two', b'three'):
+            self.loop.run_until_complete(asyncio.wait_for(client.publish('a/b', payload, qos=2), 5))
+        self.assertEqual(client.pending, 0)
+        self.assertEqual(self.broker.published, 3)
+
+    def test_qos_1_resent_after_reconnect(self):
+        # The publish unacknowledged when the connection got lost is sent again, flagged as duplicate
+        self.server.close()
+        Withholding.publishes = []
+        self.server = self.loop.run_until_complete(self.loop.create_server(lambda: Withholding(self.broker), '127.0.0.1', self.port))
+        client = self.client('qos1')
+        self.loop.run_until_complete(asyncio.wait_for(client.publish('a/b', b'one', qos=1), 5))
+        self.assertEqual(client.pending, 0)
+        self.assertEqual([flags & 0x08 for flags in Withholding.publishes], [0, 0x08])
+        self.assertEqual(self.broker.published, 1)
+
+
+class MQTTBackendTest(unittest.TestCase):
+    # Against the stand-in, which sends a copy per matching subscription like mosquitto
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.broker, self.server = self.loop.run_until_complete(brokers.start('mqtt', port=0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.controller = None
+
+    def tearDown(self):
+        if self.controller is not None:
+            for client in self.controller.adapter.clients:
+                client.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def overlapping(self, version, copies='false'):
+        # The payloads of the streams of '#', 'a.b' and 'a.c'
+        self.controller = mqtt.create({'name': 'mqtt', 'host': '127.0.0.1', 'port': str(self.port), 'protocol_version': version, 'copies': copies})
+        everything, ab, ac = Collector(), Collector(), Collector()
+        self.controller.subscribe('#', everything)
+        self.controller.subscribe('a.b', ab)
+        self.controller.subscribe('a.c', ac)
+        self.run_for(0.3)
+        publisher = self.controller.adapter.publisher()
+        for topic, payload in (('a.b', b'one'), ('a.b', b'one'), ('a.c', b'two'), ('x', b'three')):
+            self.loop.run_until_complete(publisher.publish(topic, payload))
+        self.run_for(0.3)
+        return everything.payloads, ab.payloads, ac.payloads
+
+    def test_overlapping_3_1_1(self):
+        self.assertEqual(self.overlapping('3.1.1', copies='true'), ([b'one', b'one', b'two', b'three'], [b'one', b'one'], [b'two']))
+
+    def test_overlapping_5(self):
+        self.assertEqual(self.overlapping('5'), ([b'one', b'one', b'two', b'three'], [b'one', b'one'], [b'two']))
+
+    def test_overlapping_copies(self):
+        # Without subscription identifiers, and copies off, every copy goes to all matching streams
+        self.assertEqual(self.overlapping('3.1.1'), ([b'one'] * 4 + [b'two'] * 2 + [b'three'], [b'one'] * 4, [b'two'] * 2))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+import brokers
+from http2broker.protocol.nats import Client, Protocol
+from . import until, drop_connections
+
+
+class Recorder(object):
+    # Stands in for the transport of a protocol
+    def __init__(self):
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def close(self):
+        pass
+
+
+class NATSClientTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.get_event_loop()
+        self.broker, self.server = self.loop.run_until_complete(brokers.start('nats', port=0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    def client(self, name):
+        client = Client('nats://127.0.0.1:{}'.format(self.port), name)
+        client.start()
+        self.clients.append(client)
+        until(lambda: client.connected)
+        return client
+
+    def test_split_operations(self):
+        # Operations arriving a byte at a time, payloads containing CRLF, and a PING answered with PONG
+        messages = []
+        client = Client('nats://127.0.0.1:{}'.format(self.port))
+        protocol = Protocol(client)
+        protocol.transport = Recorder()
+        client._subscriptions[1] = ('a.*', None, messages.append)
+        client._subscriptions[2] = ('b', None, messages.append)
+        data = b''.join([b'MSG a.b 1 3\r\none\r\n', b'PING\r\n', b'MSG b 2 reply.to 10\r\ntwo\r\nlines\r\n',
+                         b'MSG a.c 1 0\r\n\r\n'])
+        for i in range(len(data)):
+            protocol.data_received(data[i:i + 1])
+        self.assertEqual([(message.subject, message.sid, message.reply, message.data) for message in messages],
+                         [('a.b', 1, None, b'one'), ('b', 2, 'reply.to', b'two\r\nlines'), ('a.c', 1, None, b'')])
+        protocol._flush()
+        self.assertEqual(b''.join(protocol.transport.written), b'PONG\r\n')
+
+    def test_reconnect_resubscribes(self):
+        messages = []
+        lost = []
+        subscriber = self.client('subscriber')
+        subscriber.on_connection_lost = lost.append
+        subscriber.subscribe('a.>', messages.append)
+        publisher = self.client('publisher')
+        self.loop.run_until_complete(publisher.flush())
+        until(lambda: self.broker.subscriptions.match('a.b'))
+        self.loop.run_until_complete(publisher.publish('a.b', b'one'))
+        until(lambda: len(messages) == 1)
+
+        drop_connections(self.broker)
+        until(lambda: lost and subscriber.connected and publisher.connected and self.broker.subscriptions.match('a.b'))
+        self.loop.run_until_complete(publisher.publish('a.b', b'two'))
+        until(lambda: len(messages) == 2)
+        self.assertEqual([message.data for message in messages], [b'one', b'two'])
+        self.assertEqual(len(lost), 1)
+
+    def test_publish_many_flushes(self):
+        # Returns once the PONG to the PING after the batch arrived, so the server processed all of it
+        client = self.client('batch')
+        self.loop.run_until_complete(asyncio.wait_for(client.publish_many([('a.{}'.format(i), b'x' * i) for i in range(100)]), 5))
+        self.assertEqual(self.broker.published, 100)
+        self.assertFalse(client._pongs)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+from http2broker import negotiation
+from http2broker.negotiation import negotiate
+from http2broker.stream import TextEventStream, NDJSONStream, PlainTextStream, BinaryStream
+
+
+class NegotiationTest(unittest.TestCase):
+    def test_exact(self):
+        self.assertIs(negotiate(b'text/event-stream'), TextEventStream)
+        self.assertIs(negotiate(b'application/x-ndjson'), NDJSONStream)
+        self.assertIs(negotiate(b'text/plain'), PlainTextStream)
+        self.assertIs(negotiate(b'application/x-h2a-frames'), BinaryStream)
+
+    def test_default(self):
+        # No Accept header, or nothing usable in it, gets the first format
+        for accept in (None, b'', b'garbage', b', ;q=1'):
+            self.assertIs(negotiate(accept), TextEventStream, accept)
+
+    def test_wildcards(self):
+        self.assertIs(negotiate(b'*/*'), TextEventStream)
+        self.assertIs(negotiate(b'application/*'), NDJSONStream)
+        self.assertIs(negotiate(b'text/*;q=0.5, application/x-h2a-frames;q=0.4'), TextEventStream)
+
+    def test_quality(self):
+        self.assertIs(negotiate(b'text/plain;q=0.5, application/x-ndjson;q=0.9'), NDJSONStream)
+        # The most specific range decides, so an excluded format is not taken for */*
+        self.assertIs(negotiate(b'text/event-stream;q=0, */*'), NDJSONStream)
+        self.assertIs(negotiate(b'Text/Plain; Q=1, text/event-stream; q=0.1'), PlainTextStream)
+        self.assertIs(negotiate(b'text/plain;q=x, application/x-ndjson;q=0.1'), NDJSONStream)
+
+    def test_not_acceptable(self):
+        self.assertIsNone(negotiate(b'application/json'))
+        self.assertIsNone(negotiate(b'*/*;q=0'))
+
+    def test_cached(self):
+        accept = b'application/x-ndjson, text/plain;q=0.2'
+        negotiate(accept)
+        self.assertIs(negotiation.CACHE.get(accept), NDJSONStream)
+
+
+if __name__ == '__main__':
+    unittest.main()
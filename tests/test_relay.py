@@ -0,0 +1,98 @@
+import asyncio
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+import brokers
+from http2broker import relay
+from http2broker.stream import Frame
+from http2broker.backend import mqtt
+from . import free_port, Collector
+
+
+def backend_name(workers, owners):
+    # One whose patterns are owned by the given workers
+    probe = relay.Relay(0, workers, '')
+    for i in range(1000):
+        name = 'mqtt-{}'.format(i)
+        if all(probe.owner(name, pattern) == owner for pattern, owner in owners.items()):
+            return name
+
+
+@asyncio.coroutine
+def start_worker(index, workers, path, name, port):
+    yield from relay.setup(index, workers, path).start()
+    controller = mqtt.create({'name': name, 'host': '127.0.0.1', 'port': str(port)})
+    relay.register(name, controller)
+    return controller
+
+
+def run_owner(path, name, port, started):
+    # The second worker, with the broker, owning '#'
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(brokers.start('mqtt', port=port))
+    loop.run_until_complete(start_worker(1, 2, path, name, port))
+    started.set()
+    loop.run_forever()
+
+
+class RelayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'r-{}.sock')
+        self.port = free_port()
+        self.name = backend_name(2, {'#': 1, 'a.b': 0})
+        started = multiprocessing.Event()
+        self.owner = multiprocessing.Process(target=run_owner, args=(self.path, self.name, self.port, started))
+        self.owner.start()
+        self.assertTrue(started.wait(10))
+        self.loop = asyncio.get_event_loop()
+
+    def tearDown(self):
+        self.owner.terminate()
+        self.owner.join()
+        relay.RELAY[0] = None
+        relay.BACKENDS.clear()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_overlapping_patterns(self):
+        # 'a.b' is subscribed at the broker here, '#' relayed from the other worker: a message matching both
+        # reaches each stream once
+        everything, ab = Collector(), Collector()
+        controller = self.loop.run_until_complete(start_worker(0, 2, self.path, self.name, self.port))
+        controller.subscribe('#', everything)
+        controller.subscribe('a.b', ab)
+        self.loop.run_until_complete(asyncio.sleep(0.5))
+        self.loop.run_until_complete(controller.adapter.publisher().publish('a.b', b'one'))
+        self.loop.run_until_complete(asyncio.sleep(0.5))
+        self.assertEqual(everything.payloads, [b'one'])
+        self.assertEqual(ab.payloads, [b'one'])
+        self.assertEqual(controller.patterns('a.b'), {'a.b'})
+        for client in controller.adapter.clients:
+            client.close()
+
+
+class EncodingTest(unittest.TestCase):
+    def test_relayed_frame(self):
+        # Keeps the id and timestamp of the owner, so every worker replays it the same way
+        written = []
+
+        class Written(object):
+            buffered = 0
+            write = written.append
+
+        frame = Frame('a.b', b'one', timestamp=12.5)
+        relay.Peer(relay.Relay(0, 2, ''))._send(Written, b'mqtt', b'#', frame)
+        got = []
+        link = relay.Link('')
+        link._subscriptions[('mqtt', '#')] = lambda pattern, frame: got.append((pattern, frame))
+        relay.Protocol(link).data_received(b''.join(written))
+        (pattern, relayed), = got
+        self.assertEqual(pattern, '#')
+        self.assertEqual((relayed.topic, relayed.payload, relayed.id, relayed.timestamp), ('a.b', b'one', frame.id, 12.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+from http2broker import metrics
+from http2broker.replay import Ring, Replay
+from http2broker.stream import Frame
+from . import Collector
+
+
+def ring(*payloads, size=4, limit=1024):
+    r = Ring(size, limit, metrics.gauge('h2a_test_replay_bytes'))
+    frames = [Frame('t', payload) for payload in payloads]
+    for frame in frames:
+        r(frame)
+    return r, frames
+
+
+class RingTest(unittest.TestCase):
+    def test_since(self):
+        r, frames = ring(b'a', b'b', b'c')
+        self.assertEqual(r.since(frames[0].id), frames[1:])
+        self.assertEqual(r.since(frames[2].id), [])
+
+    def test_older(self):
+        # An id older than all held frames gets everything held, one not known at all nothing
+        r, frames = ring(b'a', b'b', b'c', b'd', b'e', b'f')
+        self.assertEqual(r.since(frames[0].id), frames[2:])
+        self.assertEqual(r.since(frames[2].id + 1), [])
+        self.assertEqual(r.since(frames[-1].id + 1), [])
+
+    def test_empty(self):
+        r, _ = ring()
+        self.assertEqual(r.since(0), [])
+
+    def test_limit(self):
+        # The oldest frames go beyond limit bytes, but the last one is kept whatever its size
+        r, frames = ring(b'a' * 4, b'b' * 4, b'c' * 4, limit=10)
+        self.assertEqual(list(r.frames), frames[1:])
+        self.assertEqual(r.bytes, 8)
+        r(Frame('t', b'd' * 20))
+        self.assertEqual([frame.payload for frame in r.frames], [b'd' * 20])
+        r.clear()
+        self.assertEqual(r.bytes, 0)
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.subscribed = []
+        self.unsubscribed = []
+        self.replay = Replay(lambda pattern, sink: self.subscribed.append((pattern, sink)),
+                             lambda pattern, sink: self.unsubscribed.append((pattern, sink)), size=4, linger=0)
+
+    def test_attach(self):
+        first = Collector()
+        self.replay.attach('a.*', first)
+        (pattern, r), = self.subscribed
+        frames = [Frame('a.b', payload) for payload in (b'one', b'two', b'three')]
+        for frame in frames:
+            r(frame)
+
+        # Replayed after the Last-Event-ID, nothing for an invalid one
+        second, third = Collector(), Collector()
+        self.replay.attach('a.*', second, str(frames[0].id).encode('ascii'))
+        self.replay.attach('a.*', third, b'x')
+        self.assertEqual(second.payloads, [b'two', b'three'])
+        self.assertEqual(third.payloads, [])
+        self.assertEqual(len(self.subscribed), 1)
+
+        for i in range(3):
+            self.replay.detach('a.*')
+        self.assertEqual(self.unsubscribed, [('a.*', r)])
+        self.assertEqual(r.bytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
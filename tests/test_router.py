@@ -0,0 +1,77 @@
+import unittest
+from http2broker.router import Router
+
+
+def index(request, start_response):
+    pass
+
+
+def static(request, start_response):
+    pass
+
+
+def get(request, start_response):
+    pass
+
+
+def post(request, start_response):
+    pass
+
+
+def fallback(request, start_response):
+    pass
+
+
+class RouterTest(unittest.TestCase):
+    def setUp(self):
+        self.router = Router(16)
+        self.router.exact('/', index)
+        self.router.prefix('/static/', static, 'filename', keep_prefix=True)
+        self.router.exact('/q/redis', get, [b'GET'])
+        self.router.prefix('/q/redis/', get, 'subscription', [b'GET'])
+        self.router.prefix('/q/redis/', post, 'subscription', ['POST'])
+
+    def test_exact(self):
+        self.assertEqual(self.router.match('/', b'GET'), {'handler': index})
+        self.assertEqual(self.router.match('/q/redis', b'GET'), {'handler': get})
+        self.assertIsNone(self.router.match('/favicon.ico', b'GET'))
+
+    def test_prefix(self):
+        self.assertEqual(self.router.match('/static/js/app.js', b'GET'), {'handler': static, 'filename': '/static/js/app.js'})
+        self.assertEqual(self.router.match('/q/redis/a/b', b'GET'), {'handler': get, 'subscription': 'a/b'})
+        self.assertEqual(self.router.match('/q/redis/', b'GET'), {'handler': get})
+        self.assertIsNone(self.router.match('/q/other/a', b'GET'))
+
+    def test_query(self):
+        self.assertEqual(self.router.match('/q/redis/a?k=b', b'POST'), {'handler': post, 'subscription': 'a'})
+        self.assertEqual(self.router.match('/?x=1', b'GET'), {'handler': index})
+
+    def test_methods(self):
+        # A method not routed for a path falls through to the prefixes, then to the routes taking any method
+        self.assertIsNone(self.router.match('/q/redis/a', b'DELETE'))
+        self.assertIsNone(self.router.match('/q/redis', b'DELETE'))
+        self.router.prefix('/q/', fallback, 'rest')
+        self.assertEqual(self.router.match('/q/redis', b'POST'), {'handler': fallback, 'rest': 'redis'})
+        self.assertEqual(self.router.match('/q/redis/a', b'DELETE'), {'handler': fallback, 'rest': 'redis/a'})
+        self.assertEqual(self.router.match('/q/redis/a', b'POST'), {'handler': post, 'subscription': 'a'})
+
+    def test_longest_prefix(self):
+        self.router.prefix('/static/vendor/', fallback, 'rest')
+        self.assertEqual(self.router.match('/static/vendor/x.js', b'GET'), {'handler': fallback, 'rest': 'x.js'})
+        self.assertEqual(self.router.match('/static/vendors.js', b'GET'), {'handler': static, 'filename': '/static/vendors.js'})
+
+    def test_cached(self):
+        # Every match is a copy, so a handler changing it does not change the cached one
+        match = self.router.match('/q/redis/a', b'GET')
+        match['subscription'] = 'b'
+        self.assertEqual(self.router.match('/q/redis/a', b'GET'), {'handler': get, 'subscription': 'a'})
+        self.router.exact('/q/redis/a', fallback)
+        self.assertEqual(self.router.match('/q/redis/a', b'GET'), {'handler': fallback})
+
+    def test_invalid_prefix(self):
+        with self.assertRaises(ValueError):
+            self.router.prefix('/static', static, 'filename')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+from http2broker.static import StaticCache
+from . import ROOT
+
+
+class Request(object):
+    def __init__(self, *headers):
+        self.headers = list(headers)
+
+
+class StaticTest(unittest.TestCase):
+    def setUp(self):
+        self.files = StaticCache(os.path.join(ROOT, 'content'))
+
+    def test_served(self):
+        status, _, body = self.files.response(Request(), '/static/app.js')
+        self.assertEqual(status, 200)
+        with open(os.path.join(ROOT, 'content', 'static', 'app.js'), 'rb') as f:
+            self.assertEqual(body, f.read())
+
+    def test_traversal(self):
+        # The templates are next to the static files, but not below them
+        for filename in ('/static/../templates-wheezy/index.html', '/static/%2e%2e/templates-wheezy/index.html',
+                         '/static/../../setup.py', '/static//etc/passwd', '/templates-wheezy/index.html'):
+            self.assertEqual(self.files.response(Request(), filename), (404, [], None), filename)
+
+    def test_other_spelling(self):
+        # Resolving to a file below the directory is fine, and cached only once
+        status, _, _ = self.files.response(Request(), '/static/./x/../app.js')
+        self.assertEqual(status, 200)
+        self.assertEqual(list(self.files._files), ['/static/app.js'])
+
+    def test_sibling_directory(self):
+        # A directory only starting with the name of the static one is not below it
+        root = tempfile.mkdtemp()
+        try:
+            for directory in ('static', 'static-private'):
+                os.mkdir(os.path.join(root, directory))
+                with open(os.path.join(root, directory, 'a.txt'), 'w') as f:
+                    f.write(directory)
+            files = StaticCache(root)
+            self.assertEqual(files.response(Request(), '/static/a.txt')[0], 200)
+            self.assertEqual(files.response(Request(), '/static/../static-private/a.txt'), (404, [], None))
+        finally:
+            shutil.rmtree(root)
+
+    def test_not_modified(self):
+        _, headers, _ = self.files.response(Request(), '/static/app.js')
+        etag = dict(headers)[b'etag']
+        status, _, body = self.files.response(Request((b'if-none-match', etag.encode('ascii'))), '/static/app.js')
+        self.assertEqual((status, body), (304, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import asyncio
+import time
+import unittest
+import nghttp2
+from http2broker import stream
+from http2broker.stream import Frame, Stream, Buffering, PlainTextStream
+
+
+class Request(object):
+    def __init__(self):
+        self.eof = False
+        self.resumed = 0
+
+    def resume(self):
+        self.resumed += 1
+
+
+def open_stream(**config):
+    config.setdefault('name', 'test')
+    return Stream(Request(), PlainTextStream, Buffering(config))
+
+
+class IdsTest(unittest.TestCase):
+    def tearDown(self):
+        stream.seed_ids()
+
+    def test_workers(self):
+        # Seeded at the same time, the workers still hand out different ids
+        ids = []
+        for worker in (0, 1, 2):
+            stream.seed_ids(worker)
+            ids.append([Frame('t', b'').id for i in range(3)])
+        self.assertEqual(len(set(sum(ids, []))), 9)
+        for worker, worker_ids in enumerate(ids):
+            self.assertEqual({id % (1 << stream.WORKER_BITS) for id in worker_ids}, {worker})
+            self.assertEqual(worker_ids, sorted(worker_ids))
+
+    def test_restart(self):
+        stream.seed_ids(1)
+        before = Frame('t', b'').id
+        time.sleep(0.001)
+        stream.seed_ids(1)
+        self.assertGreater(Frame('t', b'').id, before)
+
+
+
+class PackingTest(unittest.TestCase):
+    def test_pack(self):
+        # All buffered messages fitting go into one DATA frame
+        s = open_stream()
+        for payload in (b'a', b'b', b'c'):
+            s.consume(Frame('t', payload))
+        self.assertEqual(s(100), (b'a\nb\nc\n', nghttp2.DATA_OK))
+        self.assertEqual(s.buffered, 0)
+
+    def test_keep_for_next(self):
+        # A message not fitting anymore is kept whole for the next frame
+        s = open_stream()
+        s.consume(Frame('t', b'aa'))
+        s.consume(Frame('t', b'bb'))
+        self.assertEqual(s(5), (b'aa\n', nghttp2.DATA_OK))
+        self.assertEqual(s(5), (b'bb\n', nghttp2.DATA_OK))
+
+    def test_split(self):
+        # Only a message larger than a whole frame gets split
+        s = open_stream()
+        s.consume(Frame('t', b'x' * 10))
+        s.consume(Frame('t', b'y'))
+        self.assertEqual([s(4) for i in range(4)], [(b'xxxx', nghttp2.DATA_OK), (b'xxxx', nghttp2.DATA_OK),
+                                                    (b'xx\n', nghttp2.DATA_OK), (b'y\n', nghttp2.DATA_OK)])
+
+    def test_deferred(self):
+        # A deferred stream gets resumed once per loop iteration, however many messages arrive meanwhile
+        s = open_stream()
+        self.assertEqual(s(100), (None, nghttp2.DATA_DEFERRED))
+        s.consume(Frame('t', b'a'))
+        s.consume(Frame('t', b'b'))
+        asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+        self.assertEqual(s.request.resumed, 1)
+        self.assertEqual(s(100), (b'a\nb\n', nghttp2.DATA_OK))
+
+    def test_eof(self):
+        s = open_stream()
+        s.consume(Frame('t', b'a'))
+        s.request.eof = True
+        self.assertEqual(s(100), (b'a\n', nghttp2.DATA_EOF))
+        self.assertEqual(s(100), (None, nghttp2.DATA_EOF))
+
+    def test_shared(self):
+        # A frame fanned out to several streams is held until the last of them sent it
+        frame = Frame('t', b'a')
+        streams = [open_stream(), open_stream()]
+        for s in streams:
+            s.consume(frame)
+        self.assertEqual(streams[0](100), (b'a\n', nghttp2.DATA_OK))
+        self.assertTrue(frame.retained)
+        self.assertEqual(streams[1](100), (b'a\n', nghttp2.DATA_OK))
+        self.assertFalse(frame.retained)
+
+
+class OverflowTest(unittest.TestCase):
+    def test_close(self):
+        # The message written in part is finished before the end of the stream, the queued ones are dropped
+        s = open_stream(overflow='close', buffer_messages='2')
+        s.consume(Frame('t', b'a' * 30))
+        s.consume(Frame('t', b'b'))
+        self.assertEqual(s(20), (b'a' * 20, nghttp2.DATA_OK))
+        s.consume(Frame('t', b'c'))
+        s.consume(Frame('t', b'd'))
+        self.assertTrue(s.request.eof)
+        self.assertEqual(s(20), (b'a' * 10 + b'\n', nghttp2.DATA_EOF))
+        self.assertEqual(s.buffered, 0)
+
+    def test_drop_oldest(self):
+        s = open_stream(buffer_messages='2')
+        for payload in (b'a', b'b', b'c'):
+            s.consume(Frame('t', payload))
+        self.assertEqual(s(100), (b'b\nc\n', nghttp2.DATA_OK))
+
+    def test_drop_newest(self):
+        s = open_stream(overflow='drop_newest', buffer_messages='2')
+        for payload in (b'a', b'b', b'c'):
+            s.consume(Frame('t', payload))
+        self.assertEqual(s(100), (b'a\nb\n', nghttp2.DATA_OK))
+
+
+if __name__ == '__main__':
+    unittest.main()